@@ -0,0 +1,175 @@
+import argparse
+import math
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# --- Batched augmentation on uint8 tensors ---
+# Reproduces train_transform (RandomResizedCrop(224, scale=(0.8, 1.0)) ->
+# RandomHorizontalFlip -> RandomRotation(15) -> ColorJitter(0.3, 0.3) ->
+# Normalize) for a whole (N, 3, H, W) batch at once. Crop, flip and rotation
+# are folded into one affine grid per sample, so the batch is resampled with
+# a single grid_sample call; parameters are drawn independently per sample.
+
+class BatchAugment(nn.Module):
+    def __init__(self, size=224, scale=(0.8, 1.0), ratio=(3 / 4, 4 / 3), degrees=15.0,
+                 brightness=0.3, contrast=0.3, flip_p=0.5):
+        super().__init__()
+        self.size = size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.degrees = degrees
+        self.brightness = brightness
+        self.contrast = contrast
+        self.flip_p = flip_p
+        self.register_buffer('mean', torch.tensor(MEAN).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(STD).view(1, 3, 1, 1))
+
+    def sample_crops(self, n, height, width, device):
+        """Vectorized RandomResizedCrop.get_params: crop size/centre in normalized [-1, 1] units."""
+        area = height * width
+        crop_w = torch.full((n,), float(width), device=device)
+        crop_h = torch.full((n,), float(height), device=device)
+        pending = torch.ones(n, dtype=torch.bool, device=device)
+        # Same 10 rejection-sampling attempts as torchvision, then centre-crop fallback
+        for _ in range(10):
+            target = area * torch.empty(n, device=device).uniform_(*self.scale)
+            aspect = torch.exp(torch.empty(n, device=device).uniform_(*self.log_ratio))
+            w = torch.sqrt(target * aspect).round()
+            h = torch.sqrt(target / aspect).round()
+            fits = pending & (w > 0) & (h > 0) & (w <= width) & (h <= height)
+            crop_w = torch.where(fits, w, crop_w)
+            crop_h = torch.where(fits, h, crop_h)
+            pending &= ~fits
+            if not pending.any():
+                break
+        # Random top-left corner, expressed as the crop centre in normalized coordinates
+        left = torch.floor(torch.rand(n, device=device) * (width - crop_w + 1))
+        top = torch.floor(torch.rand(n, device=device) * (height - crop_h + 1))
+        center_x = (left + crop_w / 2) / width * 2 - 1
+        center_y = (top + crop_h / 2) / height * 2 - 1
+        return crop_w / width, crop_h / height, center_x, center_y
+
+    def forward(self, images):
+        n, _, height, width = images.shape
+        device = images.device
+        images = images.float() / 255.0 if images.dtype == torch.uint8 else images
+
+        half_w, half_h, center_x, center_y = self.sample_crops(n, height, width, device)
+        flip = torch.where(torch.rand(n, device=device) < self.flip_p, -1.0, 1.0)
+        angle = torch.empty(n, device=device).uniform_(-self.degrees, self.degrees) * math.pi / 180
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # Output coords -> un-rotate -> un-flip -> position inside the crop
+        theta = torch.zeros(n, 2, 3, device=device)
+        theta[:, 0, 0] = half_w * flip * cos
+        theta[:, 0, 1] = -half_w * flip * sin
+        theta[:, 0, 2] = center_x
+        theta[:, 1, 0] = half_h * sin
+        theta[:, 1, 1] = half_h * cos
+        theta[:, 1, 2] = center_y
+        grid = F.affine_grid(theta, (n, 3, self.size, self.size), align_corners=False)
+        out = F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+        # RandomRotation fills the corners that rotate in from outside the crop with black
+        base = F.affine_grid(torch.eye(2, 3, device=device).expand(n, 2, 3), (n, 3, self.size, self.size), align_corners=False)
+        rot_x = base[..., 0] * cos.view(n, 1, 1) - base[..., 1] * sin.view(n, 1, 1)
+        rot_y = base[..., 0] * sin.view(n, 1, 1) + base[..., 1] * cos.view(n, 1, 1)
+        inside = ((rot_x.abs() <= 1) & (rot_y.abs() <= 1)).unsqueeze(1)
+        out = out * inside
+
+        out = self.color_jitter(out)
+        return (out - self.mean) / self.std
+
+    def color_jitter(self, images):
+        """Brightness and contrast jitter, applied in a random order per sample like ColorJitter."""
+        n = images.shape[0]
+        device = images.device
+        b = torch.empty(n, 1, 1, 1, device=device).uniform_(1 - self.brightness, 1 + self.brightness)
+        c = torch.empty(n, 1, 1, 1, device=device).uniform_(1 - self.contrast, 1 + self.contrast)
+
+        def brightness(x):
+            return (x * b).clamp(0, 1)
+
+        def contrast(x):
+            gray = 0.2989 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]
+            mean = gray.mean(dim=(1, 2)).view(n, 1, 1, 1)
+            return (c * x + (1 - c) * mean).clamp(0, 1)
+
+        brightness_first = (torch.rand(n, 1, 1, 1, device=device) < 0.5)
+        return torch.where(brightness_first, contrast(brightness(images)), brightness(contrast(images)))
+
+class BatchPreprocess(nn.Module):
+    """preprocess_transform for uint8 batches: resize to 224x224 and normalize."""
+
+    def __init__(self, size=224):
+        super().__init__()
+        self.size = size
+        self.register_buffer('mean', torch.tensor(MEAN).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(STD).view(1, 3, 1, 1))
+
+    def forward(self, images):
+        images = images.float() / 255.0 if images.dtype == torch.uint8 else images
+        if images.shape[-2:] != (self.size, self.size):
+            images = F.interpolate(images, size=(self.size, self.size), mode='bilinear', align_corners=False, antialias=True)
+        return (images - self.mean) / self.std
+
+# --- Throughput benchmark vs the per-sample pipeline ---
+def main(args):
+    from torch.utils.data import DataLoader
+    from shard_dataset import ShardDataset, shard_train_transform
+    from train import ImageTensorDataset, train_transform
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    def run(loader, batch_fn):
+        seen = 0
+        start = time.perf_counter()
+        for batch_idx, (inputs, _) in enumerate(loader):
+            out = batch_fn(inputs.to(device, non_blocking=True))
+            seen += out.shape[0]
+            if batch_idx + 1 >= args.batches:
+                break
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return seen / (time.perf_counter() - start)
+
+    identity = lambda x: x  # noqa: E731
+    augment = BatchAugment().to(device)
+    rows = [
+        ("JPEG + PIL train_transform", run(DataLoader(ImageTensorDataset(args.data_dir, transform=train_transform),
+                                                      batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers), identity)),
+        ("shard + per-sample tensor aug", run(DataLoader(ShardDataset(args.shard_dir, transform=shard_train_transform),
+                                                         batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers), identity)),
+        ("shard + BatchAugment", run(DataLoader(ShardDataset(args.shard_dir),
+                                                batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers), augment)),
+    ]
+    print(f"Device: {device}, batch size {args.batch_size}, num_workers {args.num_workers}")
+    for name, rate in rows:
+        print(f"{name:<32}{rate:10.1f} images/s  ({rate / rows[0][1]:.2f}x)")
+
+    # Distribution check: per-channel statistics of both augmenters on the same images
+    images = torch.stack([ShardDataset(args.shard_dir)[i][0] for i in range(min(256, args.batch_size * 8))])
+    reference = torch.stack([shard_train_transform(img) for img in images])
+    batched = augment(images.to(device)).cpu()
+    print("\nPer-channel mean/std (per-sample vs batched):")
+    for ch in range(3):
+        print(f"  channel {ch}: {reference[:, ch].mean():+.3f}/{reference[:, ch].std():.3f} vs "
+              f"{batched[:, ch].mean():+.3f}/{batched[:, ch].std():.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched tensor augmentation against the per-sample pipeline.")
+    parser.add_argument('--data_dir', type=str, default=os.path.join('chest_xray', 'train'), help='JPEG split directory')
+    parser.add_argument('--shard_dir', type=str, default=os.path.join('chest_xray_shards', 'train'), help='Shard split directory')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size')
+    parser.add_argument('--num_workers', type=int, default=2, help='DataLoader workers')
+    parser.add_argument('--batches', type=int, default=50, help='Batches to time per pipeline')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,63 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# --- Scaling benchmark: global training throughput for 1..N processes ---
+# Each point launches launch_ddp.py with train.py --benchmark, which trains a
+# capped epoch and prints "[BENCH] world_size=... images_per_sec=...".
+
+BENCH_LINE = re.compile(r"\[BENCH\] world_size=(\d+) images_per_sec=([\d.]+)")
+
+def run_point(nproc, args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, os.path.join(here, 'launch_ddp.py'),
+               '--nproc', str(nproc), '--threads_per_rank', str(args.threads_per_rank),
+               '--master_port', str(args.master_port), '--',
+               '--arch', args.arch, '--data_root', args.data_root,
+               '--batch_size', str(args.batch_size), '--max_steps', str(args.steps),
+               '--head_epochs', '0', '--full_epochs', '1', '--benchmark']
+    if args.pin_cores:
+        command.append('--pin_cores')
+    if args.shard_dir:
+        command += ['--shard_dir', args.shard_dir, '--batch_augment']
+    result = subprocess.run(command, capture_output=True, text=True)
+    match = BENCH_LINE.search(result.stdout)
+    if result.returncode != 0 or match is None:
+        print(result.stdout[-2000:], result.stderr[-2000:], sep='\n')
+        raise RuntimeError(f"benchmark with {nproc} processes failed (exit {result.returncode})")
+    return float(match.group(2))
+
+def main(args):
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    max_procs = args.max_procs or max(1, cores // args.threads_per_rank)
+    counts = sorted({n for n in args.procs if n <= max_procs}) if args.procs else list(range(1, max_procs + 1))
+
+    rows = []
+    for nproc in counts:
+        rate = run_point(nproc, args)
+        rows.append((nproc, rate))
+        print(f"  {nproc} process(es): {rate:.1f} images/s")
+
+    base = rows[0][1] / rows[0][0]
+    print(f"\n{args.arch}, batch {args.batch_size}/rank, {args.threads_per_rank} threads/rank, {cores} cores")
+    print(f"{'procs':>6}{'images/s':>12}{'speed-up':>10}{'efficiency':>12}")
+    for nproc, rate in rows:
+        print(f"{nproc:>6}{rate:>12.1f}{rate / rows[0][1]:>9.2f}x{100 * rate / (base * nproc):>11.0f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure DDP training throughput from 1 to N processes on this machine.")
+    parser.add_argument('--arch', type=str, default='efficientnet', help='Architecture to benchmark')
+    parser.add_argument('--data_root', type=str, default='chest_xray', help='Dataset root with train/ and val/')
+    parser.add_argument('--shard_dir', type=str, default=None, help='Use memmap shards + BatchAugment instead of JPEG folders')
+    parser.add_argument('--batch_size', type=int, default=16, help='Per-rank batch size')
+    parser.add_argument('--steps', type=int, default=30, help='Training steps timed per point')
+    parser.add_argument('--threads_per_rank', type=int, default=4, help='Intra-op threads per process')
+    parser.add_argument('--pin_cores', action='store_true', help='Pin each rank to its own cores')
+    parser.add_argument('--max_procs', type=int, default=None, help='Largest process count (default: cores / threads_per_rank)')
+    parser.add_argument('--procs', type=int, nargs='+', default=None, help='Explicit process counts to test')
+    parser.add_argument('--master_port', type=int, default=29511, help='Rendezvous port')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,101 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from train import ImageTensorDataset
+
+# --- One-time dataset build: decode + resize every split into a uint8 memmap shard ---
+# Layout of <out_dir>/<split>/:
+#   images.u8      raw uint8 array, shape (N, size, size, 3)
+#   labels.npy     int64 labels, shape (N,)
+#   manifest.json  shape, class mapping and one record per image
+
+def decode_one(job):
+    file_path, size = job
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    image = Image.open(file_path)
+    original_size = image.size
+    image = image.convert('RGB').resize((size, size), Image.Resampling.BILINEAR)
+    return np.asarray(image, dtype=np.uint8), original_size, digest
+
+def build_split(data_dir, out_dir, size, workers):
+    dataset = ImageTensorDataset(data_dir)
+    idx_to_class = {i: cls for cls, i in dataset.class_to_idx.items()}
+    os.makedirs(out_dir, exist_ok=True)
+
+    count = len(dataset.file_paths)
+    images = np.memmap(os.path.join(out_dir, 'images.u8'), dtype=np.uint8, mode='w+', shape=(count, size, size, 3))
+    labels = np.empty(count, dtype=np.int64)
+    records = []
+
+    jobs = [(path, size) for path in dataset.file_paths]
+    with Pool(workers) as pool:
+        for idx, (pixels, original_size, digest) in enumerate(pool.imap(decode_one, jobs, chunksize=16)):
+            file_path = dataset.file_paths[idx]
+            label = dataset.class_to_idx[os.path.basename(os.path.dirname(file_path))]
+            images[idx] = pixels
+            labels[idx] = label
+            records.append({
+                'index': idx,
+                'path': file_path,
+                'label': label,
+                'class': idx_to_class[label],
+                'original_size': list(original_size),
+                'sha256': digest,
+            })
+    images.flush()
+    np.save(os.path.join(out_dir, 'labels.npy'), labels)
+    return {'shape': [count, size, size, 3], 'class_to_idx': dataset.class_to_idx, 'records': records}
+
+def flag_duplicates(manifests):
+    """Mark records whose content hash appears more than once, within or across splits."""
+    seen = {}
+    for split, manifest in manifests.items():
+        for record in manifest['records']:
+            seen.setdefault(record['sha256'], []).append((split, record['index']))
+
+    cross_split = 0
+    for split, manifest in manifests.items():
+        for record in manifest['records']:
+            copies = [f"{s}:{i}" for s, i in seen[record['sha256']] if (s, i) != (split, record['index'])]
+            record['duplicates'] = copies
+            if any(not c.startswith(f"{split}:") for c in copies):
+                cross_split += 1
+    return cross_split
+
+def main(args):
+    start = time.time()
+    manifests = {}
+    for split in args.splits:
+        data_dir = os.path.join(args.data_root, split)
+        print(f"Building {split} shard from {data_dir}...")
+        manifests[split] = build_split(data_dir, os.path.join(args.out_dir, split), args.size, args.workers)
+        print(f"  {manifests[split]['shape'][0]} images")
+
+    cross_split = flag_duplicates(manifests)
+    for split, manifest in manifests.items():
+        with open(os.path.join(args.out_dir, split, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+    print(f"\nShards written to {args.out_dir} in {time.time() - start:.1f}s")
+    if cross_split:
+        print(f"WARNING: {cross_split} images have identical copies in another split (see 'duplicates' in manifest.json)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-decode the dataset into memory-mapped uint8 shards.")
+    parser.add_argument('--data_root', type=str, default='chest_xray', help='Dataset root with one folder per split')
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val', 'test'], help='Splits to build')
+    parser.add_argument('--out_dir', type=str, default='chest_xray_shards', help='Output directory')
+    parser.add_argument('--size', type=int, default=256, help='Stored square resolution (>= 224 leaves room for crops)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Decode processes')
+
+    args = parser.parse_args()
+    main(args)
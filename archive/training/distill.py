@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset
+from torchvision.models import mobilenet_v3_large, MobileNet_V3_Large_Weights, mobilenet_v3_small, MobileNet_V3_Small_Weights
+from tqdm import tqdm
+
+from train import (ARCHITECTURES, Engine, ImageTensorDataset, build_loader, configure_stage, preprocess_transform,
+                   print_throughput, train_transform)
+
+# --- Knowledge distillation of the ensemble into one small student ---
+# Teacher targets are the serving ensemble's probabilities, computed exactly as
+# predict() does: softmax per member on the un-augmented preprocess_transform
+# input with each member's logits divided by its temperature, then the weighted
+# sum, read from the serving ensemble_config.json (--ensemble_config) the same
+# way backend/models.py does; --convnext_weight/--efficientnet_weight only
+# override the weights.
+# Member logits are cached once per split in <cache_dir>/teacher_<split>.npz;
+# the student then trains on augmented views against the cached targets.
+
+STUDENTS = {
+    'mobilenet_v3_large': (mobilenet_v3_large, MobileNet_V3_Large_Weights.IMAGENET1K_V1),
+    'mobilenet_v3_small': (mobilenet_v3_small, MobileNet_V3_Small_Weights.IMAGENET1K_V1),
+}
+
+def build_student(arch, num_classes):
+    builder, weights = STUDENTS[arch]
+    model = builder(weights=weights)
+    model.classifier[3] = nn.Linear(model.classifier[3].in_features, num_classes)
+    return model
+
+# --- Teacher cache ---
+def load_member(arch, weights_path, num_classes, device):
+    # No ImageNet download: the checkpoint replaces every weight anyway
+    model = ARCHITECTURES[arch]['build'](num_classes, pretrained=False)
+    model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+    return model.to(device).eval()
+
+@torch.no_grad()
+def member_logits(model, dataset, batch_size, num_workers, device):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    return torch.cat([model(inputs.to(device)).float().cpu() for inputs, _ in tqdm(loader, desc="Teacher logits")])
+
+def build_teacher_cache(args, split, device):
+    """Run both members over a split once (no augmentation) and store their logits."""
+    dataset = ImageTensorDataset(os.path.join(args.data_root, split), transform=preprocess_transform)
+    num_classes = len(dataset.class_to_idx)
+    logits = {}
+    for arch, weights_path in (('convnext', args.convnext_path), ('efficientnet', args.efficientnet_path)):
+        logits[arch] = member_logits(load_member(arch, weights_path, num_classes, device), dataset,
+                                     args.batch_size, args.num_workers, device).numpy()
+    labels = np.array([dataset.class_to_idx[os.path.basename(os.path.dirname(p))] for p in dataset.file_paths], dtype=np.int64)
+    path = os.path.join(args.cache_dir, f"teacher_{split}.npz")
+    os.makedirs(args.cache_dir, exist_ok=True)
+    np.savez_compressed(path, convnext=logits['convnext'], efficientnet=logits['efficientnet'],
+                        labels=labels, paths=np.array(dataset.file_paths))
+    return path
+
+def load_teacher(args, split, device):
+    path = os.path.join(args.cache_dir, f"teacher_{split}.npz")
+    if args.rebuild or not os.path.exists(path):
+        start = time.time()
+        build_teacher_cache(args, split, device)
+        print(f"Teacher cache for {split} built in {time.time() - start:.1f}s")
+    with np.load(path) as cache:
+        data = {key: cache[key] for key in cache.files}
+    files = sorted(ImageTensorDataset(os.path.join(args.data_root, split)).file_paths)
+    if sorted(data['paths'].tolist()) != files:
+        raise RuntimeError(f"{path} does not match the files in {args.data_root}/{split}; re-run with --rebuild")
+    return data
+
+# Same defaults and keys as backend/models.py load_ensemble_config()
+ENSEMBLE_CONFIG_PATH = os.getenv('ENSEMBLE_CONFIG', 'ensemble_config.json')
+ENSEMBLE_DEFAULTS = {'convnext_weight': 0.4, 'efficientnet_weight': 0.6,
+                     'convnext_temperature': 1.0, 'efficientnet_temperature': 1.0}
+
+def load_ensemble_config(path):
+    """Fusion settings written by backend/tune_ensemble.py, falling back to the serving defaults."""
+    config = dict(ENSEMBLE_DEFAULTS)
+    if path and os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+        config.update({key: float(stored[key]) for key in config if key in stored})
+    return config
+
+def teacher_config(args):
+    """The server's ensemble config, with the weights overridden where given on the command line."""
+    config = load_ensemble_config(args.ensemble_config)
+    for key in ('convnext_weight', 'efficientnet_weight'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    return config
+
+def ensemble_probs(cache, config):
+    """Same fusion as predict(): weighted sum of per-member temperature-scaled softmax probabilities."""
+    probs1 = F.softmax(torch.from_numpy(cache['convnext']) / config['convnext_temperature'], dim=1)
+    probs2 = F.softmax(torch.from_numpy(cache['efficientnet']) / config['efficientnet_temperature'], dim=1)
+    return (config['convnext_weight'] * probs1) + (config['efficientnet_weight'] * probs2)
+
+class IndexedDataset(Dataset):
+    """Yields (image, index) so the loss can look up the cached teacher targets."""
+
+    def __init__(self, dataset, paths):
+        order = {path: i for i, path in enumerate(paths)}
+        self.dataset = dataset
+        self.cache_index = [order[path] for path in dataset.file_paths]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, _ = self.dataset[idx]
+        return image, self.cache_index[idx]
+
+class DistillationLoss(nn.Module):
+    """alpha * T^2 * KL(teacher || student) + (1 - alpha) * CE(student, label), indexed by cache row.
+
+    The teacher is already a probability vector, so softening divides its
+    log-probabilities by T (T=1 uses the ensemble output unchanged).
+    """
+
+    def __init__(self, teacher_probs, labels, temperature=1.0, alpha=0.9):
+        super().__init__()
+        self.register_buffer('teacher_log_probs', F.log_softmax(torch.log(teacher_probs.clamp_min(1e-8)) / temperature, dim=1))
+        self.register_buffer('labels', labels)
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def forward(self, outputs, index):
+        outputs = outputs.float()
+        student = F.log_softmax(outputs / self.temperature, dim=1)
+        kd = F.kl_div(student, self.teacher_log_probs[index], reduction='batchmean', log_target=True)
+        ce = F.cross_entropy(outputs, self.labels[index])
+        return self.alpha * self.temperature ** 2 * kd + (1 - self.alpha) * ce
+
+# --- Report: agreement with the ensemble and latency ---
+@torch.no_grad()
+def student_probs(model, dataset, batch_size, num_workers, device):
+    model.eval()
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    return torch.cat([F.softmax(model(inputs.to(device)).float(), dim=1).cpu() for inputs, _ in loader])
+
+@torch.no_grad()
+def latency_ms(fn, runs=30, warmup=5):
+    x = torch.randn(1, 3, 224, 224)
+    for _ in range(warmup):
+        fn(x)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(x)
+        times.append(1000 * (time.perf_counter() - start))
+    return float(np.median(times))
+
+def report(args, model, device):
+    cache = load_teacher(args, args.eval_split, device)
+    dataset = ImageTensorDataset(os.path.join(args.data_root, args.eval_split), transform=preprocess_transform)
+    order = {path: i for i, path in enumerate(cache['paths'].tolist())}
+    rows = torch.tensor([order[path] for path in dataset.file_paths])
+    teacher = ensemble_probs(cache, teacher_config(args))[rows]
+    labels = torch.from_numpy(cache['labels'])[rows]
+    student = student_probs(model, dataset, args.batch_size, args.num_workers, device)
+
+    agreement = 100 * (student.argmax(1) == teacher.argmax(1)).float().mean().item()
+    print(f"\n--- Distillation report ({args.eval_split}, {len(labels)} images) ---")
+    print(f"Ensemble accuracy:          {100 * (teacher.argmax(1) == labels).float().mean().item():.2f}%")
+    print(f"Student accuracy:           {100 * (student.argmax(1) == labels).float().mean().item():.2f}%")
+    print(f"Agreement with ensemble:    {agreement:.2f}%")
+    print(f"Mean |p_student - p_ens|:   {(student - teacher).abs().sum(1).mean().item() / 2:.4f} (total variation)")
+
+    # Batch-1 CPU latency, the way the server runs a request
+    cpu = torch.device('cpu')
+    num_classes = teacher.shape[1]
+    convnext = load_member('convnext', args.convnext_path, num_classes, cpu)
+    efficientnet = load_member('efficientnet', args.efficientnet_path, num_classes, cpu)
+    student_cpu = model.to(cpu).eval()
+    ensemble_ms = latency_ms(lambda x: (convnext(x), efficientnet(x)))
+    student_ms = latency_ms(student_cpu)
+    print(f"Latency (batch 1, CPU, {torch.get_num_threads()} threads): ensemble {ensemble_ms:.1f} ms, "
+          f"student {student_ms:.1f} ms -> {student_ms / ensemble_ms:.2f}x ({ensemble_ms / student_ms:.1f}x faster)")
+
+# --- Main ---
+def main(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"Using device: {device}")
+
+    cache = load_teacher(args, 'train', device)
+    config = teacher_config(args)
+    print(f"Teacher fusion: weights {config['convnext_weight']:.2f}/{config['efficientnet_weight']:.2f}, "
+          f"temperatures {config['convnext_temperature']:.2f}/{config['efficientnet_temperature']:.2f}")
+    teacher = ensemble_probs(cache, config)
+    labels = torch.from_numpy(cache['labels'])
+    print(f"Teacher (cached ensemble) train accuracy: {100 * (teacher.argmax(1) == labels).float().mean().item():.2f}%")
+
+    train_dataset = IndexedDataset(ImageTensorDataset(os.path.join(args.data_root, 'train'), transform=train_transform),
+                                   cache['paths'].tolist())
+    val_dataset = ImageTensorDataset(os.path.join(args.data_root, 'val'), transform=preprocess_transform)
+    train_loader = build_loader(train_dataset, args, shuffle=True)
+    val_loader = build_loader(val_dataset, args, shuffle=False)
+
+    model = build_student(args.student, len(val_dataset.class_to_idx)).to(device)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    criterion = DistillationLoss(teacher, labels, args.temperature, args.alpha).to(device)
+    engine = Engine(model, device, args, criterion)
+
+    optimizer, scheduler = configure_stage('full', model, args)
+    best_val_accuracy = 0.0
+    for epoch in range(args.full_epochs):
+        stats = engine.train_epoch(train_loader, optimizer, f"Distill - Epoch {epoch+1}/{args.full_epochs}")
+        print_throughput(f"\nDistill - Epoch {epoch+1}", stats)
+        correct, total = engine.validate(val_loader, f"Distill - Epoch {epoch+1}/{args.full_epochs} [Validation]")
+        val_accuracy = 100 * correct / max(1, total)
+        print(f"Distill - Epoch {epoch+1} Validation Accuracy: {val_accuracy:.2f}%")
+        scheduler.step()
+        if val_accuracy > best_val_accuracy:
+            best_val_accuracy = val_accuracy
+            torch.save(model.state_dict(), args.save_path)
+            print(f"New best student saved to {args.save_path} with accuracy: {best_val_accuracy:.2f}%")
+
+    model.load_state_dict(torch.load(args.save_path, map_location='cpu'))
+    report(args, model.to(device), device)
+    print(f"\nServe it with FAST_TIER_MODEL={args.save_path} FAST_TIER_ARCH={args.student} and tier=fast on /predict")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill the ConvNeXt + EfficientNet ensemble into a single MobileNetV3 student.")
+    parser.add_argument('--student', type=str, default='mobilenet_v3_large', choices=sorted(STUDENTS), help='Student architecture')
+    parser.add_argument('--data_root', type=str, default='chest_xray', help='Dataset root with train/, val/ and the eval split')
+    parser.add_argument('--eval_split', type=str, default='test', help='Split used for the agreement/latency report')
+    parser.add_argument('--convnext_path', type=str, default='convnext_pneumonia.pth', help='Teacher ConvNeXt checkpoint')
+    parser.add_argument('--efficientnet_path', type=str, default='efficientnet_pneumonia.pth', help='Teacher EfficientNet checkpoint')
+    parser.add_argument('--ensemble_config', type=str, default=ENSEMBLE_CONFIG_PATH, help='Serving ensemble_config.json (tune_ensemble.py); defaults apply when missing')
+    parser.add_argument('--convnext_weight', type=float, default=None, help='Override the ConvNeXt weight from the ensemble config')
+    parser.add_argument('--efficientnet_weight', type=float, default=None, help='Override the EfficientNet weight from the ensemble config')
+    parser.add_argument('--cache_dir', type=str, default='teacher_cache', help='Where the teacher logits are stored')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute the teacher cache even if it exists')
+    parser.add_argument('--temperature', type=float, default=1.0, help='Distillation temperature (1 = ensemble probabilities as served)')
+    parser.add_argument('--alpha', type=float, default=0.9, help='Weight of the distillation term vs the hard-label loss')
+    parser.add_argument('--full_epochs', type=int, default=30, help='Training epochs')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size')
+    parser.add_argument('--learning_rate', type=float, default=1e-3, help='Learning rate of the classifier (backbone uses body_lr_scale)')
+    parser.add_argument('--body_lr_scale', type=float, default=0.1, help='Backbone learning rate multiplier')
+    parser.add_argument('--weight_decay', type=float, default=1e-5, help='AdamW weight decay')
+    parser.add_argument('--schedule', type=str, default='warmup_cosine', choices=['restarts', 'warmup_cosine'], help='LR schedule')
+    parser.add_argument('--amp', action=argparse.BooleanOptionalAction, default=True, help='fp16 autocast on CUDA')
+    parser.add_argument('--channels_last', action='store_true', help='Use channels_last memory format')
+    parser.add_argument('--num_workers', type=int, default=2, help='DataLoader workers')
+    parser.add_argument('--pin_memory', action='store_true', help='Pin host memory for faster device copies')
+    parser.add_argument('--persistent_workers', action='store_true', help='Keep DataLoader workers alive between epochs')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches prefetched per worker')
+    parser.add_argument('--log_interval', type=int, default=10, help='Steps between progress-bar timing updates')
+    parser.add_argument('--max_steps', type=int, default=0, help='Cap training steps per epoch (0 = full epoch)')
+    parser.add_argument('--save_path', type=str, default='student_pneumonia.pth', help='Best student state_dict')
+
+    args = parser.parse_args()
+    main(args)
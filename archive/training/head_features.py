@@ -0,0 +1,147 @@
+import argparse
+import itertools
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from train import ARCHITECTURES, ImageTensorDataset, preprocess_transform, train_transform
+
+# --- Frozen-backbone feature cache for Stage 1 (head-only) training ---
+# The backbone (features + avgpool) runs once per image and view; the pooled
+# features are stored as float16 .npy files and the classifier head, plus any
+# learning-rate / weight-decay sweep, trains on those in seconds.
+# Features come from the backbone in eval mode, so BatchNorm statistics and
+# stochastic depth are frozen too (the live Stage 1 loop runs them in train mode).
+
+def make_head(arch, model):
+    """Fresh copy of the trainable classifier head operating on flat pooled features."""
+    if arch == 'convnext':
+        # classifier = [LayerNorm2d, Flatten, Linear]; on (N, C, 1, 1) LayerNorm2d == LayerNorm(C)
+        norm = nn.LayerNorm(model.classifier[0].normalized_shape, eps=model.classifier[0].eps)
+        norm.load_state_dict(model.classifier[0].state_dict())
+        linear = nn.Linear(model.classifier[2].in_features, model.classifier[2].out_features)
+        return nn.Sequential(norm, linear)
+    # classifier = [Dropout, Linear]
+    return nn.Sequential(nn.Dropout(model.classifier[0].p), nn.Linear(model.classifier[1].in_features, model.classifier[1].out_features))
+
+def head_state_to_model(arch, head):
+    """Map head weights onto the full model's classifier state_dict keys."""
+    state = head.state_dict()
+    if arch == 'convnext':
+        return {f"classifier.0.{k[2:]}" if k.startswith('0.') else f"classifier.2.{k[2:]}": v for k, v in state.items()}
+    return {f"classifier.1.{k[2:]}": v for k, v in state.items()}
+
+@torch.no_grad()
+def extract(model, dataset, batch_size, num_workers, device, seed=None):
+    backbone = nn.Sequential(model.features, model.avgpool, nn.Flatten()).to(device).eval()
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    if seed is not None:
+        torch.manual_seed(seed)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, generator=generator)
+    feats, labels = [], []
+    for inputs, targets in tqdm(loader, desc="Extracting features"):
+        feats.append(backbone(inputs.to(device)).half().cpu())
+        labels.append(targets)
+    return torch.cat(feats).numpy(), torch.cat(labels).numpy()
+
+def build_cache(args, model, device):
+    os.makedirs(args.cache_dir, exist_ok=True)
+    train_dir, val_dir = os.path.join(args.data_root, 'train'), os.path.join(args.data_root, 'val')
+
+    # View 0 is the un-augmented image; views 1..N are fixed-seed train_transform samples
+    views = []
+    feats, labels = extract(model, ImageTensorDataset(train_dir, transform=preprocess_transform), args.batch_size, args.num_workers, device)
+    views.append(feats)
+    for view in range(1, args.views + 1):
+        feats, _ = extract(model, ImageTensorDataset(train_dir, transform=train_transform), args.batch_size, args.num_workers, device, seed=view)
+        views.append(feats)
+    np.save(os.path.join(args.cache_dir, 'train_features.npy'), np.stack(views))
+    np.save(os.path.join(args.cache_dir, 'train_labels.npy'), labels)
+
+    val_feats, val_labels = extract(model, ImageTensorDataset(val_dir, transform=preprocess_transform), args.batch_size, args.num_workers, device)
+    np.save(os.path.join(args.cache_dir, 'val_features.npy'), val_feats)
+    np.save(os.path.join(args.cache_dir, 'val_labels.npy'), val_labels)
+
+def load_cache(cache_dir):
+    def load(name):
+        return torch.from_numpy(np.load(os.path.join(cache_dir, name), mmap_mode='r').astype(np.float32))
+    return (load('train_features.npy'), load('train_labels.npy').long(),
+            load('val_features.npy'), load('val_labels.npy').long())
+
+def train_head(head, train_feats, train_labels, val_feats, val_labels, lr, weight_decay, epochs, batch_size, label_smoothing):
+    """Train a head on cached features. train_feats is (views, N, D); one random view per sample per epoch."""
+    criterion = nn.CrossEntropyLoss(label_smoothing=label_smoothing)
+    optimizer = optim.AdamW(head.parameters(), lr=lr, weight_decay=weight_decay)
+    num_views, num_samples, _ = train_feats.shape
+    best_acc, best_state = 0.0, None
+    for _ in range(epochs):
+        head.train()
+        order = torch.randperm(num_samples)
+        view_idx = torch.randint(num_views, (num_samples,))
+        for start in range(0, num_samples, batch_size):
+            idx = order[start:start + batch_size]
+            optimizer.zero_grad()
+            loss = criterion(head(train_feats[view_idx[idx], idx]), train_labels[idx])
+            loss.backward()
+            optimizer.step()
+        head.eval()
+        with torch.no_grad():
+            val_acc = 100 * (head(val_feats).argmax(1) == val_labels).float().mean().item()
+        if val_acc > best_acc:
+            best_acc, best_state = val_acc, {k: v.clone() for k, v in head.state_dict().items()}
+    return best_acc, best_state
+
+def main(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    num_classes = len(ImageTensorDataset(os.path.join(args.data_root, 'train')).class_to_idx)
+    model = ARCHITECTURES[args.arch]['build'](num_classes)
+
+    if args.rebuild or not os.path.exists(os.path.join(args.cache_dir, 'train_features.npy')):
+        start = time.time()
+        build_cache(args, model, device)
+        print(f"Feature cache built in {time.time() - start:.1f}s")
+    train_feats, train_labels, val_feats, val_labels = load_cache(args.cache_dir)
+    print(f"Cached features: train {tuple(train_feats.shape)}, val {tuple(val_feats.shape)}")
+
+    results = []
+    start = time.time()
+    for lr, weight_decay in itertools.product(args.lrs, args.weight_decays):
+        torch.manual_seed(0)
+        head = make_head(args.arch, model)
+        acc, state = train_head(head, train_feats, train_labels, val_feats, val_labels, lr, weight_decay,
+                                args.head_epochs, args.batch_size, args.label_smoothing)
+        results.append((acc, lr, weight_decay, state))
+        print(f"lr={lr:.0e} weight_decay={weight_decay:.0e} -> best val accuracy {acc:.2f}%")
+    print(f"Sweep of {len(results)} configs finished in {time.time() - start:.1f}s")
+
+    best_acc, best_lr, best_wd, best_state = max(results, key=lambda r: r[0])
+    head = make_head(args.arch, model)
+    head.load_state_dict(best_state)
+    model.load_state_dict(head_state_to_model(args.arch, head), strict=False)
+    torch.save(model.state_dict(), args.save_path)
+    print(f"Best head (lr={best_lr:.0e}, weight_decay={best_wd:.0e}, {best_acc:.2f}%) saved with backbone to {args.save_path}")
+    print(f"Continue with full fine-tuning via --init_weights {args.save_path} --head_epochs 0")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the classifier head (and sweep it) on cached backbone features.")
+    parser.add_argument('--arch', type=str, default='convnext', choices=sorted(ARCHITECTURES), help='Backbone architecture')
+    parser.add_argument('--data_root', type=str, default='chest_xray', help='Dataset root with train/ and val/')
+    parser.add_argument('--cache_dir', type=str, default='feature_cache', help='Where the feature arrays are stored')
+    parser.add_argument('--views', type=int, default=0, help='Extra fixed augmented views of the training set to cache')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute the cache even if it exists')
+    parser.add_argument('--head_epochs', type=int, default=30, help='Epochs per head training run')
+    parser.add_argument('--batch_size', type=int, default=64, help='Batch size for extraction and head training')
+    parser.add_argument('--num_workers', type=int, default=2, help='DataLoader workers for extraction')
+    parser.add_argument('--lrs', type=float, nargs='+', default=[1e-4], help='Learning rates to sweep')
+    parser.add_argument('--weight_decays', type=float, nargs='+', default=[0.01], help='Weight decays to sweep')
+    parser.add_argument('--label_smoothing', type=float, default=0.0, help='Label smoothing for the head loss')
+    parser.add_argument('--save_path', type=str, default='head_init.pth', help='Full model state_dict with the trained head')
+
+    args = parser.parse_args()
+    main(args)
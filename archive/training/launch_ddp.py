@@ -0,0 +1,48 @@
+import argparse
+import os
+import sys
+
+from torch.distributed import run as torchrun
+
+# --- Launcher for CPU data-parallel training ---
+# Thin wrapper around torchrun: picks a process count from the core count and
+# forwards everything after "--" to train.py, e.g.
+#   python launch_ddp.py --threads_per_rank 4 -- --arch convnext --pin_cores
+# Multi-node: run on every machine with the same --nnodes/--master_addr and its own --node_rank.
+
+def default_nproc(threads_per_rank):
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return max(1, cores // threads_per_rank)
+
+def build_command(args, train_args):
+    nproc = args.nproc or default_nproc(args.threads_per_rank)
+    command = [
+        f"--nnodes={args.nnodes}",
+        f"--nproc_per_node={nproc}",
+        f"--node_rank={args.node_rank}",
+        f"--master_addr={args.master_addr}",
+        f"--master_port={args.master_port}",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py'),
+    ]
+    if '--threads_per_rank' not in train_args:
+        train_args = train_args + ['--threads_per_rank', str(args.threads_per_rank)]
+    return command + train_args
+
+def main(args, train_args):
+    command = build_command(args, train_args)
+    print(f"torchrun {' '.join(command)}")
+    torchrun.main(command)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Launch train.py with DistributedDataParallel (gloo) on CPU nodes.")
+    parser.add_argument('--nproc', type=int, default=None, help='Processes on this node (default: cores / threads_per_rank)')
+    parser.add_argument('--threads_per_rank', type=int, default=4, help='Intra-op threads per process')
+    parser.add_argument('--nnodes', type=int, default=1, help='Number of machines')
+    parser.add_argument('--node_rank', type=int, default=0, help='Index of this machine')
+    parser.add_argument('--master_addr', type=str, default='127.0.0.1', help='Address of node 0')
+    parser.add_argument('--master_port', type=int, default=29500, help='Rendezvous port on node 0')
+
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    main(args, argv[split + 1:])
@@ -0,0 +1,189 @@
+import math
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision.models.convnext import CNBlock
+from torchvision.models.efficientnet import FusedMBConv, MBConv
+
+from train import (ARCHITECTURES, Engine, build_datasets, build_loader, build_parser, configure_stage, parse_args,
+                   print_throughput, resize_to_state_dict)
+
+# --- Structured channel pruning under a CPU latency budget ---
+# Only the hidden (expanded) width inside each residual block is pruned, so
+# block inputs/outputs and skip connections keep their shape:
+#   ConvNeXt CNBlock:   pwconv1 outputs / pwconv2 inputs (the 4x MLP width)
+#   EfficientNet MBConv: expand conv, depthwise conv, SE and project inputs
+#   FusedMBConv:        fused expand conv outputs / project inputs
+# Channels are sliced straight out of the state_dict and the model is rebuilt
+# with resize_to_state_dict, so the result is physically smaller and loads
+# through backend/models.py (and --init_weights) like any other checkpoint.
+
+CHANNEL_MULTIPLE = 8  # keep widths SIMD-friendly for the CPU kernels
+
+def keep_count(channels, ratio):
+    keep = int(math.ceil(channels * (1 - ratio) / CHANNEL_MULTIPLE)) * CHANNEL_MULTIPLE
+    return max(CHANNEL_MULTIPLE, min(channels, keep))
+
+def take(state, key, idx, dim=0):
+    state[key] = state[key].index_select(dim, idx)
+
+def top_channels(importance, ratio):
+    keep = keep_count(importance.numel(), ratio)
+    return torch.argsort(importance, descending=True)[:keep].sort().values
+
+def prune_convnext_block(state, prefix, ratio):
+    # block = [dwconv, Permute, LayerNorm, Linear(d, 4d), GELU, Linear(4d, d), Permute]
+    w1, w2 = state[f"{prefix}.block.3.weight"], state[f"{prefix}.block.5.weight"]
+    importance = w1.norm(dim=1) * w2.norm(dim=0)
+    idx = top_channels(importance, ratio)
+    take(state, f"{prefix}.block.3.weight", idx)
+    take(state, f"{prefix}.block.3.bias", idx)
+    take(state, f"{prefix}.block.5.weight", idx, dim=1)
+
+def bn_keys(prefix):
+    return [f"{prefix}.{name}" for name in ('weight', 'bias', 'running_mean', 'running_var')]
+
+def prune_mbconv(state, prefix, ratio):
+    # block = [expand (conv, bn, act), depthwise (conv, bn, act), SE (fc1, fc2), project (conv, bn)]
+    importance = state[f"{prefix}.block.0.1.weight"].abs() * state[f"{prefix}.block.1.1.weight"].abs()
+    idx = top_channels(importance, ratio)
+    take(state, f"{prefix}.block.0.0.weight", idx)
+    for key in bn_keys(f"{prefix}.block.0.1") + bn_keys(f"{prefix}.block.1.1"):
+        take(state, key, idx)
+    take(state, f"{prefix}.block.1.0.weight", idx)
+    take(state, f"{prefix}.block.2.fc1.weight", idx, dim=1)
+    take(state, f"{prefix}.block.2.fc2.weight", idx)
+    take(state, f"{prefix}.block.2.fc2.bias", idx)
+    take(state, f"{prefix}.block.3.0.weight", idx, dim=1)
+
+def prune_fused_mbconv(state, prefix, ratio):
+    # block = [fused expand (conv, bn, act), project (conv, bn)]; expand_ratio 1 blocks have no hidden width
+    if f"{prefix}.block.1.0.weight" not in state:
+        return
+    idx = top_channels(state[f"{prefix}.block.0.1.weight"].abs(), ratio)
+    take(state, f"{prefix}.block.0.0.weight", idx)
+    for key in bn_keys(f"{prefix}.block.0.1"):
+        take(state, key, idx)
+    take(state, f"{prefix}.block.1.0.weight", idx, dim=1)
+
+PRUNERS = {CNBlock: prune_convnext_block, MBConv: prune_mbconv, FusedMBConv: prune_fused_mbconv}
+
+def prune_model(model, ratio):
+    """Remove `ratio` of the hidden channels of every residual block (lowest importance first)."""
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    if ratio > 0:
+        for name, module in model.named_modules():
+            pruner = PRUNERS.get(type(module))
+            if pruner is not None:
+                pruner(state, name, ratio)
+    resize_to_state_dict(model, state)
+    model.load_state_dict(state)
+    return model
+
+# --- Measurement ---
+@torch.no_grad()
+def cpu_latency_ms(model, runs=30, warmup=5):
+    """Batch-1 eager CPU latency under no_grad, as served by INFERENCE_BACKEND=eager."""
+    model = model.to('cpu').eval()
+    x = torch.randn(1, 3, 224, 224)
+    for _ in range(warmup):
+        model(x)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model(x)
+        times.append(1000 * (time.perf_counter() - start))
+    return float(np.median(times))
+
+def num_params(model):
+    return sum(p.numel() for p in model.parameters())
+
+def pareto_front(rows):
+    """Indices of rows not dominated in (lower latency, higher accuracy)."""
+    front = []
+    for i, row in enumerate(rows):
+        dominated = any(other['latency_ms'] <= row['latency_ms'] and other['accuracy'] >= row['accuracy']
+                        and (other['latency_ms'] < row['latency_ms'] or other['accuracy'] > row['accuracy'])
+                        for other in rows)
+        if not dominated:
+            front.append(i)
+    return front
+
+# --- Main ---
+def main(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    train_dataset, val_dataset = build_datasets(args)
+    train_loader = build_loader(train_dataset, args, shuffle=True)
+    val_loader = build_loader(val_dataset, args, shuffle=False)
+    num_classes = len(train_dataset.class_to_idx)
+    criterion = nn.CrossEntropyLoss(label_smoothing=args.label_smoothing)
+    os.makedirs(args.out_dir, exist_ok=True)
+    print(f"Pruning {args.arch} from {args.init_weights} (CPU threads: {torch.get_num_threads()})")
+
+    rows = []
+    for ratio in sorted(set([0.0] + args.ratios)):
+        model = ARCHITECTURES[args.arch]['build'](num_classes, pretrained=False)
+        state_dict = torch.load(args.init_weights, map_location='cpu')
+        resize_to_state_dict(model, state_dict)
+        model.load_state_dict(state_dict)
+        prune_model(model, ratio)
+        latency = cpu_latency_ms(model, runs=args.latency_runs)
+
+        model = model.to(device)
+        engine = Engine(model, device, args, criterion)
+        correct, total = engine.validate(val_loader, f"ratio {ratio:.2f} [before fine-tune]")
+        pruned_accuracy = 100 * correct / max(1, total)
+        accuracy = pruned_accuracy
+        if ratio > 0 and args.full_epochs > 0:
+            optimizer, scheduler = configure_stage('full', model, args)
+            for epoch in range(args.full_epochs):
+                stats = engine.train_epoch(train_loader, optimizer, f"ratio {ratio:.2f} - Fine-tune {epoch+1}/{args.full_epochs}")
+                print_throughput(f"ratio {ratio:.2f} - Fine-tune {epoch+1}", stats)
+                if scheduler is not None:
+                    scheduler.step()
+            correct, total = engine.validate(val_loader, f"ratio {ratio:.2f} [after fine-tune]")
+            accuracy = 100 * correct / max(1, total)
+
+        path = os.path.join(args.out_dir, f"{args.arch}_pruned_{int(round(100 * ratio))}.pth")
+        torch.save(model.to('cpu').state_dict(), path)
+        rows.append({'ratio': ratio, 'params': num_params(model), 'latency_ms': latency,
+                     'pruned_accuracy': pruned_accuracy, 'accuracy': accuracy, 'path': path})
+        print(f"ratio {ratio:.2f}: {latency:.1f} ms, {accuracy:.2f}% -> {path}")
+
+    baseline = rows[0]
+    front = set(pareto_front(rows))
+    print(f"\n{args.arch} accuracy/latency (batch 1, CPU, eager; * = Pareto-optimal)")
+    print(f"{'ratio':>6}{'params (M)':>12}{'latency ms':>12}{'speed-up':>10}{'pruned acc':>12}{'fine-tuned':>12}")
+    for i, row in enumerate(rows):
+        print(f"{row['ratio']:>6.2f}{row['params'] / 1e6:>12.2f}{row['latency_ms']:>12.1f}"
+              f"{baseline['latency_ms'] / row['latency_ms']:>9.2f}x{row['pruned_accuracy']:>11.2f}%{row['accuracy']:>11.2f}%"
+              f"{' *' if i in front else ''}")
+
+    if args.latency_budget_ms:
+        within = [row for row in rows if row['latency_ms'] <= args.latency_budget_ms]
+        if within:
+            best = max(within, key=lambda row: row['accuracy'])
+        else:
+            best = min(rows, key=lambda row: row['latency_ms'])
+            print(f"\nWARNING: no ratio meets the {args.latency_budget_ms:.1f} ms budget; using the fastest candidate")
+        env = 'CONVNEXT_PATH' if args.arch == 'convnext' else 'EFFICIENTNET_PATH'
+        print(f"\nSelected ratio {best['ratio']:.2f} ({best['latency_ms']:.1f} ms, {best['accuracy']:.2f}%): {best['path']}")
+        print(f"Serve it with {env}={os.path.basename(best['path'])}")
+
+if __name__ == "__main__":
+    parser = build_parser()
+    parser.description = "Prune hidden channels of a trained member and fine-tune it briefly under a CPU latency budget."
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.25, 0.4, 0.5, 0.6], help='Fractions of hidden channels to remove')
+    parser.add_argument('--latency_budget_ms', type=float, default=None, help='Pick the most accurate ratio under this batch-1 CPU latency')
+    parser.add_argument('--latency_runs', type=int, default=30, help='Timed forwards per latency measurement')
+    parser.add_argument('--out_dir', type=str, default='pruned', help='Where the pruned checkpoints are written')
+    # Brief fine-tune: one full-model epoch per ratio unless overridden
+    parser.set_defaults(head_epochs=0, full_epochs=1)
+
+    args = parse_args(parser)
+    if not args.init_weights:
+        parser.error('--init_weights (the trained checkpoint to prune) is required')
+    main(args)
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+
+# --- Tensor transform pipelines for uint8 CHW shard images ---
+# Same augmentations as train_transform / preprocess_transform, minus the PIL round-trip
+shard_preprocess = transforms.Compose([
+    transforms.Resize((224, 224), antialias=True),
+    transforms.ConvertImageDtype(torch.float32),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+shard_train_transform = transforms.Compose([
+    transforms.RandomResizedCrop(224, scale=(0.8, 1.0), antialias=True),
+    transforms.RandomHorizontalFlip(),
+    transforms.RandomRotation(15),
+    transforms.ColorJitter(brightness=0.3, contrast=0.3),
+    transforms.ConvertImageDtype(torch.float32),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+# --- Dataset Class ---
+class ShardDataset(Dataset):
+    """Reads a split written by build_shards.py.
+
+    The memmap is opened lazily in each DataLoader worker and images are returned
+    as uint8 (3, H, W) views of the mapped file; nothing is decoded or copied
+    until the transform runs.
+    """
+
+    def __init__(self, shard_dir, transform=None):
+        with open(os.path.join(shard_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.shard_dir = shard_dir
+        self.shape = tuple(manifest['shape'])
+        self.class_to_idx = manifest['class_to_idx']
+        self.labels = torch.from_numpy(np.load(os.path.join(shard_dir, 'labels.npy')))
+        self.transform = transform
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            # Copy-on-write mapping: writable views for torch.from_numpy, file never modified
+            self._images = np.memmap(os.path.join(self.shard_dir, 'images.u8'), dtype=np.uint8, mode='c', shape=self.shape)
+        return self._images
+
+    def __getstate__(self):
+        # Don't pickle the mapping into DataLoader workers; each reopens it
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        image = torch.from_numpy(self.images[idx]).permute(2, 0, 1)
+        if self.transform:
+            image = self.transform(image)
+        return image, int(self.labels[idx])
+
+# --- Data-loading throughput comparison ---
+def measure(dataset, batch_size, num_workers, max_batches):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    seen = 0
+    start = time.perf_counter()
+    for batch_idx, (inputs, _) in enumerate(loader):
+        seen += inputs.shape[0]
+        if batch_idx + 1 >= max_batches:
+            break
+    return seen / (time.perf_counter() - start)
+
+def main(args):
+    from train import ImageTensorDataset, train_transform
+
+    jpeg_rate = measure(ImageTensorDataset(args.data_dir, transform=train_transform), args.batch_size, args.num_workers, args.batches)
+    shard_rate = measure(ShardDataset(args.shard_dir, transform=shard_train_transform), args.batch_size, args.num_workers, args.batches)
+    print(f"JPEG decode + PIL augment:  {jpeg_rate:8.1f} images/s")
+    print(f"Memmap shard + tensor aug:  {shard_rate:8.1f} images/s")
+    print(f"Speed-up: {shard_rate / jpeg_rate:.2f}x (num_workers={args.num_workers})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare data-loading throughput of JPEG folders vs memmap shards.")
+    parser.add_argument('--data_dir', type=str, default=os.path.join('chest_xray', 'train'), help='JPEG split directory')
+    parser.add_argument('--shard_dir', type=str, default=os.path.join('chest_xray_shards', 'train'), help='Shard split directory')
+    parser.add_argument('--batch_size', type=int, default=16, help='Batch size')
+    parser.add_argument('--num_workers', type=int, default=2, help='DataLoader workers')
+    parser.add_argument('--batches', type=int, default=50, help='Batches to time per pipeline')
+
+    args = parser.parse_args()
+    main(args)
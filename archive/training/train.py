@@ -0,0 +1,497 @@
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, Subset
+from torch.utils.data.distributed import DistributedSampler
+from torchvision.models import convnext_tiny, ConvNeXt_Tiny_Weights, efficientnet_v2_s, EfficientNet_V2_S_Weights
+from torch.optim.lr_scheduler import _LRScheduler, CosineAnnealingLR, CosineAnnealingWarmRestarts
+from torchvision import transforms
+import os
+import glob
+import time
+from tqdm import tqdm
+import argparse
+from PIL import Image
+
+# Unified training engine for both ensemble members.
+# train_convnext.py / train_efficientnet.py are thin wrappers that pick the
+# architecture; every recipe difference lives in ARCHITECTURES below.
+
+# --- Transformation Pipelines ---
+# For Validation & Testing (No Augmentation)
+preprocess_transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+# For Training (With Advanced Data Augmentation)
+train_transform = transforms.Compose([
+    transforms.RandomResizedCrop(224, scale=(0.8, 1.0)),
+    transforms.RandomHorizontalFlip(),
+    transforms.RandomRotation(15),
+    transforms.ColorJitter(brightness=0.3, contrast=0.3),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+# --- Dataset Class ---
+class ImageTensorDataset(Dataset):
+    def __init__(self, data_dir, transform=None):
+        class_names = sorted([d for d in os.listdir(data_dir)
+                              if os.path.isdir(os.path.join(data_dir, d)) and not d.startswith('.')])
+        self.class_to_idx = {cls: i for i, cls in enumerate(class_names)}
+        self.file_paths = []
+        for cls in class_names:
+            self.file_paths.extend(glob.glob(os.path.join(data_dir, cls, '*.jpeg')))
+            self.file_paths.extend(glob.glob(os.path.join(data_dir, cls, '*.jpg')))
+            self.file_paths.extend(glob.glob(os.path.join(data_dir, cls, '*.png')))
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def __getitem__(self, idx):
+        file_path = self.file_paths[idx]
+        image = Image.open(file_path).convert('RGB')
+        class_name = os.path.basename(os.path.dirname(file_path))
+        label = self.class_to_idx[class_name]
+        if self.transform:
+            image = self.transform(image)
+        return image, label
+
+# --- Custom Warmup Scheduler ---
+class WarmupCosineAnnealingLR(_LRScheduler):
+    def __init__(self, optimizer, warmup_epochs, total_epochs, last_epoch=-1):
+        self.warmup_epochs = warmup_epochs
+        self.total_epochs = total_epochs
+        self.cosine_scheduler = CosineAnnealingLR(optimizer, T_max=total_epochs - warmup_epochs, eta_min=1e-6)
+        super().__init__(optimizer, last_epoch)
+
+    def get_lr(self):
+        if self.last_epoch < self.warmup_epochs:
+            # Linear warmup
+            return [base_lr * (self.last_epoch + 1) / self.warmup_epochs for base_lr in self.base_lrs]
+        else:
+            return self.cosine_scheduler.get_lr()
+
+    def step(self, epoch=None):
+        if epoch is None:
+            epoch = self.last_epoch + 1
+        self.last_epoch = epoch
+        if epoch >= self.warmup_epochs:
+            self.cosine_scheduler.step(epoch - self.warmup_epochs)
+        super().step(epoch)
+
+# --- Pluggable Architectures ---
+def build_convnext(num_classes, pretrained=True):
+    model = convnext_tiny(weights=ConvNeXt_Tiny_Weights.IMAGENET1K_V1 if pretrained else None)
+    model.classifier[2] = nn.Linear(model.classifier[2].in_features, num_classes)
+    return model
+
+def build_efficientnet(num_classes, pretrained=True):
+    model = efficientnet_v2_s(weights=EfficientNet_V2_S_Weights.IMAGENET1K_V1 if pretrained else None)
+    model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
+    return model
+
+def resize_to_state_dict(model, state_dict):
+    """Shrink Conv2d / Linear / BatchNorm2d layers to the shapes in state_dict (channel-pruned checkpoints).
+
+    Same helper as backend/models.py, so prune.py output can be fine-tuned further via --init_weights.
+    """
+    for name, module in list(model.named_modules()):
+        weight = state_dict.get(f"{name}.weight")
+        if weight is None or not hasattr(module, 'weight') or weight.shape == module.weight.shape:
+            continue
+        if isinstance(module, nn.Conv2d):
+            depthwise = module.groups > 1 and module.groups == module.in_channels == module.out_channels
+            groups = weight.shape[0] if depthwise else module.groups
+            replacement = nn.Conv2d(weight.shape[1] * groups, weight.shape[0], module.kernel_size, module.stride,
+                                    module.padding, module.dilation, groups, module.bias is not None)
+        elif isinstance(module, nn.Linear):
+            replacement = nn.Linear(weight.shape[1], weight.shape[0], module.bias is not None)
+        elif isinstance(module, nn.BatchNorm2d):
+            replacement = nn.BatchNorm2d(weight.shape[0], module.eps, module.momentum)
+        else:
+            raise ValueError(f"Cannot resize {type(module).__name__} '{name}' to {tuple(weight.shape)}")
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(model.get_submodule(parent_name), child_name, replacement)
+    return model
+
+# Per-architecture recipe: model builder plus the defaults of the original scripts
+ARCHITECTURES = {
+    'convnext': {
+        'build': build_convnext,
+        'save_path': 'convnext_pneumonia_finetuned.pth',
+        'head_epochs': 5,            # Stage 1: classifier only
+        'full_epochs': 25,           # Stage 2: whole model, backbone at lr / 10
+        'batch_size': 16,
+        'learning_rate': 1e-4,
+        'weight_decay': 1e-5,
+        'label_smoothing': 0.0,
+        'body_lr_scale': 0.1,
+        'schedule': 'restarts',
+        'amp': False,
+    },
+    'efficientnet': {
+        'build': build_efficientnet,
+        'save_path': 'efficientnet_advanced.pth',
+        'head_epochs': 0,
+        'full_epochs': 50,
+        'batch_size': 10,
+        'learning_rate': 5e-5,
+        'weight_decay': 1e-5,
+        'label_smoothing': 0.1,
+        'body_lr_scale': 1.0,
+        'schedule': 'warmup_cosine',
+        'amp': True,
+    },
+}
+
+def configure_stage(stage, model, args):
+    """Set requires_grad and build the optimizer/scheduler for 'head' or 'full'."""
+    if stage == 'head':
+        # Freeze all layers, then unfreeze only the final classifier
+        for param in model.parameters():
+            param.requires_grad = False
+        for param in model.classifier.parameters():
+            param.requires_grad = True
+        optimizer = optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()), lr=args.learning_rate)
+        return optimizer, None
+
+    for param in model.parameters():
+        param.requires_grad = True
+    optimizer = optim.AdamW([
+        {'params': model.features.parameters(), 'lr': args.learning_rate * args.body_lr_scale},
+        {'params': model.classifier.parameters(), 'lr': args.learning_rate}
+    ], weight_decay=args.weight_decay)
+    if args.schedule == 'restarts':
+        scheduler = CosineAnnealingWarmRestarts(optimizer, T_0=10, T_mult=1, eta_min=1e-6)
+    else:
+        scheduler = WarmupCosineAnnealingLR(optimizer, warmup_epochs=min(5, args.full_epochs - 1), total_epochs=args.full_epochs)
+    return optimizer, scheduler
+
+# --- Data ---
+def build_datasets(args):
+    if args.shard_dir:
+        # Pre-decoded memmap shards from build_shards.py
+        from shard_dataset import ShardDataset, shard_preprocess, shard_train_transform
+        if args.batch_augment:
+            # Raw uint8 batches; augmentation runs on the whole batch on the device
+            return (ShardDataset(os.path.join(args.shard_dir, 'train')),
+                    ShardDataset(os.path.join(args.shard_dir, 'val')))
+        return (ShardDataset(os.path.join(args.shard_dir, 'train'), transform=shard_train_transform),
+                ShardDataset(os.path.join(args.shard_dir, 'val'), transform=shard_preprocess))
+    return (ImageTensorDataset(os.path.join(args.data_root, 'train'), transform=train_transform),
+            ImageTensorDataset(os.path.join(args.data_root, 'val'), transform=preprocess_transform))
+
+def build_loader(dataset, args, shuffle, sampler=None):
+    kwargs = {}
+    if args.num_workers > 0:
+        kwargs['persistent_workers'] = args.persistent_workers
+        kwargs['prefetch_factor'] = args.prefetch_factor
+    return DataLoader(dataset, batch_size=args.batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                      num_workers=args.num_workers, pin_memory=args.pin_memory, **kwargs)
+
+# --- Train / Validate Loops ---
+class Engine:
+    """Runs epochs for one model with optional AMP / channels_last and step timing."""
+
+    def __init__(self, model, device, args, criterion, train_batch_fn=None, val_batch_fn=None):
+        self.model = model
+        self.device = device
+        self.args = args
+        self.criterion = criterion
+        self.train_batch_fn = train_batch_fn or (lambda x: x)
+        self.val_batch_fn = val_batch_fn or (lambda x: x)
+        self.memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+        # fp16 autocast + GradScaler; like the original scripts, AMP only applies on CUDA
+        self.amp = args.amp and device.type == 'cuda'
+        self.amp_dtype = torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp)
+        self.show_progress = is_main_process()
+
+    def to_device(self, inputs, labels, batch_fn):
+        non_blocking = self.args.pin_memory and self.device.type == 'cuda'
+        inputs = inputs.to(self.device, non_blocking=non_blocking)
+        labels = labels.to(self.device, non_blocking=non_blocking)
+        inputs = batch_fn(inputs).contiguous(memory_format=self.memory_format)
+        return inputs, labels
+
+    def sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    def train_epoch(self, loader, optimizer, desc):
+        """One pass over loader. Returns timing stats for the epoch."""
+        self.model.train()
+        stats = {'images': 0, 'data_time': 0.0, 'compute_time': 0.0, 'loss': 0.0, 'steps': 0}
+        pbar = tqdm(loader, desc=desc, disable=not self.show_progress)
+        step_end = time.perf_counter()
+        for step, (inputs, labels) in enumerate(pbar):
+            data_ready = time.perf_counter()
+            inputs, labels = self.to_device(inputs, labels, self.train_batch_fn)
+
+            with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp):
+                outputs = self.model(inputs)
+                loss = self.criterion(outputs, labels)
+            optimizer.zero_grad(set_to_none=True)
+            self.scaler.scale(loss).backward()
+            self.scaler.step(optimizer)
+            self.scaler.update()
+            self.sync()
+
+            now = time.perf_counter()
+            stats['data_time'] += data_ready - step_end
+            stats['compute_time'] += now - data_ready
+            stats['images'] += inputs.shape[0]
+            stats['steps'] += 1
+            if step % self.args.log_interval == 0:
+                stats['loss'] = loss.item()
+                pbar.set_postfix(data_ms=f"{1000 * (data_ready - step_end):.0f}", compute_ms=f"{1000 * (now - data_ready):.0f}",
+                                 img_s=f"{inputs.shape[0] / max(now - step_end, 1e-9):.0f}", loss=f"{stats['loss']:.3f}")
+            step_end = now
+            if self.args.max_steps and stats['steps'] >= self.args.max_steps:
+                break
+        return stats
+
+    def validate(self, loader, desc):
+        """Returns (correct, total) on this process's share of the loader."""
+        self.model.eval()
+        correct = total = 0
+        with torch.no_grad():
+            for inputs, labels in tqdm(loader, desc=desc, disable=not self.show_progress):
+                inputs, labels = self.to_device(inputs, labels, self.val_batch_fn)
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp):
+                    outputs = self.model(inputs)
+                correct += (outputs.argmax(1) == labels).sum().item()
+                total += labels.shape[0]
+        return correct, total
+
+def print_throughput(prefix, stats):
+    wall = stats['data_time'] + stats['compute_time']
+    print(f"{prefix} throughput: {stats['images'] / max(wall, 1e-9):.1f} images/s | "
+          f"data wait {stats['data_time']:.1f}s ({100 * stats['data_time'] / max(wall, 1e-9):.0f}%) | "
+          f"compute {stats['compute_time']:.1f}s over {stats['steps']} steps")
+
+# --- Distributed (DDP) ---
+# Launched through torchrun / launch_ddp.py, which set RANK, WORLD_SIZE and LOCAL_RANK.
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+def pin_threads(args, local_rank, local_world_size):
+    """Give each local rank its own slice of cores and a matching intra-op thread count."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    per_rank = args.threads_per_rank or max(1, len(cores) // local_world_size)
+    if args.pin_cores and hasattr(os, 'sched_setaffinity'):
+        mine = cores[local_rank * per_rank:(local_rank + 1) * per_rank] or cores
+        os.sched_setaffinity(0, mine)
+    torch.set_num_threads(per_rank)
+    if local_world_size > 1 or args.threads_per_rank:
+        # A plain single-process run without --threads_per_rank keeps torch's inter-op defaults
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # already fixed once inter-op work has started
+    return per_rank
+
+def setup_distributed(args):
+    """Init the process group if launched with WORLD_SIZE > 1. Returns (rank, world_size, local_rank)."""
+    world_size = int(os.environ.get('WORLD_SIZE', '1'))
+    if world_size <= 1:
+        # Still honour --threads_per_rank / --pin_cores for a plain single-process run
+        threads = pin_threads(args, 0, 1)
+        print(f"[rank 0/1] {threads} threads, single process")
+        return 0, 1, 0
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', '0'))
+    threads = pin_threads(args, local_rank, int(os.environ.get('LOCAL_WORLD_SIZE', world_size)))
+    dist.init_process_group(backend=args.dist_backend)
+    print(f"[rank {rank}/{world_size}] {threads} threads, backend {args.dist_backend}")
+    return rank, world_size, local_rank
+
+def all_reduce_sum(values, device):
+    """Sum a list of numbers across ranks (no-op when not distributed)."""
+    if not dist.is_initialized():
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+# --- Checkpoint / Resume ---
+def save_checkpoint(path, model, optimizer, scheduler, scaler, stage_idx, epoch, best_val_accuracy):
+    tmp_path = path + '.tmp'
+    torch.save({
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict() if scheduler is not None else None,
+        'scaler': scaler.state_dict(),
+        'stage_idx': stage_idx,
+        'epoch': epoch,
+        'best_val_accuracy': best_val_accuracy,
+    }, tmp_path)
+    # Atomic replace so an interruption mid-write never corrupts the last good checkpoint
+    os.replace(tmp_path, path)
+
+# --- Main Training Function ---
+def main(args):
+    rank, world_size, local_rank = setup_distributed(args)
+    distributed = world_size > 1
+    if torch.cuda.is_available():
+        device = torch.device(f"cuda:{local_rank}" if distributed else "cuda")
+    else:
+        device = torch.device("cpu")
+    log = print if is_main_process() else (lambda *a, **k: None)
+    log(f"Using device: {device} (world size {world_size})")
+
+    train_dataset, val_dataset = build_datasets(args)
+    train_sampler = DistributedSampler(train_dataset, shuffle=True) if distributed else None
+    if distributed:
+        # Unpadded shards (DistributedSampler would repeat images to even them out), so the
+        # val counts summed across ranks below cover every image exactly once
+        val_dataset = Subset(val_dataset, range(rank, len(val_dataset), world_size))
+    train_loader = build_loader(train_dataset, args, shuffle=True, sampler=train_sampler)
+    val_loader = build_loader(val_dataset, args, shuffle=False)
+    log(f"Class mapping: {train_dataset.class_to_idx}")
+
+    train_batch_fn = val_batch_fn = None
+    if args.batch_augment:
+        from batch_augment import BatchAugment, BatchPreprocess
+        train_batch_fn = BatchAugment().to(device)
+        val_batch_fn = BatchPreprocess().to(device)
+
+    model = ARCHITECTURES[args.arch]['build'](len(train_dataset.class_to_idx))
+    if args.init_weights:
+        # e.g. a head trained on cached features by head_features.py
+        state_dict = torch.load(args.init_weights, map_location='cpu')
+        resize_to_state_dict(model, state_dict)  # no-op unless the checkpoint was pruned
+        model.load_state_dict(state_dict)
+        log(f"Initialized weights from {args.init_weights}")
+    model = model.to(device)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    criterion = nn.CrossEntropyLoss(label_smoothing=args.label_smoothing)
+    engine = Engine(model, device, args, criterion, train_batch_fn, val_batch_fn)
+
+    stages = [(name, epochs) for name, epochs in [('head', args.head_epochs), ('full', args.full_epochs)] if epochs > 0]
+    start_stage, start_epoch, best_val_accuracy = 0, 0, 0.0
+    resume_state = None
+    if args.resume and os.path.exists(args.checkpoint_path):
+        # Every rank loads the same file, so all replicas start identical
+        resume_state = torch.load(args.checkpoint_path, map_location='cpu')
+        model.load_state_dict(resume_state['model'])
+        start_stage, start_epoch = resume_state['stage_idx'], resume_state['epoch'] + 1
+        best_val_accuracy = resume_state['best_val_accuracy']
+        log(f"Resumed from {args.checkpoint_path}: stage {stages[start_stage][0]}, epoch {start_epoch + 1}")
+
+    for stage_idx, (stage, epochs) in enumerate(stages):
+        if stage_idx < start_stage:
+            continue
+        log(f"\n--- STAGE {stage_idx + 1}: {'Training the Classifier Head' if stage == 'head' else 'Fine-Tuning the Full Model'} ---")
+        optimizer, scheduler = configure_stage(stage, model, args)
+        if distributed:
+            # Re-wrap per stage: DDP only tracks parameters that require grad at construction
+            engine.model = DistributedDataParallel(model, device_ids=[local_rank] if device.type == 'cuda' else None)
+        first_epoch = 0
+        if resume_state is not None and stage_idx == start_stage:
+            optimizer.load_state_dict(resume_state['optimizer'])
+            if scheduler is not None and resume_state['scheduler'] is not None:
+                scheduler.load_state_dict(resume_state['scheduler'])
+            engine.scaler.load_state_dict(resume_state['scaler'])
+            first_epoch = start_epoch
+            resume_state = None
+
+        for epoch in range(first_epoch, epochs):
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+            stats = engine.train_epoch(train_loader, optimizer, f"Stage {stage_idx + 1} - Epoch {epoch+1}/{epochs} [{stage}]")
+            # Global images/s: images summed over ranks, time from the slowest rank
+            images, = all_reduce_sum([stats['images']], device)
+            stats['images'] = int(images)
+            wall_time = stats['data_time'] + stats['compute_time']
+            if distributed:
+                wall = torch.tensor([wall_time], device=device)
+                dist.all_reduce(wall, op=dist.ReduceOp.MAX)
+                wall_time = wall.item()
+            if is_main_process():
+                print_throughput(f"\nStage {stage_idx + 1} - Epoch {epoch+1}", stats)
+                if args.benchmark:
+                    print(f"[BENCH] world_size={world_size} images_per_sec={stats['images'] / max(wall_time, 1e-9):.2f}")
+            if args.benchmark:
+                break
+
+            correct, total = engine.validate(val_loader, f"Stage {stage_idx + 1} - Epoch {epoch+1}/{epochs} [Validation]")
+            correct, total = all_reduce_sum([correct, total], device)
+            val_accuracy = 100 * correct / max(1, total)
+            log(f"Stage {stage_idx + 1} - Epoch {epoch+1} Validation Accuracy: {val_accuracy:.2f}%")
+
+            if scheduler is not None:
+                scheduler.step()
+
+            # Only full-model epochs produce deployable checkpoints; rank 0 writes them
+            if stage == 'full' and val_accuracy > best_val_accuracy:
+                best_val_accuracy = val_accuracy
+                if is_main_process():
+                    torch.save(model.state_dict(), args.save_path)
+                    print(f"New best model saved to {args.save_path} with accuracy: {best_val_accuracy:.2f}%")
+
+            if args.checkpoint_path and is_main_process():
+                save_checkpoint(args.checkpoint_path, model, optimizer, scheduler, engine.scaler, stage_idx, epoch, best_val_accuracy)
+        if args.benchmark:
+            break
+
+    if distributed:
+        dist.barrier()
+        dist.destroy_process_group()
+
+def build_parser(default_arch=None):
+    parser = argparse.ArgumentParser(description="Fine-tune a Pneumonia Detection Model.")
+    parser.add_argument('--arch', type=str, default=default_arch, required=default_arch is None, choices=sorted(ARCHITECTURES))
+    parser.add_argument('--data_root', type=str, default='chest_xray', help='Dataset root with train/ and val/')
+    parser.add_argument('--save_path', type=str, default=None, help='Path to save the best model')
+    parser.add_argument('--head_epochs', type=int, default=None, help='Number of epochs to train the head (0 skips Stage 1)')
+    parser.add_argument('--full_epochs', '--epochs', dest='full_epochs', type=int, default=None, help='Number of epochs to fine-tune the full model')
+    parser.add_argument('--batch_size', type=int, default=None, help='Training batch size')
+    parser.add_argument('--learning_rate', type=float, default=None, help='Base learning rate for optimizer')
+    parser.add_argument('--weight_decay', type=float, default=None, help='Weight decay for the full-model AdamW optimizer')
+    parser.add_argument('--label_smoothing', type=float, default=None, help='Label smoothing for the loss')
+    parser.add_argument('--init_weights', type=str, default=None, help='State dict to start from (e.g. from head_features.py or prune.py)')
+    parser.add_argument('--shard_dir', type=str, default=None, help='Train from memmap shards built by build_shards.py')
+    parser.add_argument('--batch_augment', action='store_true', help='With --shard_dir: augment whole batches on the device (batch_augment.py)')
+    # Throughput options
+    parser.add_argument('--amp', action=argparse.BooleanOptionalAction, default=None, help='Mixed precision on CUDA (default on for efficientnet)')
+    parser.add_argument('--channels_last', action='store_true', help='Use channels_last memory format for model and inputs')
+    parser.add_argument('--num_workers', type=int, default=2, help='DataLoader worker processes')
+    parser.add_argument('--pin_memory', action='store_true', help='Pin host memory for faster host-to-GPU copies')
+    parser.add_argument('--persistent_workers', action='store_true', help='Keep DataLoader workers alive between epochs')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches prefetched per worker')
+    parser.add_argument('--log_interval', type=int, default=10, help='Steps between progress-bar timing updates')
+    parser.add_argument('--max_steps', type=int, default=0, help='Cap training steps per epoch (0 = full epoch)')
+    parser.add_argument('--benchmark', action='store_true', help='Train one capped epoch, print global images/s and exit')
+    # Distributed data parallel (see launch_ddp.py)
+    parser.add_argument('--dist_backend', type=str, default='gloo', help='torch.distributed backend (gloo for CPU nodes)')
+    parser.add_argument('--threads_per_rank', type=int, default=None, help='Intra-op threads per process (default: cores / local ranks)')
+    parser.add_argument('--pin_cores', action='store_true', help='Pin each local rank to its own slice of cores')
+    # Checkpoint / resume
+    parser.add_argument('--checkpoint_path', type=str, default=None, help='Write a resumable checkpoint here after every epoch')
+    parser.add_argument('--resume', action='store_true', help='Resume from --checkpoint_path if it exists')
+    return parser
+
+def parse_args(parser, argv=None):
+    """Parse and fill unset options from the architecture recipe."""
+    args = parser.parse_args(argv)
+    for key, value in ARCHITECTURES[args.arch].items():
+        if key != 'build' and getattr(args, key, None) is None:
+            setattr(args, key, value)
+    if args.batch_augment and not args.shard_dir:
+        parser.error('--batch_augment requires --shard_dir')
+    if args.resume and not args.checkpoint_path:
+        parser.error('--resume requires --checkpoint_path')
+    return args
+
+if __name__ == "__main__":
+    args = parse_args(build_parser())
+    main(args)
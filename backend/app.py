@@ -2,20 +2,29 @@
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from werkzeug.serving import WSGIRequestHandler
 import torch
-import torch.nn as nn
-from torchvision.models import convnext_tiny, efficientnet_v2_s
 from PIL import Image
 import base64
 import io
 import cv2
 import numpy as np
-from torchvision import transforms
 import os
-import traceback
+import threading
+import time
 
 # Import our Grad-CAM function
 from explain import get_grad_cam
+from dicom_io import DicomError, decode_dicom, is_dicom
+from embedding_index import EmbeddingCapture, combine, get_index
+from memory_stats import MEMORY, MemoryBudgetExceeded, fit_budget
+from models import (CLASS_NAMES, CONVNEXT_PATH, EFFICIENTNET_PATH, ENSEMBLE_CONFIG_PATH, INPUT_SIZE, RISK_THRESHOLD,
+                    TTA_VIEWS, ParallelMembers, build_convnext, build_efficientnet, build_student,
+                    load_ensemble_config, preprocess_transform, tta_batch)
+from scheduler import PRIORITY_DEFAULT, FairScheduler, SchedulerFull, classify
+from request_log import adopt_logger, get_logger, request_context, timed
+from registry import MODEL_VERSION, ModelRegistry, ModelVersion, available_versions, version_file
+from shadow import SHADOW_SAMPLE_RATE, SHADOW_VERSION, ShadowEvaluator
 import uuid
 
 # --- 1. Initialize Flask App ---
@@ -31,50 +40,172 @@ CORS(app, resources={
     }
 })
 print("[INFO] CORS enabled for all routes")
+# Request-path logs: JSON records through a non-blocking queue (see request_log.py)
+log = get_logger("app")
+adopt_logger("werkzeug")  # per-request access lines too, instead of a blocking stderr write
+
+# --- Runtime threads / workers / affinity (runtime_config.json from autotune.py) ---
+# Applied before any model work so the intra-op pool starts with the tuned size
+from autotune import apply_runtime_config, load_runtime_config
+RUNTIME_CONFIG_PATH = os.getenv("RUNTIME_CONFIG", "runtime_config.json")
+RUNTIME_CONFIG = apply_runtime_config(load_runtime_config(RUNTIME_CONFIG_PATH))
+if RUNTIME_CONFIG:
+    print(f"[INFO] Runtime config from {RUNTIME_CONFIG_PATH}: {RUNTIME_CONFIG.get('name', 'custom')}")
+# Max predict() calls running model work at once (0 = unlimited); extra requests wait in
+# per-priority-class queues, served fairly across clients (see scheduler.py)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", RUNTIME_CONFIG.get("inference_workers", 0)))
+SCHEDULER = FairScheduler(INFERENCE_WORKERS)
+PENDING = 0  # /predict and /similar requests being served; reported by /health for router.py
+PENDING_LOCK = threading.Lock()
+print(f"[INFO] torch threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}, "
+      f"inference workers: {INFERENCE_WORKERS or 'unlimited'}")
 
 # --- Global variables for the models and other settings ---
-MODEL_CONVNEXT = None
-MODEL_EFFICIENTNET = None
+# Ensemble models live in REGISTRY (one ModelVersion per loaded version, see registry.py)
+MODEL_FAST = None  # Distilled single-model student (optional "fast" tier)
 DEVICE = os.getenv("DEVICE", "cpu")
-CLASS_NAMES = ['BACTERIAL_PNEUMONIA', 'NORMAL', 'VIRAL_PNEUMONIA']
-CONVNEXT_WEIGHT = 0.4
-EFFICIENTNET_WEIGHT = 0.6
 DISABLE_CAM = os.getenv("DISABLE_CAM", "0") == "1"
+# "eager" runs the torchvision modules; "torchscript" serves the artifact from export_ensemble.py;
+# "onnx" runs both members with ONNX Runtime (see onnx_backend.py); "int8" serves the
+# quantized members written by quantize.py
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager").lower()
+ENSEMBLE_ARTIFACT = os.getenv("ENSEMBLE_ARTIFACT", "ensemble_frozen.pt")
+# Run the two member forwards concurrently (a traced fork sharing the one intra-op pool)
+PARALLEL_MEMBERS = os.getenv("PARALLEL_MEMBERS", "0") == "1"
+MEMBER_RUNNER = ParallelMembers() if PARALLEL_MEMBERS else None
+# Early-exit cascade: skip the second member when the first is confident enough
+# (pick the threshold with tune_cascade.py)
+CASCADE_MODE = os.getenv("CASCADE_MODE", "0") == "1"
+CASCADE_FIRST = os.getenv("CASCADE_FIRST", "efficientnet").lower()
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", "0.95"))
+if CASCADE_FIRST not in ("convnext", "efficientnet"):
+    raise ValueError(f"CASCADE_FIRST must be 'convnext' or 'efficientnet', got '{CASCADE_FIRST}'")
+# Warm-up forwards a new model version runs before it is swapped in
+MODEL_WARMUP_RUNS = int(os.getenv("MODEL_WARMUP_RUNS", "2"))
+# If set, the admin endpoints (model swaps, shadow control, /debug/memory, statistics resets)
+# require "Authorization: Bearer <token>"
+REGISTRY_ADMIN_TOKEN = os.getenv("REGISTRY_ADMIN_TOKEN", "")
+# Fast tier: checkpoint written by archive/training/distill.py; requests opt in with tier=fast
+FAST_TIER_MODEL = os.getenv("FAST_TIER_MODEL", "")
+FAST_TIER_ARCH = os.getenv("FAST_TIER_ARCH", "mobilenet_v3_large")
+TIERS = ("ensemble", "fast")
+# Test-time augmentation: views per request (1 = off); requests override with tta_views
+TTA_DEFAULT_VIEWS = int(os.getenv("TTA_VIEWS", "1"))
+# Similar-case retrieval (embedding_index.py): penultimate features are captured during the forward
+SIMILAR_CASES = os.getenv("SIMILAR_CASES", "0") == "1"
+# Opt-in: also append every served X-ray to the index so later queries can find it. Such rows
+# only carry the model's own "predicted_label"; "label" is kept for verified ground truth
+EMBEDDING_CAPTURE = os.getenv("EMBEDDING_CAPTURE", "0") == "1"
+SIMILAR_DEFAULT_K = int(os.getenv("SIMILAR_DEFAULT_K", "5"))
+SIMILAR_MAX_K = 50
+EMBEDDINGS = EmbeddingCapture()
 
-def load_models():
-    """Load both trained models from disk (idempotent)."""
-    global MODEL_CONVNEXT, MODEL_EFFICIENTNET
-    if MODEL_CONVNEXT is not None and MODEL_EFFICIENTNET is not None:
-        return
-    print("[INFO] Loading models...")
-    try:
+def load_version(name):
+    """Build every model of ensemble version `name` for the configured backend (see registry.py for the layout)."""
+    config_path = version_file(name, ENSEMBLE_CONFIG_PATH)
+    version = ModelVersion(name, load_ensemble_config(config_path))
+    version.cam_path = version_file(name, EFFICIENTNET_PATH)
+    config = version.config
+    if os.path.exists(config_path):
+        log.info("Ensemble config loaded", extra={"model_version": name, "path": config_path, **config})
+    if INFERENCE_BACKEND == "torchscript":
+        # Imported lazily so the eager path never touches the exporter
+        from export_ensemble import load_frozen_ensemble
+        artifact = version_file(name, ENSEMBLE_ARTIFACT)
+        version.ensemble, meta = load_frozen_ensemble(artifact, device=DEVICE)
+        stale = [key for key in ("convnext_weight", "efficientnet_weight", "convnext_temperature", "efficientnet_temperature")
+                 if meta.get(key, 1.0 if key.endswith("temperature") else None) != config[key]]
+        if stale:
+            log.warning("Frozen ensemble was exported with different settings; re-run export_ensemble.py",
+                        extra={"model_version": name, "stale": stale})
+        if CASCADE_MODE:
+            log.warning("CASCADE_MODE needs per-member models; the frozen ensemble always runs both")
+        log.info("Frozen ensemble loaded", extra={"model_version": name, "path": artifact})
+    elif INFERENCE_BACKEND == "onnx":
+        from onnx_backend import ONNX_CONVNEXT, ONNX_EFFICIENTNET, load_onnx_members
+        version.convnext, version.efficientnet = load_onnx_members(version_file(name, ONNX_CONVNEXT),
+                                                                   version_file(name, ONNX_EFFICIENTNET))
+        log.info("ONNX Runtime sessions created for ConvNeXt and EfficientNetV2", extra={"model_version": name})
+    elif INFERENCE_BACKEND == "int8":
+        from quantize import INT8_CONVNEXT, INT8_EFFICIENTNET, load_int8_members
+        version.convnext, version.efficientnet = load_int8_members(version_file(name, INT8_CONVNEXT),
+                                                                   version_file(name, INT8_EFFICIENTNET))
+        log.info("INT8 quantized ConvNeXt and EfficientNetV2 loaded", extra={"model_version": name})
+    elif INFERENCE_BACKEND == "eager":
         # --- Load ConvNeXt-Tiny ---
-        MODEL_CONVNEXT = convnext_tiny(weights=None)
-        num_ftrs1 = MODEL_CONVNEXT.classifier[2].in_features
-        MODEL_CONVNEXT.classifier[2] = nn.Linear(num_ftrs1, len(CLASS_NAMES))
-        MODEL_CONVNEXT.load_state_dict(torch.load('convnext_pneumonia.pth', map_location=torch.device('cpu'), weights_only=True))
-        MODEL_CONVNEXT = MODEL_CONVNEXT.to(DEVICE)
-        MODEL_CONVNEXT.eval()
-        print("  - ConvNeXt model loaded.")
+        version.convnext = build_convnext(version_file(name, CONVNEXT_PATH), DEVICE)
+        log.info("ConvNeXt model loaded", extra={"model_version": name})
 
         # --- Load EfficientNetV2-S ---
-        MODEL_EFFICIENTNET = efficientnet_v2_s(weights=None)
-        num_ftrs2 = MODEL_EFFICIENTNET.classifier[1].in_features
-        MODEL_EFFICIENTNET.classifier[1] = nn.Linear(num_ftrs2, len(CLASS_NAMES))
-        MODEL_EFFICIENTNET.load_state_dict(torch.load('efficientnet_pneumonia.pth', map_location=torch.device('cpu'), weights_only=True))
-        MODEL_EFFICIENTNET = MODEL_EFFICIENTNET.to(DEVICE)
-        MODEL_EFFICIENTNET.eval()
-        print("  - EfficientNetV2 model loaded.")
-        print("[INFO] All models loaded successfully.")
-    except Exception as e:
-        print("[ERROR] Failed to load models:", e)
-        traceback.print_exc()
+        version.efficientnet = build_efficientnet(version.cam_path, DEVICE)
+        version.cam = version.efficientnet
+        log.info("EfficientNetV2 model loaded", extra={"model_version": name})
+    else:
+        raise ValueError(f"Unknown INFERENCE_BACKEND '{INFERENCE_BACKEND}'")
+    if SIMILAR_CASES:
+        hooked = [EMBEDDINGS.attach("convnext", version.convnext), EMBEDDINGS.attach("efficientnet", version.efficientnet)]
+        if not all(hooked):
+            log.warning("SIMILAR_CASES needs eager member modules; no embeddings for this backend",
+                        extra={"backend": INFERENCE_BACKEND})
+    return version
+
+def warm_up(version):
+    """Run a few forwards so the first real request on a new version pays no first-call costs."""
+    example = torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE, device=DEVICE)
+    for _ in range(MODEL_WARMUP_RUNS):
+        ensemble_probs(example, version)
+
+REGISTRY = ModelRegistry(load_version, warm_up)
+
+def load_candidate(name):
+    """A warmed version for shadow evaluation; not added to the registry cache."""
+    version = load_version(name)
+    warm_up(version)
+    return version
+
+def shadow_forward(version, batch):
+    """Candidate probabilities, in the shadow process (which has no member executors of its own in use)."""
+    return ensemble_probs(batch, version, runner=None)[0]
+
+# The candidate is loaded and run in separate processes (see shadow.py); both functions are sent there
+SHADOW = ShadowEvaluator(load_candidate, shadow_forward, CLASS_NAMES)
+
+def models_ready():
+    """True once a model version is serving predictions."""
+    return REGISTRY.current() is not None
+
+def load_models():
+    """Load the startup model version (MODEL_VERSION) for the configured backend (idempotent)."""
+    global MODEL_FAST
+    if models_ready():
+        return
+    log.info("Loading models", extra={"backend": INFERENCE_BACKEND, "model_version": MODEL_VERSION})
+    start = time.perf_counter()
+    try:
+        REGISTRY.activate(MODEL_VERSION)
+        if SHADOW_VERSION:
+            SHADOW.start(SHADOW_VERSION, SHADOW_SAMPLE_RATE)
+        if FAST_TIER_MODEL and MODEL_FAST is None:
+            MODEL_FAST = build_student(FAST_TIER_MODEL, DEVICE, FAST_TIER_ARCH)
+            log.info("Fast tier student loaded", extra={"arch": FAST_TIER_ARCH, "path": FAST_TIER_MODEL})
+        log.info("All models loaded", extra={"seconds": round(time.perf_counter() - start, 2)})
+    except Exception:
+        log.error("Failed to load models", exc_info=True)
         raise
 
+def get_cam_model(version):
+    """Eager EfficientNet of `version` used for Grad-CAM; loaded on first use for non-eager backends."""
+    if version.cam is None:
+        with version.cam_lock:
+            if version.cam is None:
+                log.info("Loading eager EfficientNetV2 for Grad-CAM", extra={"model_version": version.name})
+                version.cam = build_efficientnet(version.cam_path, DEVICE)
+    return version.cam
+
 # --- NEW: Define Risk Level Logic ---
-def get_risk_level(predicted_class, confidence_score):
+def get_risk_level(predicted_class, confidence_score, risk_threshold=RISK_THRESHOLD):
     """Determines a risk level based on the prediction and confidence."""
-    if confidence_score < 70.0:
+    if confidence_score < risk_threshold:
         return "Indeterminate (Low Confidence)"
     
     if predicted_class == 'NORMAL':
@@ -86,50 +217,158 @@ def get_risk_level(predicted_class, confidence_score):
     else:
         return "Unknown"
 
+def ensemble_probs(input_tensor, version, cascade=CASCADE_MODE, runner=MEMBER_RUNNER):
+    """Class probabilities of model version `version` for a preprocessed batch.
+
+    Returns: (probs [N, C], inference path) where the path is "ensemble" or
+    "cascade:<member>" when the cascade exited after the first member.
+    """
+    config = version.config
+    with torch.no_grad():
+        if version.ensemble is not None:
+            # Frozen graph already contains both members and the weighted fusion
+            return version.ensemble(input_tensor), "ensemble"
+
+        if cascade:
+            first, second = version.efficientnet, version.convnext
+            first_temperature, second_temperature = config["efficientnet_temperature"], config["convnext_temperature"]
+            if CASCADE_FIRST == "convnext":
+                first, second = second, first
+                first_temperature, second_temperature = second_temperature, first_temperature
+            first_probs = torch.nn.functional.softmax(first(input_tensor) / first_temperature, dim=1)
+            # A batch here is the TTA views of one image, so exit on the view-averaged confidence
+            if first_probs.mean(0).max().item() >= CASCADE_THRESHOLD:
+                return first_probs, f"cascade:{CASCADE_FIRST}"
+            second_probs = torch.nn.functional.softmax(second(input_tensor) / second_temperature, dim=1)
+            if CASCADE_FIRST == "convnext":
+                probs1, probs2 = first_probs, second_probs
+            else:
+                probs1, probs2 = second_probs, first_probs
+        else:
+            if runner is not None:
+                outputs1, outputs2 = runner.run(version.convnext, version.efficientnet, input_tensor)
+            else:
+                outputs1 = version.convnext(input_tensor)
+                outputs2 = version.efficientnet(input_tensor)
+            probs1 = torch.nn.functional.softmax(outputs1 / config["convnext_temperature"], dim=1)
+            probs2 = torch.nn.functional.softmax(outputs2 / config["efficientnet_temperature"], dim=1)
+        return (config["convnext_weight"] * probs1) + (config["efficientnet_weight"] * probs2), "ensemble"
+
 # --- 2. Define the Ensemble Prediction Function ---
-def predict(image_bytes, disable_cam_override=False):
-    """Takes image bytes, returns prediction, confidence, risk level, and (optional) Grad-CAM."""
-    try:
-        if MODEL_CONVNEXT is None or MODEL_EFFICIENTNET is None:
-            load_models()
-
-        transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        input_tensor = transform(image).unsqueeze(0).to(DEVICE)
-
-        with torch.no_grad():
-            outputs1 = MODEL_CONVNEXT(input_tensor)
-            probs1 = torch.nn.functional.softmax(outputs1, dim=1)
-            outputs2 = MODEL_EFFICIENTNET(input_tensor)
-            probs2 = torch.nn.functional.softmax(outputs2, dim=1)
-            avg_probs = (CONVNEXT_WEIGHT * probs1) + (EFFICIENTNET_WEIGHT * probs2)
+def predict(image_bytes, disable_cam_override=False, tier="ensemble", tta_views=1, similar_k=0, request_id=None,
+            priority=PRIORITY_DEFAULT, client="anonymous", weight=1.0):
+    """Takes image bytes, returns prediction, confidence, risk level, (optional) Grad-CAM, inference path,
+    the model version that served it and the similar cases (None unless similar_k > 0).
+
+    tier="fast" serves the distilled student alone (and runs Grad-CAM on it).
+    tta_views > 1 stacks that many augmented views into one batched forward per
+    model and averages their probabilities before the risk decision.
+    similar_k > 0 (SIMILAR_CASES=1) returns the k nearest indexed X-rays by the
+    embedding captured during the same forward; reference cases carry their
+    verified "label", captured requests only the model's "predicted_label".
+    priority / client / weight place the request in SCHEDULER's queues (see
+    scheduler.classify); its cost there is tta_views forward passes.
+    """
+    with request_context(request_id) as timings, SCHEDULER.slot(priority, client, weight, cost=tta_views) as queue_ms:
+        timings["queue"] = round(queue_ms, 2)
+        try:
+            if not models_ready():
+                load_models()
+            if tier == "fast" and MODEL_FAST is None:
+                raise ValueError("Fast tier is not enabled (set FAST_TIER_MODEL)")
+            # Pinned for the whole request, so a hot swap never mixes two versions
+            version = REGISTRY.current()
+
+            dicom = is_dicom(image_bytes)
+            with timed("decode"), MEMORY.stage("decode"):
+                if dicom:
+                    # Budget-checked on the header, then windowed and downsampled straight to model resolution
+                    image = decode_dicom(image_bytes, views=tta_views)
+                else:
+                    # Only the header is read until convert(); the budget check may decode at reduced size
+                    image = fit_budget(Image.open(io.BytesIO(image_bytes)), tta_views).convert('RGB')
+            with timed("preprocess"), MEMORY.stage("preprocess"):
+                input_tensor = preprocess_transform(image).unsqueeze(0).to(DEVICE)
+                if tta_views > 1:
+                    input_tensor = tta_batch(input_tensor, tta_views)
+
+            forward_start = time.perf_counter()
+            with timed("forward"), MEMORY.stage("forward"):
+                if tier == "fast":
+                    with torch.no_grad():
+                        avg_probs = torch.nn.functional.softmax(MODEL_FAST(input_tensor), dim=1)
+                    inference_path = f"fast:{FAST_TIER_ARCH}"
+                else:
+                    embed = SIMILAR_CASES and (similar_k > 0 or EMBEDDING_CAPTURE)
+                    if embed:
+                        EMBEDDINGS.expect(input_tensor)
+                    try:
+                        # A cascade exit leaves one member without features, so searches run both
+                        # The traced member graph does not fire the capture hooks, so embedding requests run eagerly
+                        avg_probs, inference_path = ensemble_probs(input_tensor, version, cascade=CASCADE_MODE and not similar_k,
+                                                                   runner=None if embed else MEMBER_RUNNER)
+                    finally:
+                        features = EMBEDDINGS.collect(input_tensor) if embed else {}
+            forward_ms = 1000 * (time.perf_counter() - forward_start)
+            if tta_views > 1:
+                avg_probs = avg_probs.mean(0, keepdim=True)
+                inference_path += f"+tta{tta_views}"
             confidence, predicted_idx = torch.max(avg_probs, 1)
 
-        predicted_class = CLASS_NAMES[predicted_idx.item()]
-        confidence_score = confidence.item() * 100
+            predicted_class = CLASS_NAMES[predicted_idx.item()]
+            confidence_score = confidence.item() * 100
         
-        # --- Call the new risk level function ---
-        risk_level = get_risk_level(predicted_class, confidence_score)
+            # --- Call the new risk level function ---
+            risk_level = get_risk_level(predicted_class, confidence_score, version.config["risk_threshold"])
 
-        gradcam_overlay = None
-        if not DISABLE_CAM and not disable_cam_override:
-            try:
-                target_layer_efficientnet = MODEL_EFFICIENTNET.features[-1]
-                gradcam_overlay = get_grad_cam(MODEL_EFFICIENTNET, image_bytes, target_layer_efficientnet)
-            except Exception as cam_err:
-                print(f"[PREDICT] WARN: Grad-CAM generation failed: {cam_err}")
-                traceback.print_exc()
-                gradcam_overlay = None
-
-        return predicted_class, confidence_score, risk_level, gradcam_overlay
-    except Exception as e:
-        print(f"[PREDICT] ERROR in predict function: {e}")
-        traceback.print_exc()
-        raise
+            gradcam_overlay = None
+            if not DISABLE_CAM and not disable_cam_override:
+                try:
+                    cam_model = MODEL_FAST if tier == "fast" else get_cam_model(version)
+                    target_layer = cam_model.features[-1]
+                    with timed("gradcam"), MEMORY.stage("gradcam"):
+                        # The already decoded (budget-checked) image; image_bytes are not decoded again
+                        gradcam_overlay = get_grad_cam(cam_model, image_bytes, target_layer, image=image)
+                except Exception:
+                    log.warning("Grad-CAM generation failed", exc_info=True)
+                    gradcam_overlay = None
+
+            similar_cases = None
+            if tier != "fast" and features:
+                with timed("similar"), MEMORY.stage("similar"):
+                    similar_cases = find_similar(version, features, similar_k, {
+                        "id": request_id or uuid.uuid4().hex[:8], "source": "query",
+                        "predicted_label": predicted_class, "confidence": round(confidence_score, 2)})
+
+            if tier != "fast":
+                # Mirrors a sample to the shadow candidate; never blocks (a full queue drops it)
+                SHADOW.offer(input_tensor, avg_probs[0], forward_ms)
+
+            model_version = f"fast:{FAST_TIER_MODEL}" if tier == "fast" else version.name
+            log.info("Prediction served", extra={
+                "prediction": predicted_class, "confidence": round(confidence_score, 2), "risk_level": risk_level,
+                "inference_path": inference_path, "model_version": model_version, "priority": priority,
+                "dicom": dicom, "timings_ms": dict(timings), "sample": True})
+            return predicted_class, confidence_score, risk_level, gradcam_overlay, inference_path, model_version, similar_cases
+        except Exception as e:
+            log.error("Prediction failed", extra={"error": str(e), "timings_ms": dict(timings)})
+            raise
+
+def find_similar(version, features, k, meta):
+    """Search for (k > 0) and index (EMBEDDING_CAPTURE) one request's embedding; returns the matches or None."""
+    try:
+        embedding = combine(features)
+        if embedding is None:
+            return [] if k else None
+        index = get_index(version.name)
+        # Searched before the append so a query never finds itself
+        matches = index.search(embedding, k) if k else None
+        if EMBEDDING_CAPTURE:
+            index.add(embedding[None], [meta])
+        return matches
+    except Exception:
+        log.warning("Similar-case lookup failed", exc_info=True)
+        return [] if k else None
 
 # --- 3. Define the API Endpoints ---
 
@@ -141,76 +380,269 @@ def home():
         "status": "running",
         "endpoints": {
             "/health": "GET - Health check",
-            "/predict": "POST - Predict pneumonia from X-ray image"
+            "/debug/memory": "GET - Per-stage memory peaks and request budget (admin)",
+            "/debug/memory/reset": "POST - Clear the memory statistics (admin)",
+            "/debug/queues": "GET - Priority class queues, running requests and queue waits",
+            "/debug/queues/reset": "POST - Clear the queue statistics (admin)",
+            "/models": "GET - Serving, cached and available model versions",
+            "/models/activate": "POST - Load, warm up and swap in a model version",
+            "/models/rollback": "POST - Swap back to the previously served version",
+            "/shadow": "GET - Candidate vs production agreement / POST - start or stop shadowing a version (admin)",
+            "/shadow/reset": "POST - Clear the shadow statistics (admin)",
+            "/predict": "POST - Predict pneumonia from X-ray image",
+            "/similar": "POST - Prediction plus the most similar indexed X-rays (SIMILAR_CASES=1)"
         }
     }), 200
 
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint."""
-    status = (MODEL_CONVNEXT is not None) and (MODEL_EFFICIENTNET is not None)
-    return jsonify({"status": "ok" if status else "loading"}), 200
+    status = models_ready()
+    version = REGISTRY.current()
+    return jsonify({"status": "ok" if status else "loading", "fast_tier": MODEL_FAST is not None,
+                    "model_version": version.name if version else None, "pending": PENDING}), 200
+
+def admin_authorized(headers=None):
+    """True if the request (Flask's current one unless `headers` is given) may use the admin endpoints."""
+    headers = request.headers if headers is None else headers
+    return not REGISTRY_ADMIN_TOKEN or headers.get("Authorization", "") == f"Bearer {REGISTRY_ADMIN_TOKEN}"
+
+@app.route("/debug/memory", methods=["GET"])
+def debug_memory():
+    """Per-stage memory peaks (MEMORY_PROFILE=1), process RSS and the request budget (admin only: shows source paths)."""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(MEMORY.snapshot()), 200
+
+@app.route("/debug/memory/reset", methods=["POST"])
+def debug_memory_reset():
+    """Clear the per-stage memory statistics."""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    MEMORY.reset()
+    return jsonify({"status": "reset"}), 200
+
+@app.route("/debug/queues", methods=["GET"])
+def debug_queues():
+    """Queued / running requests and queue-wait percentiles per priority class."""
+    return jsonify(SCHEDULER.snapshot()), 200
+
+@app.route("/debug/queues/reset", methods=["POST"])
+def debug_queues_reset():
+    """Clear the queue-wait statistics and served / rejected counts."""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    SCHEDULER.reset()
+    return jsonify({"status": "reset"}), 200
+
+@app.route("/models", methods=["GET"])
+def list_models():
+    """Serving version, the warm LRU cache and the versions found under MODEL_REGISTRY_DIR."""
+    return jsonify(REGISTRY.status()), 200
+
+@app.route("/models/activate", methods=["POST"])
+def activate_model():
+    """Swap in a model version: instantly if cached, otherwise after a background load and warm-up."""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    body = request.get_json(silent=True) or {}
+    name = str(body.get("version", request.form.get("version", "")))
+    payload, status = activate_version(name, str(body.get("wait", "false")).lower() == "true")
+    return jsonify(payload), status
+
+@app.route("/models/rollback", methods=["POST"])
+def rollback_model():
+    """Swap back to the most recently served cached version."""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    payload, status = rollback_version()
+    return jsonify(payload), status
+
+# --- Admin helpers (shared with the ASGI server in asgi_app.py): (JSON payload, status) ---
+def activate_version(name, wait=False):
+    """Swap in version `name`: at once if cached or `wait`, else after a background load (202)."""
+    if name not in available_versions():
+        return {"error": f"Unknown model version '{name}'", "available": available_versions()}, 404
+    if REGISTRY.is_cached(name) or wait:
+        try:
+            REGISTRY.activate(name)
+        except Exception as e:
+            log.error("Failed to activate model version", exc_info=True, extra={"model_version": name})
+            return {"error": f"Failed to load '{name}': {e}"}, 500
+        return {"status": "active", "model_version": name}, 200
+    started = REGISTRY.activate_async(name)
+    return {"status": "loading" if started else "already loading", "model_version": name}, 202
+
+def rollback_version():
+    try:
+        version = REGISTRY.rollback()
+    except KeyError as e:
+        return {"error": str(e.args[0])}, 409
+    return {"status": "active", "model_version": version.name}, 200
+
+def control_shadow(body):
+    """{"version": name, "sample_rate": 0.1} starts shadowing a version; {"version": null} stops."""
+    name = body.get("version")
+    if not name:
+        SHADOW.stop()
+        return {"status": "off"}, 200
+    if name not in available_versions():
+        return {"error": f"Unknown model version '{name}'", "available": available_versions()}, 404
+    try:
+        SHADOW.start(str(name), float(body.get("sample_rate", SHADOW_SAMPLE_RATE)))
+    except (TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+    return {"status": "loading", "candidate": name}, 202
+
+# --- /predict helpers (shared with the ASGI server in asgi_app.py) ---
+def validate_options(tier, tta_views, similar_k=0):
+    """Normalized (tier, tta_views, similar_k) of a request; ValueError carries the message for a 400."""
+    if tier not in TIERS:
+        raise ValueError(f"Unknown tier '{tier}', expected one of {list(TIERS)}")
+    if tier == "fast" and not FAST_TIER_MODEL:
+        raise ValueError("Fast tier is not enabled on this server")
+    try:
+        tta_views = int(tta_views)
+    except (TypeError, ValueError):
+        raise ValueError(f"tta_views must be an integer, got '{tta_views}'")
+    if not 1 <= tta_views <= len(TTA_VIEWS):
+        raise ValueError(f"tta_views must be between 1 and {len(TTA_VIEWS)}")
+    try:
+        similar_k = int(similar_k)
+    except (TypeError, ValueError):
+        raise ValueError(f"similar_k must be an integer, got '{similar_k}'")
+    if not 0 <= similar_k <= SIMILAR_MAX_K:
+        raise ValueError(f"similar_k must be between 0 and {SIMILAR_MAX_K}")
+    if similar_k and not SIMILAR_CASES:
+        raise ValueError("Similar-case search is not enabled on this server")
+    if similar_k and tier == "fast":
+        raise ValueError("Similar-case search needs the ensemble tier")
+    return tier, tta_views, similar_k
+
+def format_response(result, req_id):
+    """JSON body of a successful /predict from the predict() result (Grad-CAM as a base64 PNG)."""
+    predicted_class, confidence, risk_level, gradcam_overlay, inference_path, model_version, similar_cases = result
+    gradcam_base64 = None
+    if gradcam_overlay is not None:
+        try:
+            with timed("encode"), MEMORY.stage("encode"):
+                _, buffer = cv2.imencode('.png', cv2.cvtColor(gradcam_overlay, cv2.COLOR_RGB2BGR))
+                gradcam_base64 = base64.b64encode(buffer).decode('utf-8')
+        except Exception:
+            log.warning("Failed to encode Grad-CAM image", exc_info=True, extra={"req_id": req_id})
+
+    # Format prediction text by removing underscores
+    formatted_prediction = predicted_class.replace("_", " ")
+
+    resp = {
+        "prediction": formatted_prediction,
+        "confidence": f"{confidence:.2f}%",
+        # --- Add the new risk_level to the response ---
+        "risk_level": risk_level,
+        "gradcam_image": gradcam_base64,
+        "inference_path": inference_path,
+        "model_version": model_version
+    }
+    if similar_cases is not None:
+        resp["similar_cases"] = similar_cases
+    return resp
+
+@app.route("/shadow", methods=["GET"])
+def shadow_report():
+    """Agreement, confidence deltas and latency of the shadow candidate against production."""
+    return jsonify(SHADOW.snapshot()), 200
+
+@app.route("/shadow/reset", methods=["POST"])
+def shadow_reset():
+    """Clear the agreement and latency statistics (e.g. before judging a new candidate)."""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    SHADOW.reset()
+    return jsonify({"status": "reset"}), 200
+
+@app.route("/shadow", methods=["POST"])
+def shadow_control():
+    """{"version": name, "sample_rate": 0.1} starts shadowing a version; {"version": null} stops."""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    payload, status = control_shadow(request.get_json(silent=True) or {})
+    return jsonify(payload), status
 
 @app.route("/predict", methods=["POST"])
-def handle_prediction():
+def handle_prediction(default_similar_k=0):
+    global PENDING
     req_id = uuid.uuid4().hex[:8]
-    try:
-        # Check if request contains base64 data (for CORS proxy compatibility)
-        if request.is_json and 'file_data' in request.json:
-            # Handle base64 encoded file data
-            file_data = request.json.get('file_data')
-            if not file_data:
-                return jsonify({"error": "No file_data provided in JSON request"}), 400
+    with request_context(req_id):
+        try:
+            # Check if request contains base64 data (for CORS proxy compatibility)
+            if request.is_json and 'file_data' in request.json:
+                # Handle base64 encoded file data
+                file_data = request.json.get('file_data')
+                if not file_data:
+                    return jsonify({"error": "No file_data provided in JSON request"}), 400
             
-            try:
-                # Decode base64 to bytes
-                image_bytes = base64.b64decode(file_data)
-            except Exception as e:
-                return jsonify({"error": f"Invalid base64 data: {str(e)}"}), 400
+                try:
+                    # Decode base64 to bytes
+                    image_bytes = base64.b64decode(file_data)
+                except Exception as e:
+                    return jsonify({"error": f"Invalid base64 data: {str(e)}"}), 400
                 
-            disable_cam_request = request.json.get('disable_cam', 'false') == 'true'
+                disable_cam_request = request.json.get('disable_cam', 'false') == 'true'
+                tier = str(request.json.get('tier', 'ensemble')).lower()
+                tta_views = request.json.get('tta_views', TTA_DEFAULT_VIEWS)
+                similar_k = request.json.get('similar_k', default_similar_k)
             
-        else:
-            # Handle traditional file upload
-            if 'file' not in request.files:
-                return jsonify({"error": "No file part in the request"}), 400
-            file = request.files['file']
-            if file.filename == '':
-                return jsonify({"error": "No file selected for uploading"}), 400
-
-            image_bytes = file.read()
-            disable_cam_request = request.form.get('disable_cam', 'false').lower() == 'true'
-        
-        # --- Get the new risk_level from the predict function ---
-        predicted_class, confidence, risk_level, gradcam_overlay = predict(image_bytes, disable_cam_request)
+            else:
+                # Handle traditional file upload
+                if 'file' not in request.files:
+                    return jsonify({"error": "No file part in the request"}), 400
+                file = request.files['file']
+                if file.filename == '':
+                    return jsonify({"error": "No file selected for uploading"}), 400
 
-        gradcam_base64 = None
-        if gradcam_overlay is not None:
-            try:
-                _, buffer = cv2.imencode('.png', cv2.cvtColor(gradcam_overlay, cv2.COLOR_RGB2BGR))
-                gradcam_base64 = base64.b64encode(buffer).decode('utf-8')
-            except Exception as e:
-                print(f"[REQ {req_id}] WARN: Failed to encode Grad-CAM image: {e}")
-                traceback.print_exc()
+                image_bytes = file.read()
+                disable_cam_request = request.form.get('disable_cam', 'false').lower() == 'true'
+                tier = request.form.get('tier', 'ensemble').lower()
+                tta_views = request.form.get('tta_views', TTA_DEFAULT_VIEWS)
+                similar_k = request.form.get('similar_k', default_similar_k)
 
-        # Format prediction text by removing underscores
-        formatted_prediction = predicted_class.replace("_", " ")
+            try:
+                tier, tta_views, similar_k = validate_options(tier, tta_views, similar_k)
+                priority, client, weight = classify(request.headers, request.remote_addr)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
         
-        resp = {
-            "prediction": formatted_prediction,
-            "confidence": f"{confidence:.2f}%",
-            # --- Add the new risk_level to the response ---
-            "risk_level": risk_level,
-            "gradcam_image": gradcam_base64
-        }
-        return jsonify(resp), 200
-    except Exception as e:
-        print(f"[REQ {req_id}] ERROR: Unhandled exception in /predict: {e}")
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+            # --- Get the new risk_level from the predict function ---
+            with PENDING_LOCK:
+                PENDING += 1
+            try:
+                result = predict(image_bytes, disable_cam_request, tier, tta_views, similar_k, req_id, priority, client, weight)
+            finally:
+                with PENDING_LOCK:
+                    PENDING -= 1
+            return jsonify(format_response(result, req_id)), 200
+        except SchedulerFull as e:
+            log.warning("Request rejected", extra={"status": 503, "error": str(e)})
+            return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+        except MemoryBudgetExceeded as e:
+            log.warning("Request rejected", extra={"status": 413, "error": str(e)})
+            return jsonify({"error": str(e)}), 413
+        except DicomError as e:
+            log.warning("Request rejected", extra={"status": 400, "error": str(e)})
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            log.error("Unhandled exception in /predict", exc_info=True)
+            return jsonify({"error": str(e)}), 500
+
+@app.route("/similar", methods=["POST"])
+def handle_similar():
+    """Same inputs and response as /predict, with similar_k defaulting to SIMILAR_DEFAULT_K."""
+    return handle_prediction(default_similar_k=SIMILAR_DEFAULT_K)
 
 # --- 4. Run the App ---
 if __name__ == "__main__":
     load_models()
     port = int(os.getenv("PORT", 5000))
+    # HTTP/1.1 keeps connections open between requests (nginx upstream keepalive, router.py's pool)
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(debug=False, use_reloader=False, host='0.0.0.0', port=port, threaded=True)
\ No newline at end of file
@@ -0,0 +1,303 @@
+# asgi_app.py
+"""ASGI serving mode: the HTTP contract of app.py on an event loop.
+
+Request and response bodies are read and written asynchronously by uvicorn,
+so an idle keep-alive connection or a slow upload costs a socket and a small
+coroutine instead of a Flask thread. Only the CPU-heavy work leaves the loop:
+  - base64 decoding and Grad-CAM PNG encoding -> ASGI_IO_THREADS thread pool
+  - image decode + model forwards (app.predict) -> ASGI_EXECUTOR pool:
+      "thread":  ASGI_INFERENCE_THREADS threads sharing the models loaded here
+                 (torch releases the GIL inside operators)
+      "process": ASGI_PROCESSES worker processes, each loading its own copy of
+                 the startup model version (no GIL contention for decode /
+                 pre- and post-processing; model hot swap is not available)
+The admin and debug endpoints (/models, /models/activate, /models/rollback,
+/shadow, /debug/memory, /debug/queues and their resets) call the same helpers
+as app.py in thread mode. In process mode the models, queues and shadow
+evaluator live in the workers, so they answer 501 there.
+At most ASGI_MAX_PENDING predictions are admitted (queued or running); beyond
+that /predict answers 503 with Retry-After instead of growing the queue.
+In thread mode with INFERENCE_WORKERS set, the inference pool defaults to
+ASGI_MAX_PENDING threads: admitted requests wait in app.SCHEDULER's priority
+queues (see scheduler.py) rather than in the executor's FIFO, where an
+interactive request could not overtake bulk work. In process mode each
+worker process schedules only its own requests.
+
+Usage:
+    python asgi_app.py                          # uvicorn on $PORT (default 5000)
+    SERVER_MODE=asgi ./startup.sh               # behind nginx in the container
+    python loadtest.py --launch flask asgi      # compare with the Flask mode
+"""
+import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import multiprocessing
+import os
+import uuid
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import app as core
+from dicom_io import DicomError
+from memory_stats import MemoryBudgetExceeded
+from request_log import get_logger
+from scheduler import SchedulerFull, classify
+
+ASGI_EXECUTOR = os.getenv("ASGI_EXECUTOR", "thread").lower()
+ASGI_PROCESSES = int(os.getenv("ASGI_PROCESSES", "2"))
+ASGI_IO_THREADS = int(os.getenv("ASGI_IO_THREADS", "4"))
+ASGI_MAX_PENDING = int(os.getenv("ASGI_MAX_PENDING", "64"))
+# Threads waiting for a scheduler slot are cheap; the scheduler, not the pool size, bounds model work
+ASGI_INFERENCE_THREADS = int(os.getenv("ASGI_INFERENCE_THREADS", "0")) or (ASGI_MAX_PENDING if core.INFERENCE_WORKERS else 2)
+if ASGI_EXECUTOR not in ("thread", "process"):
+    raise ValueError(f"ASGI_EXECUTOR must be 'thread' or 'process', got '{ASGI_EXECUTOR}'")
+if ASGI_EXECUTOR == "process" and core.SIMILAR_CASES and core.EMBEDDING_CAPTURE:
+    # Every worker process would append to the same index files
+    raise ValueError("ASGI_EXECUTOR=process cannot append to the similar-case index; set EMBEDDING_CAPTURE=0")
+log = get_logger("asgi")
+
+# --- Executors ---
+def _init_worker():
+    # Runs once in every worker process (ASGI_EXECUTOR=process)
+    core.load_models()
+
+def _predict_in_worker(*args):
+    return core.predict(*args)
+
+def _worker_health():
+    version = core.REGISTRY.current()
+    return version.name if version else None
+
+IO_EXECUTOR = concurrent.futures.ThreadPoolExecutor(ASGI_IO_THREADS, thread_name_prefix="asgi-io")
+if ASGI_EXECUTOR == "process":
+    # spawn: a forked child would inherit the parent's torch thread pools in an unusable state
+    INFERENCE_EXECUTOR = concurrent.futures.ProcessPoolExecutor(
+        ASGI_PROCESSES, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker)
+else:
+    INFERENCE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(ASGI_INFERENCE_THREADS, thread_name_prefix="asgi-infer")
+PENDING = 0  # predictions admitted and not finished; only touched on the event loop
+WORKER_VERSION = None  # model version reported by the worker processes (process mode)
+
+async def run_predict(*args):
+    """core.predict(*args) on the inference executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(INFERENCE_EXECUTOR, _predict_in_worker if ASGI_EXECUTOR == "process" else core.predict, *args)
+
+# --- Endpoints ---
+async def home(request):
+    return JSONResponse({
+        "message": "Pneumonia Detection API",
+        "status": "running",
+        "server": f"asgi ({ASGI_EXECUTOR} executor)",
+        "endpoints": {
+            "/health": "GET - Health check",
+            "/predict": "POST - Predict pneumonia from X-ray image",
+            "/similar": "POST - Prediction plus the most similar indexed X-rays (SIMILAR_CASES=1)",
+            **({} if ASGI_EXECUTOR == "process" else {
+                "/debug/memory": "GET - Per-stage memory peaks and request budget (admin)",
+                "/debug/memory/reset": "POST - Clear the memory statistics (admin)",
+                "/debug/queues": "GET - Priority class queues, running requests and queue waits",
+                "/debug/queues/reset": "POST - Clear the queue statistics (admin)",
+                "/models": "GET - Serving, cached and available model versions",
+                "/models/activate": "POST - Load, warm up and swap in a model version (admin)",
+                "/models/rollback": "POST - Swap back to the previously served version (admin)",
+                "/shadow": "GET - Candidate vs production agreement / POST - start or stop shadowing a version (admin)",
+                "/shadow/reset": "POST - Clear the shadow statistics (admin)",
+            })
+        }
+    })
+
+async def health(request):
+    if ASGI_EXECUTOR == "process":
+        ready, model_version = WORKER_VERSION is not None, WORKER_VERSION
+    else:
+        version = core.REGISTRY.current()
+        ready, model_version = version is not None, version.name if version else None
+    return JSONResponse({"status": "ok" if ready else "loading", "fast_tier": bool(core.FAST_TIER_MODEL),
+                         "model_version": model_version, "pending": PENDING})
+
+async def predict(request, default_similar_k=0):
+    global PENDING
+    req_id = uuid.uuid4().hex[:8]
+    loop = asyncio.get_running_loop()
+    try:
+        body = None
+        if request.headers.get("content-type", "").startswith("application/json"):
+            try:
+                body = await request.json()
+            except ValueError:
+                return JSONResponse({"error": "Invalid JSON body"}, status_code=400)
+        # Check if request contains base64 data (for CORS proxy compatibility)
+        if isinstance(body, dict) and 'file_data' in body:
+            file_data = body.get('file_data')
+            if not file_data:
+                return JSONResponse({"error": "No file_data provided in JSON request"}, status_code=400)
+            try:
+                image_bytes = await loop.run_in_executor(IO_EXECUTOR, base64.b64decode, file_data)
+            except Exception as e:
+                return JSONResponse({"error": f"Invalid base64 data: {str(e)}"}, status_code=400)
+            disable_cam_request = body.get('disable_cam', 'false') == 'true'
+            tier = str(body.get('tier', 'ensemble')).lower()
+            tta_views = body.get('tta_views', core.TTA_DEFAULT_VIEWS)
+            similar_k = body.get('similar_k', default_similar_k)
+        else:
+            if body is not None:
+                return JSONResponse({"error": "No file part in the request"}, status_code=400)
+            # Multipart upload: parsed as it streams in, large files spool to disk until the form is closed
+            async with request.form() as form:
+                file = form.get('file')
+                if file is None or isinstance(file, str):
+                    return JSONResponse({"error": "No file part in the request"}, status_code=400)
+                if file.filename == '':
+                    return JSONResponse({"error": "No file selected for uploading"}, status_code=400)
+                image_bytes = await file.read()
+                disable_cam_request = str(form.get('disable_cam', 'false')).lower() == 'true'
+                tier = str(form.get('tier', 'ensemble')).lower()
+                tta_views = form.get('tta_views', core.TTA_DEFAULT_VIEWS)
+                similar_k = form.get('similar_k', default_similar_k)
+
+        try:
+            tier, tta_views, similar_k = core.validate_options(tier, tta_views, similar_k)
+            priority, client, weight = classify(request.headers, request.client.host if request.client else None)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        if PENDING >= ASGI_MAX_PENDING:
+            return JSONResponse({"error": "Server busy, retry shortly"}, status_code=503, headers={"Retry-After": "1"})
+        PENDING += 1
+        try:
+            result = await run_predict(image_bytes, disable_cam_request, tier, tta_views, similar_k, req_id,
+                                       priority, client, weight)
+        finally:
+            PENDING -= 1
+        resp = await loop.run_in_executor(IO_EXECUTOR, core.format_response, result, req_id)
+        return JSONResponse(resp)
+    except SchedulerFull as e:
+        log.warning("Request rejected", extra={"req_id": req_id, "status": 503, "error": str(e)})
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "1"})
+    except MemoryBudgetExceeded as e:
+        log.warning("Request rejected", extra={"req_id": req_id, "status": 413, "error": str(e)})
+        return JSONResponse({"error": str(e)}, status_code=413)
+    except DicomError as e:
+        log.warning("Request rejected", extra={"req_id": req_id, "status": 400, "error": str(e)})
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except Exception as e:
+        log.error("Unhandled exception in /predict", exc_info=True, extra={"req_id": req_id})
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def similar(request):
+    return await predict(request, default_similar_k=core.SIMILAR_DEFAULT_K)
+
+# --- Admin / debug endpoints (thread mode) ---
+def local_endpoint(handler, admin=False):
+    """Wrap handler(request) -> (payload, status) with the process-mode and admin-token checks."""
+    async def endpoint(request):
+        if ASGI_EXECUTOR == "process":
+            return JSONResponse({"error": "Not available with ASGI_EXECUTOR=process: each worker process "
+                                          "holds its own models, queues and shadow evaluator"}, status_code=501)
+        if admin and not core.admin_authorized(request.headers):
+            return JSONResponse({"error": "Unauthorized"}, status_code=401)
+        payload, status = await handler(request)
+        return JSONResponse(payload, status_code=status)
+    return endpoint
+
+async def in_io(fn, *args):
+    """fn(*args) on the I/O pool: model loads and tracemalloc snapshots must not block the loop."""
+    return await asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, fn, *args)
+
+async def request_fields(request):
+    """JSON object or form fields of an admin request as a dict."""
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            return {}
+        return body if isinstance(body, dict) else {}
+    async with request.form() as form:
+        return {key: value for key, value in form.items() if isinstance(value, str)}
+
+async def debug_memory(request):
+    return await in_io(core.MEMORY.snapshot), 200
+
+async def debug_memory_reset(request):
+    core.MEMORY.reset()
+    return {"status": "reset"}, 200
+
+async def debug_queues(request):
+    return core.SCHEDULER.snapshot(), 200
+
+async def debug_queues_reset(request):
+    core.SCHEDULER.reset()
+    return {"status": "reset"}, 200
+
+async def list_models(request):
+    return await in_io(core.REGISTRY.status), 200
+
+async def activate_model(request):
+    fields = await request_fields(request)
+    return await in_io(core.activate_version, str(fields.get("version", "")),
+                       str(fields.get("wait", "false")).lower() == "true")
+
+async def rollback_model(request):
+    return await in_io(core.rollback_version)
+
+async def shadow_report(request):
+    return core.SHADOW.snapshot(), 200
+
+async def shadow_control(request):
+    return await in_io(core.control_shadow, await request_fields(request))
+
+async def shadow_reset(request):
+    core.SHADOW.reset()
+    return {"status": "reset"}, 200
+
+@contextlib.asynccontextmanager
+async def lifespan(asgi_app):
+    global WORKER_VERSION
+    loop = asyncio.get_running_loop()
+    # Like app.py, load before accepting traffic so /health only answers once models are ready
+    if ASGI_EXECUTOR == "process":
+        # One call per worker starts every process (and its model load) up front
+        versions = await asyncio.gather(*[loop.run_in_executor(INFERENCE_EXECUTOR, _worker_health)
+                                          for _ in range(ASGI_PROCESSES)])
+        WORKER_VERSION = versions[0]
+    else:
+        await loop.run_in_executor(INFERENCE_EXECUTOR, core.load_models)
+    print(f"[INFO] ASGI server ready ({ASGI_EXECUTOR} executor, "
+          f"{ASGI_PROCESSES if ASGI_EXECUTOR == 'process' else ASGI_INFERENCE_THREADS} inference workers, "
+          f"max {ASGI_MAX_PENDING} pending)")
+    yield
+    INFERENCE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    IO_EXECUTOR.shutdown(wait=False)
+
+asgi = Starlette(
+    routes=[
+        Route("/", home, methods=["GET"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/predict", predict, methods=["POST"]),
+        Route("/similar", similar, methods=["POST"]),
+        Route("/debug/memory", local_endpoint(debug_memory, admin=True), methods=["GET"]),
+        Route("/debug/memory/reset", local_endpoint(debug_memory_reset, admin=True), methods=["POST"]),
+        Route("/debug/queues", local_endpoint(debug_queues), methods=["GET"]),
+        Route("/debug/queues/reset", local_endpoint(debug_queues_reset, admin=True), methods=["POST"]),
+        Route("/models", local_endpoint(list_models), methods=["GET"]),
+        Route("/models/activate", local_endpoint(activate_model, admin=True), methods=["POST"]),
+        Route("/models/rollback", local_endpoint(rollback_model, admin=True), methods=["POST"]),
+        Route("/shadow", local_endpoint(shadow_report), methods=["GET"]),
+        Route("/shadow", local_endpoint(shadow_control, admin=True), methods=["POST"]),
+        Route("/shadow/reset", local_endpoint(shadow_reset, admin=True), methods=["POST"]),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["GET", "POST", "OPTIONS"],
+                           allow_headers=["Content-Type", "Authorization"])],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    port = int(os.getenv("PORT", 5000))
+    uvicorn.run(asgi, host='0.0.0.0', port=port, log_level="warning",
+                timeout_keep_alive=int(os.getenv("ASGI_KEEPALIVE_S", "65")))
@@ -0,0 +1,183 @@
+# autotune.py
+"""Pick torch thread counts, inference workers and CPU affinity for this machine.
+
+Every candidate runs in a fresh subprocess (inter-op threads and affinity can
+only be set once per process): it applies the settings, loads the models
+through app.py and drives predict() from --concurrency client threads, exactly
+as concurrent Flask requests would. The best configuration is written to
+runtime_config.json, which app.py applies at startup.
+
+Usage:
+    python autotune.py --concurrency 4 --requests 40
+    python autotune.py --concurrency 8 --max_p95_ms 1500 --cam
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import torch
+
+RUNTIME_CONFIG_PATH = os.getenv("RUNTIME_CONFIG", "runtime_config.json")
+
+# --- Runtime config (also used by app.py) ---
+def load_runtime_config(path=RUNTIME_CONFIG_PATH):
+    """Settings written by autotune.py, or {} if the file does not exist."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+def apply_runtime_config(config):
+    """Apply thread counts and CPU affinity; call before any model work starts."""
+    if config.get("cpu_affinity") and hasattr(os, 'sched_setaffinity'):
+        cores = [core for core in config["cpu_affinity"] if core in available_cores()]
+        if cores:
+            os.sched_setaffinity(0, cores)
+    if config.get("intra_op_threads"):
+        torch.set_num_threads(int(config["intra_op_threads"]))
+    if config.get("inter_op_threads"):
+        try:
+            torch.set_num_interop_threads(int(config["inter_op_threads"]))
+        except RuntimeError:
+            print("[WARN] inter-op threads already initialized; inter_op_threads from the runtime config ignored")
+    return config
+
+# --- One candidate, measured in this process ---
+def measure(config, image_bytes, concurrency, requests, warmup, cam):
+    apply_runtime_config(config)
+    os.environ["INFERENCE_WORKERS"] = str(config["inference_workers"])
+    os.environ["RUNTIME_CONFIG"] = ""  # candidate settings only, never a stale file
+    import app
+    app.load_models()
+    for _ in range(warmup):
+        app.predict(image_bytes, disable_cam_override=not cam)
+
+    latencies = []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            app.predict(image_bytes, disable_cam_override=not cam)
+            with lock:
+                latencies.append(1000 * (time.perf_counter() - start))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "mean_ms": statistics.mean(latencies),
+    }
+
+# --- Search ---
+def powers_of_two(limit):
+    values, value = [], 1
+    while value <= limit:
+        values.append(value)
+        value *= 2
+    if values[-1] != limit:
+        values.append(limit)
+    return values
+
+def candidates(cores, concurrency):
+    """Thread/worker splits that fit the cores, plus the untuned default (one full pool shared by every request)."""
+    configs = [{"name": "default", "intra_op_threads": 0, "inter_op_threads": 0,
+                "inference_workers": 0, "cpu_affinity": None}]
+    for workers, intra in itertools.product(powers_of_two(concurrency), powers_of_two(len(cores))):
+        if workers * intra > len(cores):
+            continue
+        for affinity in ("all", "compact"):
+            # compact: only the cores the workers can keep busy, leaving the rest to decode / nginx
+            pinned = cores[:workers * intra] if affinity == "compact" and workers * intra < len(cores) else None
+            if affinity == "compact" and pinned is None:
+                continue
+            configs.append({"name": f"{workers}w x {intra}t ({affinity})", "intra_op_threads": intra,
+                            "inter_op_threads": 1, "inference_workers": workers, "cpu_affinity": pinned})
+    return configs
+
+def run_candidate(config, args):
+    command = [sys.executable, os.path.abspath(__file__), '--measure', json.dumps(config),
+               '--image', args.image, '--concurrency', str(args.concurrency),
+               '--requests', str(args.requests), '--warmup', str(args.warmup)]
+    if args.cam:
+        command.append('--cam')
+    result = subprocess.run(command, capture_output=True, text=True)
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith('[AUTOTUNE-RESULT] '):
+            return json.loads(line[len('[AUTOTUNE-RESULT] '):])
+    print(result.stdout[-2000:], result.stderr[-2000:], sep='\n')
+    raise RuntimeError(f"Candidate '{config['name']}' failed (exit {result.returncode})")
+
+def main(args):
+    cores = available_cores()
+    configs = candidates(cores, args.concurrency)
+    print(f"[AUTOTUNE] {len(configs)} configurations, {len(cores)} cores, concurrency {args.concurrency}, "
+          f"{args.requests} requests each ({'with' if args.cam else 'without'} Grad-CAM)")
+
+    rows = []
+    for config in configs:
+        stats = run_candidate(config, args)
+        rows.append((config, stats))
+        print(f"  {config['name']:<26}{stats['throughput']:8.2f} req/s  p50 {stats['p50_ms']:7.1f} ms  p95 {stats['p95_ms']:7.1f} ms")
+
+    eligible = [row for row in rows if args.max_p95_ms is None or row[1]["p95_ms"] <= args.max_p95_ms]
+    if not eligible:
+        print(f"[WARN] No configuration meets p95 <= {args.max_p95_ms} ms; choosing by throughput alone")
+        eligible = rows
+    best_config, best_stats = max(eligible, key=lambda row: row[1]["throughput"])
+    default_stats = rows[0][1]
+
+    print(f"\n{'configuration':<28}{'req/s':>9}{'p50 (ms)':>11}{'p95 (ms)':>11}")
+    print("-" * 59)
+    for config, stats in sorted(rows, key=lambda row: -row[1]["throughput"]):
+        marker = " <- best" if config is best_config else ""
+        print(f"{config['name']:<28}{stats['throughput']:>9.2f}{stats['p50_ms']:>11.1f}{stats['p95_ms']:>11.1f}{marker}")
+    print(f"\nBest vs default: {best_stats['throughput'] / default_stats['throughput']:.2f}x throughput, "
+          f"p95 {default_stats['p95_ms']:.0f} -> {best_stats['p95_ms']:.0f} ms")
+
+    out = dict(best_config, measured=best_stats, concurrency=args.concurrency, cores=len(cores), cam=args.cam)
+    with open(args.out, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"[AUTOTUNE] Wrote {args.out}; app.py applies it at startup (RUNTIME_CONFIG).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark predict() across thread/worker/affinity settings and save the best.")
+    parser.add_argument('--image', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archive',
+                                                                  'Real Data', 'xray1.jpg'), help='X-ray used for every request')
+    parser.add_argument('--concurrency', type=int, default=4, help='Simultaneous client requests to optimize for')
+    parser.add_argument('--requests', type=int, default=40, help='Timed requests per configuration')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per configuration')
+    parser.add_argument('--cam', action='store_true', help='Include Grad-CAM in each request')
+    parser.add_argument('--max_p95_ms', type=float, default=None, help='Only pick configurations under this p95 latency')
+    parser.add_argument('--out', type=str, default=RUNTIME_CONFIG_PATH, help='Runtime config read by app.py')
+    parser.add_argument('--measure', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        with open(args.image, 'rb') as f:
+            image_bytes = f.read()
+        result = measure(json.loads(args.measure), image_bytes, args.concurrency, args.requests, args.warmup, args.cam)
+        print(f"[AUTOTUNE-RESULT] {json.dumps(result)}")
+    else:
+        main(args)
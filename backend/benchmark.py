@@ -0,0 +1,359 @@
+# benchmark.py
+"""Offline latency benchmarks for the inference paths in app.py.
+
+Usage:
+    python benchmark.py frozen --artifact ensemble_frozen.pt --runs 30
+    python benchmark.py members --runs 30
+    python benchmark.py tta --views 2 4 6
+    python benchmark.py memory --runs 10
+    python benchmark.py shadow --candidate 2024-06-01 --sample_rate 0.2
+    python benchmark.py priority --slots 2 --bulk_clients 4 --target_ms 200
+"""
+import argparse
+import glob
+import io
+import os
+import statistics
+import time
+import torch
+from PIL import Image
+
+from models import (CONVNEXT_PATH, CONVNEXT_WEIGHT, EFFICIENTNET_PATH, EFFICIENTNET_WEIGHT,
+                    TTA_VIEWS, ParallelMembers, build_convnext, build_efficientnet, preprocess_transform,
+                    threads_on_fresh_thread, tta_batch)
+
+DEFAULT_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archive', 'Real Data')
+
+def load_sample_inputs(image_dir=DEFAULT_IMAGES):
+    """Preprocess the sample X-rays into (1, 3, 224, 224) tensors."""
+    paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')) + glob.glob(os.path.join(image_dir, '*.png')))
+    if not paths:
+        raise FileNotFoundError(f"No sample images found in {image_dir}")
+    inputs = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            image = Image.open(io.BytesIO(f.read())).convert('RGB')
+        inputs.append(preprocess_transform(image).unsqueeze(0))
+    return inputs
+
+def load_payloads(image_dir=DEFAULT_IMAGES):
+    """Raw bytes of the sample X-rays, as a client would upload them."""
+    paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')) + glob.glob(os.path.join(image_dir, '*.png')))
+    payloads = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            payloads.append(f.read())
+    return payloads
+
+def time_fn(fn, inputs, runs, warmup=3):
+    """Call fn over the inputs `runs` times and return latency stats in milliseconds."""
+    with torch.no_grad():
+        for i in range(warmup):
+            fn(inputs[i % len(inputs)])
+        samples = []
+        for i in range(runs):
+            start = time.perf_counter()
+            fn(inputs[i % len(inputs)])
+            samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "mean": statistics.mean(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
+
+def print_table(rows):
+    """Print rows of (name, stats dict) as an aligned table."""
+    print(f"\n{'path':<28}{'load (s)':>10}{'mean (ms)':>12}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+    print("-" * 74)
+    for name, stats in rows:
+        load = f"{stats['load']:.2f}" if 'load' in stats else '-'
+        print(f"{name:<28}{load:>10}{stats['mean']:>12.1f}{stats['p50']:>12.1f}{stats['p95']:>12.1f}")
+
+def bench_frozen(args):
+    """Eager two-model ensemble vs the frozen TorchScript artifact."""
+    inputs = load_sample_inputs(args.images)
+
+    start = time.perf_counter()
+    convnext = build_convnext(CONVNEXT_PATH)
+    efficientnet = build_efficientnet(EFFICIENTNET_PATH)
+    eager_load = time.perf_counter() - start
+
+    def eager(x):
+        probs1 = torch.nn.functional.softmax(convnext(x), dim=1)
+        probs2 = torch.nn.functional.softmax(efficientnet(x), dim=1)
+        return (CONVNEXT_WEIGHT * probs1) + (EFFICIENTNET_WEIGHT * probs2)
+
+    eager_stats = time_fn(eager, inputs, args.runs)
+    eager_stats["load"] = eager_load
+
+    from export_ensemble import load_frozen_ensemble
+    start = time.perf_counter()
+    frozen, _ = load_frozen_ensemble(args.artifact)
+    frozen_load = time.perf_counter() - start
+    frozen_stats = time_fn(frozen, inputs, args.runs)
+    frozen_stats["load"] = frozen_load
+
+    print_table([("eager", eager_stats), ("torchscript (frozen)", frozen_stats)])
+    print(f"\nSpeed-up (mean latency): {eager_stats['mean'] / frozen_stats['mean']:.2f}x, "
+          f"startup: {eager_load / frozen_load:.2f}x")
+
+def bench_members(args):
+    """Sequential member forwards vs ParallelMembers (and, optionally, a forked TorchScript graph)."""
+    inputs = load_sample_inputs(args.images)
+    convnext = build_convnext(CONVNEXT_PATH)
+    efficientnet = build_efficientnet(EFFICIENTNET_PATH)
+    total_threads = torch.get_num_threads()
+
+    def sequential(x):
+        return convnext(x), efficientnet(x)
+
+    runner = ParallelMembers()
+
+    def parallel(x):
+        return runner.run(convnext, efficientnet, x)
+
+    rows = [
+        (f"sequential ({total_threads} thr)", time_fn(sequential, inputs, args.runs)),
+        ("parallel (traced fork)", time_fn(parallel, inputs, args.runs)),
+    ]
+    # The parallel runs must not have shrunk the pool every other request thread uses
+    print(f"Intra-op threads on a fresh thread after the parallel runs: {threads_on_fresh_thread()} (was {total_threads})")
+
+    if args.artifact:
+        from export_ensemble import load_frozen_ensemble
+        frozen, meta = load_frozen_ensemble(args.artifact)
+        label = "torchscript fork" if meta.get("parallel") else "torchscript"
+        rows.append((label, time_fn(frozen, inputs, args.runs)))
+
+    print(f"CPU threads available to torch: {total_threads}")
+    print_table(rows)
+    print(f"\nSingle-request latency reduction (mean): {rows[0][1]['mean'] / rows[1][1]['mean']:.2f}x")
+
+def bench_tta(args):
+    """Test-time augmentation: one batched forward per member vs a per-view loop."""
+    inputs = load_sample_inputs(args.images)
+    convnext = build_convnext(CONVNEXT_PATH)
+    efficientnet = build_efficientnet(EFFICIENTNET_PATH)
+
+    def fused(x):
+        probs1 = torch.nn.functional.softmax(convnext(x), dim=1)
+        probs2 = torch.nn.functional.softmax(efficientnet(x), dim=1)
+        return (CONVNEXT_WEIGHT * probs1) + (EFFICIENTNET_WEIGHT * probs2)
+
+    rows = [("no TTA", time_fn(fused, inputs, args.runs))]
+    for views in args.views:
+        def batched(x, views=views):
+            return fused(tta_batch(x, views)).mean(0, keepdim=True)
+
+        def looped(x, views=views):
+            batch = tta_batch(x, views)
+            return torch.stack([fused(batch[i:i + 1]) for i in range(views)]).mean(0)
+
+        rows.append((f"{views} views, batched", time_fn(batched, inputs, args.runs)))
+        rows.append((f"{views} views, per-view loop", time_fn(looped, inputs, args.runs)))
+
+    print_table(rows)
+    base = rows[0][1]['mean']
+    print(f"\n{'views':>6}{'batched':>12}{'loop':>12}{'batched vs loop':>18}")
+    for i, views in enumerate(args.views):
+        batched_ms, looped_ms = rows[1 + 2 * i][1]['mean'], rows[2 + 2 * i][1]['mean']
+        print(f"{views:>6}{batched_ms / base:>11.2f}x{looped_ms / base:>11.2f}x{looped_ms / batched_ms:>17.2f}x")
+    print("(latency relative to a single un-augmented forward)")
+
+def bench_memory(args):
+    """Per-stage memory peaks of app.predict() (decode, preprocess, forward, Grad-CAM, encode)."""
+    os.environ["MEMORY_PROFILE"] = "1"
+    import cv2
+    import app
+    from memory_stats import MEMORY, current_rss
+
+    payloads = load_payloads(args.images)
+    baseline = current_rss()
+    app.load_models()
+    print(f"Models loaded: +{(current_rss() - baseline) / 2 ** 20:.0f} MB RSS")
+    MEMORY.reset()
+    for i in range(args.runs):
+        overlay = app.predict(payloads[i % len(payloads)], disable_cam_override=args.no_cam,
+                              tta_views=args.tta_views)[3]
+        if overlay is not None:
+            with MEMORY.stage("encode"):
+                cv2.imencode('.png', cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
+
+    report = MEMORY.snapshot()
+    print(f"\n{'stage':<12}{'RSS peak mean':>15}{'RSS peak max':>14}{'py peak max':>13}{'cuda peak max':>15}  (MB)")
+    print("-" * 69)
+    for name, stage in report["stages"].items():
+        print(f"{name:<12}{stage['rss_mb']['mean']:>15.1f}{stage['rss_mb']['max']:>14.1f}"
+              f"{stage['py_mb']['max']:>13.1f}{stage['cuda_mb']['max']:>15.1f}")
+    print(f"\nProcess RSS {report['rss_mb']:.0f} MB, peak {report['max_rss_mb']:.0f} MB")
+
+def bench_shadow(args):
+    """Primary predict() latency under concurrent load, without and with a shadow candidate."""
+    import threading
+    import app
+    from registry import MODEL_VERSION
+
+    payloads = load_payloads(args.images)
+    app.load_models()
+
+    def drive():
+        latencies, lock, remaining = [], threading.Lock(), [args.runs]
+
+        def request(i):
+            start = time.perf_counter()
+            app.predict(payloads[i % len(payloads)], disable_cam_override=True)
+            with lock:
+                latencies.append(1000 * (time.perf_counter() - start))
+
+        def client():
+            while True:
+                with lock:
+                    if remaining[0] == 0:
+                        return
+                    remaining[0] -= 1
+                    i = remaining[0]
+                # A fresh thread per request, as Flask's threaded server does: torch
+                # settings made by other threads (the intra-op pool size) show up here
+                thread = threading.Thread(target=request, args=(i,))
+                thread.start()
+                thread.join()
+
+        threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        return {"mean": statistics.mean(latencies), "p50": latencies[len(latencies) // 2],
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]}
+
+    for i in range(3):
+        app.predict(payloads[i % len(payloads)], disable_cam_override=True)
+    baseline = drive()
+    app.SHADOW.start(args.candidate or MODEL_VERSION, args.sample_rate)
+    while app.SHADOW.snapshot()["status"] != "running":
+        if app.SHADOW.snapshot()["status"].startswith("failed"):
+            raise RuntimeError(app.SHADOW.snapshot()["status"])
+        time.sleep(0.5)
+    shadowed = drive()
+    report = app.SHADOW.snapshot()
+    app.SHADOW.stop()
+
+    print(f"\n{'primary path':<22}{'mean (ms)':>11}{'p50 (ms)':>11}{'p95 (ms)':>11}{'p99 (ms)':>11}")
+    print("-" * 66)
+    for name, stats in (("shadow off", baseline), (f"shadow on ({args.sample_rate:.0%})", shadowed)):
+        print(f"{name:<22}{stats['mean']:>11.1f}{stats['p50']:>11.1f}{stats['p95']:>11.1f}{stats['p99']:>11.1f}")
+    print(f"\np99 change: {100 * (shadowed['p99'] / baseline['p99'] - 1):+.1f}%")
+    print(f"Shadow: {report['counts']}, agreement {report['agreement']}, "
+          f"candidate forward {report['candidate_forward_ms']}")
+
+def bench_priority(args):
+    """Interactive latency while bulk clients saturate the model slots: one FIFO queue vs priority lanes."""
+    import random
+    import threading
+    import app
+    from scheduler import FairScheduler
+
+    payloads = load_payloads(args.images)
+    app.load_models()
+    for i in range(3):
+        app.predict(payloads[i % len(payloads)], disable_cam_override=True)
+
+    def run(lanes):
+        if lanes:
+            app.SCHEDULER = FairScheduler(args.slots, ["interactive", "bulk"], target_ms=args.target_ms)
+        else:
+            app.SCHEDULER = FairScheduler(args.slots, ["fifo"])  # one class, one client: arrival order
+        stop = threading.Event()
+        interactive, bulk, lock = [], [0], threading.Lock()
+
+        def bulk_client(i):
+            while not stop.is_set():
+                app.predict(payloads[i % len(payloads)], True, "ensemble", args.bulk_tta, 0, None,
+                            "bulk" if lanes else "fifo", f"bulk-{i}" if lanes else "all")
+                with lock:
+                    bulk[0] += 1
+
+        def interactive_client(i):
+            rng = random.Random(i)
+            for n in range(args.runs):
+                time.sleep(rng.expovariate(1 / args.think_s))
+                start = time.perf_counter()
+                app.predict(payloads[n % len(payloads)], not args.cam, "ensemble", 1, 0, None,
+                            "interactive" if lanes else "fifo", f"clinician-{i}" if lanes else "all")
+                with lock:
+                    interactive.append(1000 * (time.perf_counter() - start))
+
+        bulk_threads = [threading.Thread(target=bulk_client, args=(i,)) for i in range(args.bulk_clients)]
+        interactive_threads = [threading.Thread(target=interactive_client, args=(i,)) for i in range(args.interactive_clients)]
+        start = time.perf_counter()
+        for thread in bulk_threads + interactive_threads:
+            thread.start()
+        for thread in interactive_threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for thread in bulk_threads:
+            thread.join()
+        interactive.sort()
+        pick = lambda q: interactive[min(len(interactive) - 1, int(len(interactive) * q))]
+        return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "bulk_rps": bulk[0] / elapsed,
+                "queues": app.SCHEDULER.snapshot()}
+
+    rows = [("single FIFO queue", run(lanes=False)), ("priority lanes", run(lanes=True))]
+    print(f"\n{args.slots} slots, {args.bulk_clients} bulk clients (tta_views={args.bulk_tta}), "
+          f"{args.interactive_clients} interactive clients x {args.runs} requests"
+          f"{f', target {args.target_ms:.0f} ms' if args.target_ms else ''}")
+    print(f"{'scheduling':<20}{'inter. p50':>12}{'inter. p95':>12}{'inter. p99':>12}{'bulk req/s':>12}")
+    print("-" * 68)
+    for name, stats in rows:
+        print(f"{name:<20}{stats['p50']:>12.1f}{stats['p95']:>12.1f}{stats['p99']:>12.1f}{stats['bulk_rps']:>12.2f}")
+    waits = rows[1][1]["queues"]["classes"]
+    print(f"\nQueue wait with lanes (ms): interactive {waits['interactive']['wait_ms']}, bulk {waits['bulk']['wait_ms']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pneumonia ensemble inference paths.")
+    parser.add_argument('--images', type=str, default=DEFAULT_IMAGES, help='Directory of sample X-rays')
+    parser.add_argument('--runs', type=int, default=30, help='Timed iterations per path')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    frozen_parser = subparsers.add_parser('frozen', help='Eager ensemble vs frozen TorchScript artifact')
+    frozen_parser.add_argument('--artifact', type=str, default='ensemble_frozen.pt', help='Frozen ensemble path')
+    frozen_parser.set_defaults(func=bench_frozen)
+
+    members_parser = subparsers.add_parser('members', help='Sequential vs concurrent ensemble members')
+    members_parser.add_argument('--artifact', type=str, default=None, help='Also time a frozen artifact exported with --parallel')
+    members_parser.set_defaults(func=bench_members)
+
+    tta_parser = subparsers.add_parser('tta', help='Batched test-time augmentation vs a per-view loop')
+    tta_parser.add_argument('--views', type=int, nargs='+', default=[2, 4, len(TTA_VIEWS)], help='View counts to time')
+    tta_parser.set_defaults(func=bench_tta)
+
+    memory_parser = subparsers.add_parser('memory', help='Per-stage memory peaks of predict()')
+    memory_parser.add_argument('--no_cam', action='store_true', help='Skip Grad-CAM')
+    memory_parser.add_argument('--tta_views', type=int, default=1, help='TTA views per request')
+    memory_parser.set_defaults(func=bench_memory)
+
+    shadow_parser = subparsers.add_parser('shadow', help='Primary latency with and without shadow evaluation')
+    shadow_parser.add_argument('--candidate', type=str, default=None, help='Registry version to shadow (default: the serving one)')
+    shadow_parser.add_argument('--sample_rate', type=float, default=0.2, help='Fraction of requests mirrored')
+    shadow_parser.add_argument('--concurrency', type=int, default=2, help='Concurrent client threads')
+    shadow_parser.set_defaults(func=bench_shadow)
+
+    priority_parser = subparsers.add_parser('priority', help='Interactive latency under bulk load, FIFO vs priority lanes')
+    priority_parser.add_argument('--slots', type=int, default=2, help='Concurrent predict() slots (INFERENCE_WORKERS)')
+    priority_parser.add_argument('--bulk_clients', type=int, default=4, help='Closed-loop bulk clients')
+    priority_parser.add_argument('--bulk_tta', type=int, default=1, help='tta_views of a bulk request')
+    priority_parser.add_argument('--interactive_clients', type=int, default=2, help='Interactive clients')
+    priority_parser.add_argument('--think_s', type=float, default=0.5, help='Mean pause between interactive requests (s)')
+    priority_parser.add_argument('--target_ms', type=float, default=0.0, help='Interactive p95 queue-wait target (0 = off)')
+    priority_parser.add_argument('--cam', action='store_true', help='Interactive requests include Grad-CAM')
+    priority_parser.set_defaults(func=bench_priority)
+
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    args.func(args)
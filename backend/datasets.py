@@ -0,0 +1,80 @@
+# datasets.py
+"""Labelled X-ray folders for the offline backend tools (quantization, tuning, benchmarks).
+
+Uses the same <data_dir>/<CLASS_NAME>/*.jpeg layout and class ordering as
+ImageTensorDataset in archive/training.
+"""
+import glob
+import os
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from PIL import Image
+
+from models import CLASS_NAMES, CONVNEXT_PATH, EFFICIENTNET_PATH, build_convnext, build_efficientnet, preprocess_transform
+
+class ImageTensorDataset(Dataset):
+    def __init__(self, data_dir, transform=preprocess_transform):
+        class_names = sorted([d for d in os.listdir(data_dir)
+                              if os.path.isdir(os.path.join(data_dir, d)) and not d.startswith('.')])
+        if class_names != CLASS_NAMES:
+            raise ValueError(f"Expected class folders {CLASS_NAMES} in {data_dir}, found {class_names}")
+        self.class_to_idx = {cls: i for i, cls in enumerate(class_names)}
+        self.file_paths = []
+        for cls in class_names:
+            self.file_paths.extend(glob.glob(os.path.join(data_dir, cls, '*.jpeg')))
+            self.file_paths.extend(glob.glob(os.path.join(data_dir, cls, '*.jpg')))
+            self.file_paths.extend(glob.glob(os.path.join(data_dir, cls, '*.png')))
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def __getitem__(self, idx):
+        file_path = self.file_paths[idx]
+        image = Image.open(file_path).convert('RGB')
+        class_name = os.path.basename(os.path.dirname(file_path))
+        label = self.class_to_idx[class_name]
+        if self.transform:
+            image = self.transform(image)
+        return image, label
+
+def make_loader(data_dir, batch_size=16, num_workers=2, shuffle=False):
+    """DataLoader over a labelled folder with the inference preprocessing."""
+    return DataLoader(ImageTensorDataset(data_dir), batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+
+def collect_logits(model, loader, device='cpu'):
+    """Run a model over a loader once. Returns (logits [N, C], labels [N])."""
+    all_logits, all_labels = [], []
+    with torch.no_grad():
+        for inputs, labels in loader:
+            all_logits.append(model(inputs.to(device)).float().cpu())
+            all_labels.append(labels)
+    return torch.cat(all_logits), torch.cat(all_labels)
+
+def per_class_accuracy(predicted, labels):
+    """Accuracy (%) per class name plus 'overall' from predicted/true index tensors."""
+    report = {}
+    for idx, name in enumerate(CLASS_NAMES):
+        mask = labels == idx
+        total = int(mask.sum().item())
+        report[name] = 100.0 * (predicted[mask] == idx).sum().item() / total if total else float('nan')
+    report['overall'] = 100.0 * (predicted == labels).sum().item() / max(1, len(labels))
+    return report
+
+def build_logit_cache(data_dir, out_path, batch_size=16, device='cpu'):
+    """Run both members over a labelled folder once and save their logits to an .npz file."""
+    loader = make_loader(data_dir, batch_size=batch_size)
+    convnext_logits, labels = collect_logits(build_convnext(CONVNEXT_PATH, device), loader, device)
+    efficientnet_logits, _ = collect_logits(build_efficientnet(EFFICIENTNET_PATH, device), loader, device)
+    np.savez_compressed(
+        out_path,
+        convnext=convnext_logits.numpy().astype(np.float32),
+        efficientnet=efficientnet_logits.numpy().astype(np.float32),
+        labels=labels.numpy().astype(np.int64),
+    )
+
+def load_logit_cache(path):
+    """Load a cache written by build_logit_cache. Returns a dict of torch tensors."""
+    with np.load(path) as cache:
+        return {key: torch.from_numpy(cache[key]) for key in ('convnext', 'efficientnet', 'labels')}
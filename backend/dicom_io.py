@@ -0,0 +1,112 @@
+# dicom_io.py
+"""DICOM ingestion for /predict: PACS exports go straight to the model without a JPEG/PNG step.
+
+Only the pixel data and the tags needed to display it are parsed (dcmread
+with specific_tags), the stored single-channel values are area-averaged
+straight to the model input resolution, and the modality rescale, VOI window
+and MONOCHROME1 inversion are applied vectorized on that small array. No
+full-resolution float or 16-bit RGB copy is ever made. The stored frame
+size is checked against MEMORY_BUDGET_MB before decoding, and with pydicom 3
+only the first frame of a multi-frame file is decoded.
+
+Needs pydicom (and its pixel-data handlers for compressed transfer syntaxes).
+
+Usage:
+    curl -F "file=@study.dcm" localhost:5000/predict
+"""
+import io
+import cv2
+import numpy as np
+from PIL import Image
+
+from memory_stats import MEMORY_BUDGET_MB, check_decode_budget
+from models import INPUT_SIZE
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+# Everything read from a DICOM upload; other elements (patient data, overlays, ...) are skipped
+DICOM_TAGS = [
+    "PixelData", "Rows", "Columns", "SamplesPerPixel", "NumberOfFrames",
+    "BitsAllocated", "BitsStored", "HighBit", "PixelRepresentation", "PhotometricInterpretation",
+    "RescaleSlope", "RescaleIntercept", "WindowCenter", "WindowWidth",
+]
+MONOCHROME = ("MONOCHROME1", "MONOCHROME2")
+
+class DicomError(ValueError):
+    """The upload is DICOM but cannot be turned into a model input (reported as a 400)."""
+
+def is_dicom(data):
+    """True for DICOM Part 10 files (128-byte preamble followed by "DICM")."""
+    return len(data) >= 132 and data[128:132] == b"DICM"
+
+def read_dicom(data):
+    """Dataset holding only DICOM_TAGS."""
+    if pydicom is None:
+        raise DicomError("DICOM uploads are not enabled on this server (pydicom is not installed)")
+    try:
+        return pydicom.dcmread(io.BytesIO(data), specific_tags=DICOM_TAGS)
+    except Exception as e:
+        raise DicomError(f"Unreadable DICOM file: {e}")
+
+def _first(value):
+    # WindowCenter / WindowWidth may be multi-valued (several presets); use the first
+    if not isinstance(value, (str, bytes)) and hasattr(value, '__len__'):
+        value = value[0]
+    return float(value)
+
+def window_bounds(ds, values):
+    """(low, width) of the linear VOI window from the tags, or the value range if the file has none."""
+    if "WindowCenter" in ds and "WindowWidth" in ds:
+        center, width = _first(ds.WindowCenter), _first(ds.WindowWidth)
+        if width >= 1:
+            # PS3.3 C.11.2.1.2.1: x <= c - 0.5 - (w - 1) / 2 -> black, x > c - 0.5 + (w - 1) / 2 -> white
+            return center - 0.5 - (width - 1) / 2, max(width - 1, 1e-6)
+    low, high = float(values.min()), float(values.max())
+    return low, max(high - low, 1e-6)
+
+def decode_dicom(data, size=(INPUT_SIZE, INPUT_SIZE), views=1, budget_mb=MEMORY_BUDGET_MB):
+    """8-bit RGB PIL image of `size` from DICOM bytes; DicomError for files that cannot be shown as an X-ray.
+
+    Raises MemoryBudgetExceeded when the stored pixels to decode (plus `views`
+    forwards) exceed budget_mb.
+    """
+    ds = read_dicom(data)
+    if "PixelData" not in ds:
+        raise DicomError("DICOM file has no pixel data")
+    photometric = str(ds.get("PhotometricInterpretation", "MONOCHROME2")).upper()
+    if photometric not in MONOCHROME or int(ds.get("SamplesPerPixel", 1)) != 1:
+        raise DicomError(f"Unsupported DICOM photometric interpretation '{photometric}', expected {' or '.join(MONOCHROME)}")
+
+    # pydicom 3 can decode a single frame; older versions decode every frame first
+    frame_level = hasattr(ds, "pixel_array_options")
+    rows, columns = int(ds.get("Rows", 0)), int(ds.get("Columns", 0))
+    frames = 1 if frame_level else int(ds.get("NumberOfFrames", 1) or 1)
+    check_decode_budget(rows * columns * frames * int(ds.get("BitsAllocated", 16)) // 8, views, budget_mb,
+                        f"DICOM {columns}x{rows}, {frames} frame(s) decoded")
+    try:
+        if frame_level:
+            ds.pixel_array_options(index=0)
+        pixels = ds.pixel_array
+    except Exception as e:
+        # e.g. a compressed transfer syntax without its decoder installed
+        raise DicomError(f"Cannot decode DICOM pixel data: {e}")
+    if pixels.ndim == 3:
+        pixels = pixels[0]  # multi-frame decoded by an older pydicom: first frame
+    # INTER_AREA works on the stored 8/16-bit values directly; other dtypes go through float32
+    if pixels.dtype not in (np.uint8, np.uint16, np.int16):
+        pixels = pixels.astype(np.float32)
+    values = cv2.resize(pixels, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    # Modality LUT (linear), then VOI window, both on the model-resolution array
+    slope, intercept = float(ds.get("RescaleSlope", 1.0)), float(ds.get("RescaleIntercept", 0.0))
+    if slope != 1.0 or intercept != 0.0:
+        values = values * slope + intercept
+    low, width = window_bounds(ds, values)
+    values = np.clip((values - low) / width, 0.0, 1.0)
+    if photometric == "MONOCHROME1":
+        values = 1.0 - values  # MONOCHROME1 stores bright as low values
+    gray = (values * 255.0 + 0.5).astype(np.uint8)
+    return Image.fromarray(np.repeat(gray[:, :, None], 3, axis=2), 'RGB')
@@ -0,0 +1,313 @@
+# embedding_index.py
+"""Similar-case retrieval over ensemble embeddings kept in a memory-mapped index.
+
+An embedding is the penultimate (pre-classifier) features of both members,
+recorded by hooks during the normal predict() forward (no extra forward),
+averaged over TTA views, L2-normalized per member and concatenated
+(ConvNeXt 768 + EfficientNetV2 1280) with unit total norm, so cosine
+similarity is a dot product.
+
+Index directory, one per model version (EMBEDDING_INDEX_DIR/<version>):
+    index.json    dim, dtype, row count, capacity and IVF state
+    vectors.bin   [capacity, dim] float16/float32 rows, memory-mapped
+    offsets.bin   [capacity] int64 byte offset of each row's line in meta.jsonl
+    meta.jsonl    one JSON line per row: id, source, time and either the verified
+                  "label" (references) or the model's "predicted_label" and
+                  confidence (captured queries, EMBEDDING_CAPTURE=1)
+    ivf.npy       optional IVF centroids [lists, dim] (train-ivf)
+    lists.bin     optional [capacity] int32 IVF list of each row
+Opening an index only maps these files, so restarts are instant regardless of
+size. The server only appends; run the add / train-ivf commands against an
+index the server is not writing to, and restart it to pick them up.
+Without IVF every search is one chunked matrix-vector product; with IVF
+only the rows of the EMBEDDING_NPROBE closest lists are scored.
+
+Usage:
+    python embedding_index.py add --data_dir chest_xray/train     # labelled reference cases
+    python embedding_index.py train-ivf --lists 1024
+    python embedding_index.py search --image xray.jpg -k 5
+"""
+import argparse
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+import torch
+
+EMBEDDING_INDEX_DIR = os.getenv("EMBEDDING_INDEX_DIR", "embedding_index")
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float16")
+EMBEDDING_NPROBE = int(os.getenv("EMBEDDING_NPROBE", "8"))
+SEARCH_CHUNK_ROWS = 8192  # rows converted to float32 at a time during exhaustive search
+MEMBERS = ("convnext", "efficientnet")
+if EMBEDDING_DTYPE not in ("float16", "float32"):
+    raise ValueError(f"EMBEDDING_DTYPE must be 'float16' or 'float32', got '{EMBEDDING_DTYPE}'")
+
+# --- Capture during the normal forward ---
+class EmbeddingCapture:
+    """Records the classifier-head inputs of the members for batches predict() asks for.
+
+    predict() calls expect(batch) before its forward and collect(batch) after;
+    other forwards (warm-up, Grad-CAM, benchmarks) are ignored. The head input
+    is matched to the batch through a forward hook on the whole member, which
+    runs on the same thread as the head. Traced graphs (PARALLEL_MEMBERS) skip
+    the hooks, so predict() runs the members eagerly when it needs embeddings.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # id(batch) -> {member name: features [N, D]}
+        self.local = threading.local()
+
+    def attach(self, name, model):
+        """Hook member `name`; False if it is not an eager module with a Linear head (ONNX, TorchScript)."""
+        head = getattr(model, 'classifier', None)
+        if not isinstance(model, torch.nn.Module) or not isinstance(head, torch.nn.Sequential):
+            return False
+
+        def record_head_input(_module, inputs):
+            self.local.features = inputs[0]
+
+        def record_member(_module, inputs, _output):
+            features, self.local.features = getattr(self.local, 'features', None), None
+            with self.lock:
+                slot = self.pending.get(id(inputs[0]))
+                if slot is not None and features is not None:
+                    slot[name] = features.detach()
+
+        head[-1].register_forward_pre_hook(record_head_input)
+        model.register_forward_hook(record_member)
+        return True
+
+    def expect(self, batch):
+        with self.lock:
+            self.pending[id(batch)] = {}
+
+    def collect(self, batch):
+        with self.lock:
+            return self.pending.pop(id(batch), {})
+
+def combine(features):
+    """Unit-norm embedding (np.float32 [D]) from per-member features of one image's views; None if a member is missing."""
+    if any(name not in features for name in MEMBERS):
+        return None
+    parts = [torch.nn.functional.normalize(features[name].float().mean(0), dim=0) for name in MEMBERS]
+    return (torch.cat(parts) / math.sqrt(len(parts))).cpu().numpy()
+
+# --- Index ---
+class EmbeddingIndex:
+    def __init__(self, path, dtype=EMBEDDING_DTYPE):
+        self.path = path
+        self.lock = threading.Lock()  # appends and IVF changes; searches only read a snapshot
+        os.makedirs(path, exist_ok=True)
+        self.header_path = os.path.join(path, 'index.json')
+        if os.path.exists(self.header_path):
+            with open(self.header_path) as f:
+                self.header = json.load(f)
+        else:
+            self.header = {"dim": None, "dtype": dtype, "count": 0, "capacity": 0, "ivf_lists": 0}
+        self.vectors = self.offsets = self.lists = None
+        self.centroids = None
+        if self.header["capacity"]:
+            # Rows past the header count (a crash before the header write) are simply overwritten later
+            self._map()
+        if self.header["ivf_lists"]:
+            self.centroids = np.load(os.path.join(path, 'ivf.npy'))
+
+    def __len__(self):
+        return self.header["count"]
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _map(self):
+        capacity, dim = self.header["capacity"], self.header["dim"]
+        self.vectors = np.memmap(self._file('vectors.bin'), dtype=self.header["dtype"], mode='r+', shape=(capacity, dim))
+        self.offsets = np.memmap(self._file('offsets.bin'), dtype=np.int64, mode='r+', shape=(capacity,))
+        if self.header["ivf_lists"]:
+            self.lists = np.memmap(self._file('lists.bin'), dtype=np.int32, mode='r+', shape=(capacity,))
+
+    def _grow(self, needed):
+        capacity = max(1024, self.header["capacity"])
+        while capacity < needed:
+            capacity *= 2
+        itemsize = np.dtype(self.header["dtype"]).itemsize
+        files = [('vectors.bin', self.header["dim"] * itemsize), ('offsets.bin', 8)]
+        if self.header["ivf_lists"]:
+            files.append(('lists.bin', 4))
+        for name, row_bytes in files:
+            # Extending the file keeps existing rows in place; old maps stay valid for running searches
+            with open(self._file(name), 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        self.header["capacity"] = capacity
+        self._map()
+
+    def _write_header(self):
+        tmp = self.header_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f)
+        os.replace(tmp, self.header_path)
+
+    def add(self, embeddings, metas):
+        """Append unit-norm rows [N, D] with one metadata dict each; returns the new row count."""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        with self.lock:
+            if self.header["dim"] is None:
+                self.header["dim"] = embeddings.shape[1]
+            elif embeddings.shape[1] != self.header["dim"]:
+                raise ValueError(f"Embedding dim {embeddings.shape[1]} does not match index dim {self.header['dim']}")
+            start = self.header["count"]
+            end = start + len(embeddings)
+            if end > self.header["capacity"]:
+                self._grow(end)
+            self.vectors[start:end] = embeddings
+            if self.centroids is not None:
+                self.lists[start:end] = np.argmax(embeddings @ self.centroids.T, axis=1)
+            with open(self._file('meta.jsonl'), 'ab') as f:
+                for row, meta in enumerate(metas, start):
+                    self.offsets[row] = f.tell()
+                    meta = dict(meta, added=meta.get("added", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())))
+                    f.write((json.dumps(meta) + "\n").encode())
+            self.header["count"] = end
+            self._write_header()
+            return end
+
+    def meta(self, row):
+        with open(self._file('meta.jsonl'), 'rb') as f:
+            f.seek(int(self.offsets[row]))
+            return json.loads(f.readline())
+
+    def search(self, query, k=5, nprobe=EMBEDDING_NPROBE):
+        """Top-k rows by cosine similarity: [{"score", **meta}], best first."""
+        with self.lock:
+            count, vectors, lists, centroids = self.header["count"], self.vectors, self.lists, self.centroids
+        if count == 0 or k <= 0:
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        if centroids is not None:
+            # IVF: score only the rows of the nprobe closest lists
+            probe = np.argsort(centroids @ query)[::-1][:nprobe]
+            rows = np.flatnonzero(np.isin(lists[:count], probe))
+            scores = np.asarray(vectors[rows], dtype=np.float32) @ query
+        else:
+            rows = None
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, SEARCH_CHUNK_ROWS):
+                end = min(count, start + SEARCH_CHUNK_ROWS)
+                scores[start:end] = np.asarray(vectors[start:end], dtype=np.float32) @ query
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [{"score": round(float(scores[i]), 4), **self.meta(int(rows[i] if rows is not None else i))} for i in top]
+
+    def train_ivf(self, num_lists, iters=10, sample=100000, seed=0):
+        """Spherical k-means over a sample of the rows, then assign every row to its closest list."""
+        count = len(self)
+        if count < num_lists:
+            raise ValueError(f"Need at least {num_lists} rows to train {num_lists} lists, index has {count}")
+        rng = np.random.default_rng(seed)
+        data = np.asarray(self.vectors[np.sort(rng.choice(count, min(sample, count), replace=False))], dtype=np.float32)
+        centroids = data[rng.choice(len(data), num_lists, replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, data)
+            empty = np.bincount(assign, minlength=num_lists) == 0
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]  # re-seed empty lists
+            centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True).clip(1e-12)
+        with self.lock:
+            with open(self._file('lists.bin'), 'ab') as f:
+                f.truncate(self.header["capacity"] * 4)
+            self.header["ivf_lists"] = num_lists
+            self._map()
+            for start in range(0, count, SEARCH_CHUNK_ROWS):
+                end = min(count, start + SEARCH_CHUNK_ROWS)
+                self.lists[start:end] = np.argmax(np.asarray(self.vectors[start:end], dtype=np.float32) @ centroids.T, axis=1)
+            np.save(self._file('ivf.npy'), centroids)
+            self.centroids = centroids
+            self._write_header()
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+def get_index(version_name, root=EMBEDDING_INDEX_DIR):
+    """The index of one model version (embeddings of different versions are not comparable)."""
+    with _INDEXES_LOCK:
+        if version_name not in _INDEXES:
+            _INDEXES[version_name] = EmbeddingIndex(os.path.join(root, version_name))
+        return _INDEXES[version_name]
+
+# --- CLI ---
+def serve_cli_version(app, name):
+    """Serve registry version `name` (its own checkpoints), or the startup version if None."""
+    if name:
+        return app.REGISTRY.activate(name)
+    app.load_models()
+    return app.REGISTRY.current()
+
+def add_reference(args):
+    """Embed a labelled <data_dir>/<CLASS_NAME>/*.jpeg folder through the serving models."""
+    import app
+    from datasets import ImageTensorDataset
+    from models import CLASS_NAMES
+    version = serve_cli_version(app, args.version)
+    dataset = ImageTensorDataset(args.data_dir)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=2)
+    index = get_index(version.name)
+    row = 0
+    for inputs, labels in loader:
+        inputs = inputs.to(app.DEVICE)
+        app.EMBEDDINGS.expect(inputs)
+        try:
+            app.ensemble_probs(inputs, version, cascade=False)
+        finally:
+            features = app.EMBEDDINGS.collect(inputs)
+        embeddings = np.stack([combine({name: value[i:i + 1] for name, value in features.items()})
+                               for i in range(len(inputs))])
+        paths = dataset.file_paths[row:row + len(inputs)]
+        row += len(inputs)
+        index.add(embeddings, [{"id": os.path.relpath(path, args.data_dir), "source": "reference",
+                                "label": CLASS_NAMES[int(label)]} for path, label in zip(paths, labels)])
+        print(f"[INDEX] {row}/{len(dataset)} reference images embedded", end="\r")
+    print(f"\n[INDEX] {len(index)} rows in {index.path}")
+
+def search_cli(args):
+    import app
+    serve_cli_version(app, args.version)
+    with open(args.image, 'rb') as f:
+        result = app.predict(f.read(), disable_cam_override=True, similar_k=args.k)
+    for case in result[-1] or []:
+        label = case.get('label') or f"({case.get('predicted_label', '-')})"  # parenthesized: unverified prediction
+        print(f"{case['score']:.4f}  {label:<22} {case.get('source', '-'):<10} {case.get('id')}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and query the similar-case embedding index.")
+    parser.add_argument('--version', type=str, default=None, help='Model version whose index to use (default: MODEL_VERSION)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='Add labelled reference images')
+    add_parser.add_argument('--data_dir', type=str, required=True, help='<data_dir>/<CLASS_NAME>/*.jpeg')
+    add_parser.add_argument('--batch_size', type=int, default=16)
+    add_parser.set_defaults(func=add_reference)
+    ivf_parser = subparsers.add_parser('train-ivf', help='Partition the index into IVF lists')
+    ivf_parser.add_argument('--lists', type=int, default=None, help='Number of lists (default: ~4 * sqrt(rows))')
+    ivf_parser.add_argument('--iters', type=int, default=10)
+    ivf_parser.add_argument('--sample', type=int, default=100000, help='Rows used to fit the centroids')
+    search_parser = subparsers.add_parser('search', help='Nearest cases for one X-ray')
+    search_parser.add_argument('--image', type=str, required=True)
+    search_parser.add_argument('-k', type=int, default=5)
+    search_parser.set_defaults(func=search_cli)
+    args = parser.parse_args()
+    os.environ["SIMILAR_CASES"] = "1"
+    os.environ["EMBEDDING_CAPTURE"] = "0"  # CLI queries are not added to the index
+    if args.command == 'train-ivf':
+        from registry import MODEL_VERSION
+        index = get_index(args.version or MODEL_VERSION)
+        lists = args.lists or max(1, int(4 * math.sqrt(len(index))))
+        start = time.perf_counter()
+        index.train_ivf(lists, args.iters, args.sample)
+        print(f"[INDEX] Trained {lists} IVF lists over {len(index)} rows in {time.perf_counter() - start:.1f}s")
+    else:
+        args.func(args)
@@ -1,24 +1,49 @@
 # explain.py
+"""Grad-CAM overlays: one image per call for /predict, or batched for scoring a folder.
+
+Usage (batch scoring, one overlay per image plus predictions.csv):
+    python explain.py --data_dir chest_xray/test --out_dir gradcam [--version 2024-06-01]
+"""
 from PIL import Image
+import argparse
+import csv
 import io
 import torch
 import cv2
 import numpy as np
 from pytorch_grad_cam import GradCAM
 from pytorch_grad_cam.utils.image import show_cam_on_image, preprocess_image
-import traceback
 import gc
+import os
+import weakref
+
+from request_log import get_logger
+
+# Memory budget for the saved activations of one batched Grad-CAM chunk
+GRADCAM_CHUNK_MB = float(os.getenv("GRADCAM_CHUNK_MB", "512"))
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+# model -> {input shape: (fixed bytes, bytes per sample)} autograd saves for backward; weak so an
+# evicted or swapped-out model version drops its entry instead of lending it to a new module
+_SAVED_BYTES = weakref.WeakKeyDictionary()
+MB = 2 ** 20
+log = get_logger("gradcam")
 
-def get_grad_cam_optimized(model, image_bytes, target_layer, max_size=(224, 224)):
+def get_grad_cam_optimized(model, image_bytes, target_layer, max_size=(224, 224), image=None):
     """Generate Grad-CAM heatmap overlay with optimizations for memory and speed.
 
+    image: already decoded PIL image (e.g. from a DICOM upload); image_bytes is then not decoded.
+
     Returns: np.ndarray (RGB) or None if it fails.
     """
     try:
-        print("[GRAD-CAM] Starting optimized Grad-CAM generation...")
+        log.debug("Starting optimized Grad-CAM generation")
         
-        # Load and resize image efficiently
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        if image is None:
+            # Load and resize image efficiently (JPEGs are DCT-scaled while decoding)
+            image = Image.open(io.BytesIO(image_bytes))
+            image.draft('RGB', max_size)
+        image = image.convert('RGB')
         
         # Resize to max_size to reduce memory usage
         if image.size != max_size:
@@ -53,7 +78,7 @@ def get_grad_cam_optimized(model, image_bytes, target_layer, max_size=(224, 224)
                     torch.cuda.empty_cache()
                 
         except Exception as cam_error:
-            print(f"[GRAD-CAM] CAM generation error: {cam_error}")
+            log.warning("CAM generation error", extra={"error": str(cam_error)})
             return None
 
         # Restore training mode if needed
@@ -72,17 +97,161 @@ def get_grad_cam_optimized(model, image_bytes, target_layer, max_size=(224, 224)
         # Force garbage collection again to be safe
         gc.collect()
         
-        print("[GRAD-CAM] Optimized Grad-CAM generation complete")
+        log.debug("Optimized Grad-CAM generation complete")
         return visualization
         
-    except Exception as e:
-        print(f"[GRAD-CAM] ERROR: Optimized Grad-CAM failed: {e}")
-        traceback.print_exc()
+    except Exception:
+        log.error("Optimized Grad-CAM failed", exc_info=True)
         return None
 
-def get_grad_cam(model, image_bytes, target_layer):
+def get_grad_cam(model, image_bytes, target_layer, image=None):
     """Generate Grad-CAM heatmap overlay safely - wrapper for backward compatibility.
 
     Returns: np.ndarray (RGB) or None if it fails.
     """
-    return get_grad_cam_optimized(model, image_bytes, target_layer)
\ No newline at end of file
+    return get_grad_cam_optimized(model, image_bytes, target_layer, image=image)
+
+# --- Batched Grad-CAM ---
+def _cam_chunk(model, inputs, target_layer, target_classes):
+    """One forward + one backward for a chunk.
+
+    Returns (cams [n, H, W] in [0, 1], target classes [n], bytes autograd saved for the backward).
+    """
+    captured = {}
+    saved = 0
+
+    def hook(_module, _inputs, output):
+        captured['activations'] = output
+
+    def pack(tensor):
+        nonlocal saved
+        saved += tensor.numel() * tensor.element_size()
+        return tensor
+
+    handle = target_layer.register_forward_hook(hook)
+    try:
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            logits = model(inputs)
+            if target_classes is None:
+                target_classes = logits.argmax(1)
+            # Sum of each sample's own target score: one backward gives every sample its gradient
+            score = logits.gather(1, target_classes.view(-1, 1).to(logits.device)).sum()
+            activations = captured['activations']
+            gradients, = torch.autograd.grad(score, activations)
+    finally:
+        handle.remove()
+
+    with torch.no_grad():
+        weights = gradients.mean(dim=(2, 3), keepdim=True)
+        cams = torch.relu((weights * activations).sum(1, keepdim=True))
+        cams = torch.nn.functional.interpolate(cams, size=inputs.shape[-2:], mode='bilinear', align_corners=False)[:, 0]
+        # Per-image min-max scaling, as pytorch_grad_cam does for the single-image path
+        flat = cams.flatten(1)
+        low, high = flat.min(1).values.view(-1, 1, 1), flat.max(1).values.view(-1, 1, 1)
+        cams = (cams - low) / (high - low).clamp_min(1e-7)
+    return cams.float().cpu().numpy(), target_classes.cpu(), saved
+
+def get_grad_cam_batch(model, input_tensor, target_layer, target_classes=None, images=None, chunk_size=None):
+    """Grad-CAM for a stacked (N, 3, H, W) batch with one forward/backward per chunk.
+
+    target_classes: per-sample class indices (default: each sample's predicted class).
+    images: optional float RGB arrays in [0, 1] for the overlays (default: the
+    de-normalized input tensor).
+    chunk_size: samples per forward/backward; by default sized so the
+    activations kept for backward stay within GRADCAM_CHUNK_MB. The cost is
+    measured on the first two chunks (1 and 2 samples), whose difference is
+    the per-sample part; saved weights are the same in both and cancel out.
+
+    Returns: (heatmaps np.ndarray [N, H, W] in [0, 1], overlays list of RGB uint8 arrays, target classes tensor [N])
+    """
+    was_training = model.training
+    model.eval()
+    try:
+        n = input_tensor.shape[0]
+        if target_classes is not None:
+            target_classes = torch.as_tensor(target_classes).view(-1)
+            if len(target_classes) != n:
+                raise ValueError(f"Expected {n} target classes, got {len(target_classes)}")
+        shape = tuple(input_tensor.shape[1:])
+        sizing = _SAVED_BYTES.get(model, {}).get(shape) if chunk_size is None else None
+        measured = []
+
+        heatmaps, classes = [], []
+        start = 0
+        while start < n:
+            if chunk_size is not None:
+                size = chunk_size
+            elif sizing is not None:
+                fixed, per_sample = sizing
+                size = max(1, int((GRADCAM_CHUNK_MB * MB - fixed) // per_sample))
+            else:
+                size = len(measured) + 1  # measuring: 1 sample, then 2
+            chunk = input_tensor[start:start + size]
+            chunk_targets = None if target_classes is None else target_classes[start:start + size]
+            cams, chunk_classes, saved = _cam_chunk(model, chunk, target_layer, chunk_targets)
+            heatmaps.append(cams)
+            classes.append(chunk_classes)
+            start += len(chunk)
+            if sizing is None and chunk_size is None and len(chunk) == len(measured) + 1:
+                measured.append(saved)
+                if len(measured) == 2:
+                    per_sample = max(1, measured[1] - measured[0])
+                    sizing = (max(0, measured[0] - per_sample), per_sample)
+                    _SAVED_BYTES.setdefault(model, {})[shape] = sizing
+        log.info("Batched Grad-CAM", extra={"images": n, "chunks": len(heatmaps),
+                                            "mb_per_sample": round(sizing[1] / MB, 2) if sizing else None})
+        heatmaps = np.concatenate(heatmaps)
+
+        if images is None:
+            mean = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1)
+            std = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1)
+            images = (input_tensor.detach().cpu() * std + mean).clamp(0, 1).permute(0, 2, 3, 1).numpy()
+        overlays = [
+            show_cam_on_image(np.float32(image), heatmap, use_rgb=True, colormap=cv2.COLORMAP_JET, image_weight=0.6)
+            for image, heatmap in zip(images, heatmaps)
+        ]
+        return heatmaps, overlays, torch.cat(classes)
+    finally:
+        if was_training:
+            model.train()
+
+# --- CLI ---
+def explain_folder(args):
+    """Score a labelled <data_dir>/<CLASS_NAME>/*.jpeg folder and write a Grad-CAM overlay per image."""
+    import app
+    from datasets import ImageTensorDataset
+    from embedding_index import serve_cli_version
+    from models import CLASS_NAMES
+    version = serve_cli_version(app, args.version)
+    cam_model = app.get_cam_model(version)
+    dataset = ImageTensorDataset(args.data_dir)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=2)
+    rows, row = [], 0
+    for inputs, labels in loader:
+        inputs = inputs.to(app.DEVICE)
+        probs, _ = app.ensemble_probs(inputs, version, cascade=False)
+        confidence, predicted = probs.max(1)
+        # CAM of the class the ensemble predicted, not the CAM model's own argmax
+        _, overlays, _ = get_grad_cam_batch(cam_model, inputs, cam_model.features[-1], target_classes=predicted)
+        for i, overlay in enumerate(overlays):
+            name = os.path.relpath(dataset.file_paths[row + i], args.data_dir)
+            out_path = os.path.join(args.out_dir, os.path.splitext(name)[0] + '.png')
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            cv2.imwrite(out_path, cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
+            rows.append((name, CLASS_NAMES[int(labels[i])], CLASS_NAMES[int(predicted[i])],
+                         f"{100 * confidence[i].item():.2f}"))
+        row += len(inputs)
+        print(f"[GRADCAM] {row}/{len(dataset)} images explained", end="\r")
+    with open(os.path.join(args.out_dir, 'predictions.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["image", "label", "prediction", "confidence"])
+        writer.writerows(rows)
+    print(f"\n[GRADCAM] Overlays and predictions.csv written to {args.out_dir} (version '{version.name}')")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch-score a labelled folder with batched Grad-CAM overlays.")
+    parser.add_argument('--data_dir', type=str, required=True, help='<data_dir>/<CLASS_NAME>/*.jpeg')
+    parser.add_argument('--out_dir', type=str, default='gradcam', help='Where the overlays and predictions.csv go')
+    parser.add_argument('--version', type=str, default=None, help='Model version to score with (default: MODEL_VERSION)')
+    parser.add_argument('--batch_size', type=int, default=32, help='Images per ensemble forward (Grad-CAM chunks itself)')
+    explain_folder(parser.parse_args())
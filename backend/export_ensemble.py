@@ -0,0 +1,100 @@
+# export_ensemble.py
+"""Export both ensemble members plus the weighted fusion as one frozen TorchScript graph.
+
+Usage:
+    python export_ensemble.py --out ensemble_frozen.pt
+
+Serve it with INFERENCE_BACKEND=torchscript (ENSEMBLE_ARTIFACT points at the file).
+Fusion weights and temperatures come from ensemble_config.json (tune_ensemble.py)
+when present, so re-export after re-tuning.
+"""
+import argparse
+import json
+import time
+import torch
+
+from models import (CLASS_NAMES, CONVNEXT_PATH, EFFICIENTNET_PATH, ENSEMBLE_CONFIG_PATH,
+                    INPUT_SIZE, EnsembleNet, build_convnext, build_efficientnet,
+                    load_ensemble_config)
+
+# Name of the metadata file stored inside the TorchScript archive
+ARTIFACT_META = 'ensemble.json'
+
+def export_frozen_ensemble(out_path, convnext_path=CONVNEXT_PATH, efficientnet_path=EFFICIENTNET_PATH,
+                           config=None, parallel=False):
+    """Trace, freeze and optimize the ensemble, then save it to out_path.
+
+    config is a load_ensemble_config() dict (defaults to ensemble_config.json).
+    parallel=True scripts the fusion wrapper around the traced members so the
+    torch.jit.fork in EnsembleNet runs both backbones concurrently.
+    """
+    config = config or load_ensemble_config()
+    fusion = dict(
+        convnext_weight=config['convnext_weight'],
+        efficientnet_weight=config['efficientnet_weight'],
+        convnext_temperature=config['convnext_temperature'],
+        efficientnet_temperature=config['efficientnet_temperature'],
+    )
+    convnext = build_convnext(convnext_path)
+    efficientnet = build_efficientnet(efficientnet_path)
+    ensemble = EnsembleNet(convnext, efficientnet, **fusion).eval()
+    example = torch.randn(1, 3, INPUT_SIZE, INPUT_SIZE)
+
+    with torch.no_grad():
+        if parallel:
+            graph = torch.jit.script(EnsembleNet(
+                torch.jit.trace(convnext, example),
+                torch.jit.trace(efficientnet, example),
+                parallel=True,
+                **fusion,
+            ).eval())
+        else:
+            graph = torch.jit.trace(ensemble, example)
+        # freeze() inlines weights/attributes as constants; optimize_for_inference
+        # then folds conv+bn, fuses ops and pre-packs weights for the CPU kernels.
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(graph.eval()))
+
+        # Sanity check: the frozen graph must agree with the eager ensemble
+        max_diff = (frozen(example) - ensemble(example)).abs().max().item()
+        if max_diff > 1e-4:
+            raise RuntimeError(f"Frozen ensemble diverges from eager model (max diff {max_diff:.2e})")
+
+    meta = {
+        "class_names": CLASS_NAMES,
+        **{key: float(value) for key, value in fusion.items()},
+        "input_size": INPUT_SIZE,
+        "parallel": bool(parallel),
+        "torch_version": torch.__version__,
+    }
+    torch.jit.save(frozen, out_path, _extra_files={ARTIFACT_META: json.dumps(meta)})
+    return max_diff
+
+def load_frozen_ensemble(path, device='cpu', warmup_runs=2):
+    """Load a frozen ensemble artifact and run a few warm-up passes.
+
+    Returns: (module, metadata dict)
+    """
+    extra_files = {ARTIFACT_META: ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    meta = json.loads(extra_files[ARTIFACT_META] or '{}')
+    # The profiling executor specializes the graph on the first calls, so pay
+    # that cost at startup rather than on the first real request.
+    example = torch.zeros(1, 3, meta.get("input_size", INPUT_SIZE), meta.get("input_size", INPUT_SIZE), device=device)
+    with torch.no_grad():
+        for _ in range(warmup_runs):
+            module(example)
+    return module, meta
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the ensemble as a frozen TorchScript artifact.")
+    parser.add_argument('--out', type=str, default='ensemble_frozen.pt', help='Output artifact path')
+    parser.add_argument('--convnext_path', type=str, default=CONVNEXT_PATH, help='ConvNeXt checkpoint')
+    parser.add_argument('--efficientnet_path', type=str, default=EFFICIENTNET_PATH, help='EfficientNet checkpoint')
+    parser.add_argument('--config', type=str, default=ENSEMBLE_CONFIG_PATH, help='Fusion settings from tune_ensemble.py')
+    parser.add_argument('--parallel', action='store_true', help='Run the two backbones concurrently inside the graph')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    diff = export_frozen_ensemble(args.out, args.convnext_path, args.efficientnet_path,
+                                  config=load_ensemble_config(args.config), parallel=args.parallel)
+    print(f"[EXPORT] Saved frozen ensemble to {args.out} in {time.perf_counter() - start:.1f}s (max diff vs eager: {diff:.2e})")
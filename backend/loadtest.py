@@ -0,0 +1,194 @@
+# loadtest.py
+"""Load test /predict under many idle and slow connections: Flask mode vs ASGI mode.
+
+Three kinds of clients run at once against each server:
+  - idle:   open a connection, send half the request headers and wait
+  - slow:   upload an X-ray at --slow_bps bytes/s (a phone on a bad link)
+  - active: --clients loops posting the X-ray until --requests are done
+Throughput and latency are taken from the active clients only; the idle and
+slow connections measure what holding them costs the server (threads, RSS).
+
+Usage:
+    python loadtest.py --launch flask asgi --idle 500 --slow 20
+    python loadtest.py --target flask=http://127.0.0.1:5000 --target asgi=http://127.0.0.1:5001
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+SERVERS = {
+    "flask": [sys.executable, "app.py"],
+    "asgi": [sys.executable, "asgi_app.py"],
+}
+
+# --- Minimal HTTP/1.1 client over asyncio streams (no third-party client needed) ---
+def multipart_request(host, port, image_bytes, disable_cam, fields=None):
+    boundary = uuid.uuid4().hex
+    fields = dict(fields or {}, disable_cam='true' if disable_cam else 'false')
+    body = ("".join(f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n"
+                    for name, value in fields.items()) +
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"xray.jpg\"\r\n"
+            f"Content-Type: image/jpeg\r\n\r\n").encode() + image_bytes + f"\r\n--{boundary}--\r\n".encode()
+    head = (f"POST /predict HTTP/1.1\r\nHost: {host}:{port}\r\nConnection: close\r\n"
+            f"Content-Type: multipart/form-data; boundary={boundary}\r\nContent-Length: {len(body)}\r\n\r\n").encode()
+    return head, body
+
+async def post(host, port, head, body, bps=None):
+    """Send one request (throttled to bps if given) and return the HTTP status."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(head)
+        if bps:
+            chunk = max(1, bps // 10)
+            for i in range(0, len(body), chunk):
+                writer.write(body[i:i + chunk])
+                await writer.drain()
+                await asyncio.sleep(0.1)
+        else:
+            writer.write(body)
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()  # Connection: close, so the body ends at EOF
+        return int(status_line.split()[1]) if status_line else 0
+    finally:
+        writer.close()
+
+async def hold_idle(host, port, stop, opened):
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        return
+    opened.append(1)
+    writer.write(f"POST /predict HTTP/1.1\r\nHost: {host}:{port}\r\n".encode())
+    await stop.wait()
+    writer.close()
+
+# --- One scenario against one server ---
+def server_stats(pid):
+    """Threads and RSS (MB) of a launched server from /proc, if available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["Threads"]), int(fields["VmRSS"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+async def run_scenario(url, image_bytes, args, pid=None):
+    parsed = urllib.parse.urlparse(url)
+    host, port = parsed.hostname, parsed.port or 80
+    head, body = multipart_request(host, port, image_bytes, not args.cam)
+
+    stop = asyncio.Event()
+    opened = []
+    idle = [asyncio.create_task(hold_idle(host, port, stop, opened)) for _ in range(args.idle)]
+    slow = [asyncio.create_task(post(host, port, head, body, args.slow_bps)) for _ in range(args.slow)]
+    await asyncio.sleep(1.0)  # let the idle / slow connections settle before timing
+    threads, rss = server_stats(pid) if pid else (None, None)
+
+    latencies, errors = [], 0
+    remaining = [args.requests]
+
+    async def client():
+        nonlocal errors
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(post(host, port, head, body), args.timeout)
+            except (OSError, asyncio.TimeoutError):
+                status = 0
+            if status == 200:
+                latencies.append(1000 * (time.perf_counter() - start))
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.clients)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for task in slow:
+        task.cancel()
+    await asyncio.gather(*idle, *slow, return_exceptions=True)
+
+    latencies.sort()
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] if latencies else float('nan'),
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else float('nan'),
+        "mean_ms": statistics.mean(latencies) if latencies else float('nan'),
+        "errors": errors,
+        "idle_open": len(opened),
+        "threads": threads,
+        "rss_mb": rss,
+    }
+
+def wait_healthy(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=2) as response:
+                if b'"ok"' in response.read():
+                    return
+        except OSError:
+            pass
+        time.sleep(1)
+    raise RuntimeError(f"{url} did not become healthy within {timeout}s")
+
+def main(args):
+    with open(args.image, 'rb') as f:
+        image_bytes = f.read()
+    targets = [tuple(target.split("=", 1)) for target in args.target]
+    rows = []
+    for name, url in targets:
+        print(f"[LOADTEST] {name}: {url}")
+        rows.append((name, asyncio.run(run_scenario(url, image_bytes, args))))
+    for i, name in enumerate(args.launch):
+        port = args.port + i
+        url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, PORT=str(port))
+        server = subprocess.Popen(SERVERS[name], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            print(f"[LOADTEST] Launched {name} on {url}, waiting for /health...")
+            wait_healthy(url, args.startup_timeout)
+            rows.append((name, asyncio.run(run_scenario(url, image_bytes, args, server.pid))))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"\n{args.idle} idle + {args.slow} slow ({args.slow_bps} B/s) connections, "
+          f"{args.clients} active clients, {args.requests} requests ({'with' if args.cam else 'without'} Grad-CAM)")
+    print(f"{'server':<10}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}{'idle open':>11}{'threads':>9}{'RSS MB':>8}")
+    print("-" * 72)
+    for name, stats in rows:
+        threads = stats['threads'] if stats['threads'] is not None else '-'
+        rss = f"{stats['rss_mb']:.0f}" if stats['rss_mb'] is not None else '-'
+        print(f"{name:<10}{stats['throughput']:>8.2f}{stats['p50_ms']:>9.0f}{stats['p95_ms']:>9.0f}"
+              f"{stats['errors']:>8}{stats['idle_open']:>11}{threads:>9}{rss:>8}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare Flask and ASGI serving under idle and slow connections.")
+    parser.add_argument('--launch', nargs='*', default=[], choices=sorted(SERVERS), help='Start these servers one after another')
+    parser.add_argument('--target', action='append', default=[], help='name=url of an already running server')
+    parser.add_argument('--port', type=int, default=5100, help='First port for launched servers')
+    parser.add_argument('--image', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archive',
+                                                                  'Real Data', 'xray1.jpg'), help='X-ray posted by every client')
+    parser.add_argument('--idle', type=int, default=200, help='Idle connections held open during the test')
+    parser.add_argument('--slow', type=int, default=10, help='Slow uploads in flight during the test')
+    parser.add_argument('--slow_bps', type=int, default=2000, help='Upload rate of the slow clients (bytes/s)')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent active clients')
+    parser.add_argument('--requests', type=int, default=40, help='Timed requests across the active clients')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Per-request timeout (s)')
+    parser.add_argument('--cam', action='store_true', help='Request Grad-CAM overlays')
+    parser.add_argument('--startup_timeout', type=float, default=120.0, help='Seconds to wait for a launched server')
+    args = parser.parse_args()
+    if not args.launch and not args.target:
+        parser.error('give --launch and/or --target')
+    main(args)
@@ -0,0 +1,196 @@
+# memory_stats.py
+"""Per-stage memory accounting and the per-request memory budget.
+
+With MEMORY_PROFILE=1 every `with MEMORY.stage(name):` block records:
+  - rss_mb:  peak resident set size during the stage minus RSS at its start,
+             sampled by one background thread (covers the torch CPU allocator,
+             OpenCV and PIL buffers that Python's tracemalloc cannot see)
+  - py_mb:   tracemalloc peak of Python / NumPy allocations during the stage
+  - cuda_mb: torch.cuda peak allocated memory (CUDA devices only)
+tracemalloc peaks and RSS are process-wide, so stages of concurrent requests
+overlap; profile with one request at a time for clean numbers.
+
+MEMORY_BUDGET_MB (0 = off) bounds the estimated peak of a request before the
+image is decoded; MEMORY_BUDGET_ACTION=downscale decodes oversized JPEGs at
+reduced resolution (what still does not fit is refused), "reject" refuses them.
+"""
+import contextlib
+import os
+import resource
+import threading
+import time
+import tracemalloc
+import torch
+
+from request_log import get_logger
+
+MEMORY_PROFILE = os.getenv("MEMORY_PROFILE", "0") == "1"
+MEMORY_SAMPLE_MS = float(os.getenv("MEMORY_SAMPLE_MS", "2"))
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_BUDGET_ACTION = os.getenv("MEMORY_BUDGET_ACTION", "downscale").lower()
+# Working set of one ensemble forward per 224x224 view (activations + softmax); check with benchmark.py memory
+FORWARD_MB_PER_VIEW = float(os.getenv("FORWARD_MB_PER_VIEW", "150"))
+MB = 2 ** 20
+log = get_logger("memory")
+if MEMORY_BUDGET_ACTION not in ("downscale", "reject"):
+    raise ValueError(f"MEMORY_BUDGET_ACTION must be 'downscale' or 'reject', got '{MEMORY_BUDGET_ACTION}'")
+
+class MemoryBudgetExceeded(ValueError):
+    """The request would exceed MEMORY_BUDGET_MB even after downscaling."""
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def current_rss():
+    """Resident set size in bytes (falls back to the peak where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return max_rss()
+
+def max_rss():
+    """Peak RSS of the process so far, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class _Window:
+    __slots__ = ('start_rss', 'peak_rss')
+
+    def __init__(self, rss):
+        self.start_rss = rss
+        self.peak_rss = rss
+
+class MemoryProfiler:
+    def __init__(self, enabled=MEMORY_PROFILE, sample_ms=MEMORY_SAMPLE_MS):
+        self.enabled = enabled
+        self.sample_s = sample_ms / 1000.0
+        self.lock = threading.Lock()
+        self.active = set()
+        self.sampler = None
+        self.stats = {}
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _sample(self):
+        # One sampler for all active stages; exits when nothing is being measured
+        while True:
+            rss = current_rss()
+            with self.lock:
+                if not self.active:
+                    self.sampler = None
+                    return
+                for window in self.active:
+                    window.peak_rss = max(window.peak_rss, rss)
+            time.sleep(self.sample_s)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        window = _Window(current_rss())
+        with self.lock:
+            self.active.add(window)
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample, name="memory-sampler", daemon=True)
+                self.sampler.start()
+        py_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        cuda = torch.cuda.is_available()
+        if cuda:
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            yield
+        finally:
+            py_peak = max(0, tracemalloc.get_traced_memory()[1] - py_start)
+            cuda_peak = torch.cuda.max_memory_allocated() if cuda else 0
+            window.peak_rss = max(window.peak_rss, current_rss())
+            with self.lock:
+                self.active.discard(window)
+                self._record(name, (window.peak_rss - window.start_rss) / MB, py_peak / MB, cuda_peak / MB)
+
+    def _record(self, name, rss_mb, py_mb, cuda_mb):
+        entry = self.stats.setdefault(name, {"count": 0, "rss_mb": {}, "py_mb": {}, "cuda_mb": {}})
+        entry["count"] += 1
+        for key, value in (("rss_mb", rss_mb), ("py_mb", py_mb), ("cuda_mb", cuda_mb)):
+            agg = entry[key]
+            agg["last"] = round(value, 2)
+            agg["max"] = round(max(agg.get("max", value), value), 2)
+            agg["total"] = agg.get("total", 0.0) + value
+            agg["mean"] = round(agg["total"] / entry["count"], 2)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def snapshot(self, top=10):
+        """Per-stage aggregates plus process RSS and the largest traced allocation sites."""
+        with self.lock:
+            stages = {name: {"count": entry["count"],
+                             **{key: {k: v for k, v in entry[key].items() if k != "total"}
+                                for key in ("rss_mb", "py_mb", "cuda_mb")}}
+                      for name, entry in self.stats.items()}
+        report = {
+            "enabled": self.enabled,
+            "rss_mb": round(current_rss() / MB, 1),
+            "max_rss_mb": round(max_rss() / MB, 1),
+            "budget_mb": MEMORY_BUDGET_MB,
+            "budget_action": MEMORY_BUDGET_ACTION,
+            "stages": stages,
+        }
+        if self.enabled:
+            report["top_allocations"] = [
+                {"site": str(stat.traceback[0]), "size_mb": round(stat.size / MB, 2), "count": stat.count}
+                for stat in tracemalloc.take_snapshot().statistics('lineno')[:top]
+            ]
+        return report
+
+# --- Per-request budget ---
+def estimate_request_mb(width, height, views=1):
+    """Estimated peak for one request: decoded RGB plus the converted copy, then the model forwards."""
+    return 2 * width * height * 3 / MB + views * FORWARD_MB_PER_VIEW
+
+def check_decode_budget(decoded_bytes, views=1, budget_mb=MEMORY_BUDGET_MB, what="image"):
+    """Raise MemoryBudgetExceeded if decoding `decoded_bytes` of pixels plus the forwards cannot fit.
+
+    For inputs that cannot be decoded at reduced size (DICOM pixel data), so
+    the check has to happen on the header before anything is decoded.
+    """
+    if not budget_mb:
+        return
+    estimate = decoded_bytes / MB + views * FORWARD_MB_PER_VIEW
+    if estimate > budget_mb:
+        raise MemoryBudgetExceeded(f"Request needs ~{estimate:.0f} MB ({what}, {views} view(s)); "
+                                   f"budget is {budget_mb:.0f} MB")
+
+def fit_budget(image, views=1, budget_mb=MEMORY_BUDGET_MB, action=MEMORY_BUDGET_ACTION):
+    """Check a lazily opened PIL image against the budget before it is decoded.
+
+    Downscaling only uses the JPEG decoder's draft mode (DCT scaling), so the
+    full resolution image is never materialized. Raises MemoryBudgetExceeded
+    when the request cannot fit, including when draft() cannot shrink it
+    enough (other formats, or more than the decoder's 1/8 scale).
+    """
+    if not budget_mb:
+        return image
+    width, height = image.size
+    estimate = estimate_request_mb(width, height, views)
+    if estimate <= budget_mb:
+        return image
+    pixel_budget_mb = budget_mb - views * FORWARD_MB_PER_VIEW
+    if action == "reject" or pixel_budget_mb <= 0:
+        raise MemoryBudgetExceeded(f"Request needs ~{estimate:.0f} MB ({width}x{height}, {views} view(s)); "
+                                   f"budget is {budget_mb:.0f} MB")
+    scale = (pixel_budget_mb * MB / (2 * width * height * 3)) ** 0.5
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    # draft() picks the largest power-of-two scale that stays at or above the requested
+    # size, so asking for half the target lands between half the target and the target
+    image.draft('RGB', (max(1, target[0] // 2), max(1, target[1] // 2)))
+    decoded = estimate_request_mb(*image.size, views)
+    if decoded > budget_mb:
+        raise MemoryBudgetExceeded(f"Request needs ~{decoded:.0f} MB ({image.size[0]}x{image.size[1]} after "
+                                   f"draft decoding {width}x{height}, {views} view(s)); budget is {budget_mb:.0f} MB")
+    log.info("Downscaled image to fit the memory budget",
+             extra={"original": f"{width}x{height}", "decoded": f"{image.size[0]}x{image.size[1]}", "budget_mb": budget_mb})
+    return image
+
+MEMORY = MemoryProfiler()
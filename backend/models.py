@@ -0,0 +1,210 @@
+# models.py
+import json
+import os
+import threading
+import weakref
+import torch
+import torch.nn as nn
+from torchvision.models import convnext_tiny, efficientnet_v2_s, mobilenet_v3_large, mobilenet_v3_small
+from torchvision import transforms
+
+# --- Shared model settings (used by app.py and the offline tools) ---
+CLASS_NAMES = ['BACTERIAL_PNEUMONIA', 'NORMAL', 'VIRAL_PNEUMONIA']
+CONVNEXT_WEIGHT = 0.4
+EFFICIENTNET_WEIGHT = 0.6
+RISK_THRESHOLD = 70.0  # % confidence below which get_risk_level reports "Indeterminate"
+# Tuned weights / temperatures / risk threshold written by tune_ensemble.py
+ENSEMBLE_CONFIG_PATH = os.getenv('ENSEMBLE_CONFIG', 'ensemble_config.json')
+# Overridable so pruned checkpoints (archive/training/prune.py) can be served
+CONVNEXT_PATH = os.getenv('CONVNEXT_PATH', 'convnext_pneumonia.pth')
+EFFICIENTNET_PATH = os.getenv('EFFICIENTNET_PATH', 'efficientnet_pneumonia.pth')
+# Distilled single-model student (archive/training/distill.py), served as the "fast" tier
+STUDENT_ARCHITECTURES = {'mobilenet_v3_large': mobilenet_v3_large, 'mobilenet_v3_small': mobilenet_v3_small}
+INPUT_SIZE = 224
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+def load_ensemble_config(path=ENSEMBLE_CONFIG_PATH):
+    """Fusion settings from tune_ensemble.py, falling back to the defaults above for missing keys/file."""
+    config = {
+        'convnext_weight': CONVNEXT_WEIGHT,
+        'efficientnet_weight': EFFICIENTNET_WEIGHT,
+        'convnext_temperature': 1.0,
+        'efficientnet_temperature': 1.0,
+        'risk_threshold': RISK_THRESHOLD,
+    }
+    if path and os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+        config.update({key: float(stored[key]) for key in config if key in stored})
+    return config
+
+# Built once at import instead of on every request
+preprocess_transform = transforms.Compose([
+    transforms.Resize((INPUT_SIZE, INPUT_SIZE)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+])
+
+# --- Test-time augmentation ---
+# Views in the order they are added as num_views grows; "zoom" centre-crops and resizes back
+TTA_VIEWS = [(False, 1.0), (True, 1.0), (False, 0.9), (True, 0.9), (False, 0.8), (True, 0.8)]
+
+def tta_batch(input_tensor, num_views):
+    """Stack the first num_views TTA views of a preprocessed (1, 3, H, W) image into one (V, 3, H, W) batch."""
+    if not 1 <= num_views <= len(TTA_VIEWS):
+        raise ValueError(f"num_views must be between 1 and {len(TTA_VIEWS)}, got {num_views}")
+    size = input_tensor.shape[-2:]
+    views = []
+    for flip, scale in TTA_VIEWS[:num_views]:
+        view = input_tensor
+        if scale != 1.0:
+            h, w = int(round(size[0] * scale)), int(round(size[1] * scale))
+            top, left = (size[0] - h) // 2, (size[1] - w) // 2
+            view = torch.nn.functional.interpolate(view[..., top:top + h, left:left + w], size=size,
+                                                   mode='bilinear', align_corners=False)
+        if flip:
+            view = torch.flip(view, dims=[3])
+        views.append(view)
+    return torch.cat(views)
+
+def resize_to_state_dict(model, state_dict):
+    """Shrink Conv2d / Linear / BatchNorm2d layers in place to the shapes stored in state_dict.
+
+    Structured pruning removes channels, so a pruned checkpoint no longer fits
+    the stock torchvision layout; this rebuilds the affected layers (depthwise
+    convs keep groups == channels) so load_state_dict works unchanged.
+    """
+    for name, module in list(model.named_modules()):
+        weight = state_dict.get(f"{name}.weight")
+        if weight is None or not hasattr(module, 'weight') or weight.shape == module.weight.shape:
+            continue
+        if isinstance(module, nn.Conv2d):
+            depthwise = module.groups > 1 and module.groups == module.in_channels == module.out_channels
+            groups = weight.shape[0] if depthwise else module.groups
+            replacement = nn.Conv2d(weight.shape[1] * groups, weight.shape[0], module.kernel_size, module.stride,
+                                    module.padding, module.dilation, groups, module.bias is not None)
+        elif isinstance(module, nn.Linear):
+            replacement = nn.Linear(weight.shape[1], weight.shape[0], module.bias is not None)
+        elif isinstance(module, nn.BatchNorm2d):
+            replacement = nn.BatchNorm2d(weight.shape[0], module.eps, module.momentum)
+        else:
+            raise ValueError(f"Cannot resize {type(module).__name__} '{name}' to {tuple(weight.shape)}")
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(model.get_submodule(parent_name), child_name, replacement)
+    return model
+
+def _load_checkpoint(model, weights_path):
+    state_dict = torch.load(weights_path, map_location=torch.device('cpu'), weights_only=True)
+    resize_to_state_dict(model, state_dict)
+    model.load_state_dict(state_dict)
+
+def build_convnext(weights_path=None, device='cpu'):
+    """Build ConvNeXt-Tiny with the 3-class head, optionally loading a checkpoint."""
+    model = convnext_tiny(weights=None)
+    num_ftrs = model.classifier[2].in_features
+    model.classifier[2] = nn.Linear(num_ftrs, len(CLASS_NAMES))
+    if weights_path:
+        _load_checkpoint(model, weights_path)
+    return model.to(device).eval()
+
+def build_efficientnet(weights_path=None, device='cpu'):
+    """Build EfficientNetV2-S with the 3-class head, optionally loading a checkpoint."""
+    model = efficientnet_v2_s(weights=None)
+    num_ftrs = model.classifier[1].in_features
+    model.classifier[1] = nn.Linear(num_ftrs, len(CLASS_NAMES))
+    if weights_path:
+        _load_checkpoint(model, weights_path)
+    return model.to(device).eval()
+
+def build_student(weights_path=None, device='cpu', arch='mobilenet_v3_large'):
+    """Build the distilled MobileNetV3 student with the 3-class head, optionally loading a checkpoint."""
+    if arch not in STUDENT_ARCHITECTURES:
+        raise ValueError(f"Unknown student architecture '{arch}', expected one of {sorted(STUDENT_ARCHITECTURES)}")
+    model = STUDENT_ARCHITECTURES[arch](weights=None)
+    num_ftrs = model.classifier[3].in_features
+    model.classifier[3] = nn.Linear(num_ftrs, len(CLASS_NAMES))
+    if weights_path:
+        model.load_state_dict(torch.load(weights_path, map_location=torch.device('cpu'), weights_only=True))
+    return model.to(device).eval()
+
+class EnsembleNet(nn.Module):
+    """Both ensemble members plus the weighted softmax fusion done in predict().
+
+    With parallel=True the ConvNeXt forward is forked so that, once scripted,
+    both members run concurrently on the inter-op pool (eager mode runs the fork inline).
+    """
+
+    def __init__(self, convnext, efficientnet, convnext_weight=CONVNEXT_WEIGHT, efficientnet_weight=EFFICIENTNET_WEIGHT,
+                 parallel: bool = False, convnext_temperature=1.0, efficientnet_temperature=1.0):
+        super().__init__()
+        self.convnext = convnext
+        self.efficientnet = efficientnet
+        self.convnext_weight = float(convnext_weight)
+        self.efficientnet_weight = float(efficientnet_weight)
+        self.parallel = parallel
+        self.convnext_temperature = float(convnext_temperature)
+        self.efficientnet_temperature = float(efficientnet_temperature)
+
+    def forward(self, x):
+        if self.parallel:
+            future = torch.jit.fork(self.convnext, x)
+            outputs2 = self.efficientnet(x)
+            outputs1 = torch.jit.wait(future)
+        else:
+            outputs1 = self.convnext(x)
+            outputs2 = self.efficientnet(x)
+        probs1 = torch.nn.functional.softmax(outputs1 / self.convnext_temperature, dim=1)
+        probs2 = torch.nn.functional.softmax(outputs2 / self.efficientnet_temperature, dim=1)
+        return (self.convnext_weight * probs1) + (self.efficientnet_weight * probs2)
+
+class MemberPair(nn.Module):
+    """Both members' logits, with the ConvNeXt forward forked (concurrent once traced)."""
+
+    def __init__(self, convnext, efficientnet):
+        super().__init__()
+        self.convnext = convnext
+        self.efficientnet = efficientnet
+
+    def forward(self, x):
+        future = torch.jit.fork(self.convnext, x)
+        outputs2 = self.efficientnet(x)
+        return torch.jit.wait(future), outputs2
+
+def threads_on_fresh_thread():
+    """torch.get_num_threads() as a newly started request thread would see it."""
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(torch.get_num_threads()))
+    thread.start()
+    thread.join()
+    return seen[0]
+
+class ParallelMembers:
+    """Runs the two member forwards concurrently from the calling thread.
+
+    The members are traced once into a MemberPair graph whose fork runs on the
+    inter-op pool, so both forwards share the one intra-op pool and nothing
+    changes torch's process-wide thread count (which every request thread,
+    Grad-CAM and the fast tier included, would pick up). The traced graph
+    shares the members' parameters; it is cached per ConvNeXt module (weakly,
+    so an evicted model version frees it).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.traced = weakref.WeakKeyDictionary()  # convnext module -> (efficientnet module, traced pair)
+
+    def _pair(self, convnext, efficientnet, input_tensor):
+        with self.lock:
+            entry = self.traced.get(convnext)
+            if entry is None or entry[0] is not efficientnet:
+                with torch.no_grad():
+                    pair = torch.jit.trace(MemberPair(convnext, efficientnet).eval(), input_tensor, check_trace=False)
+                entry = self.traced[convnext] = (efficientnet, pair)
+            return entry[1]
+
+    def run(self, convnext, efficientnet, input_tensor):
+        """Returns (convnext_logits, efficientnet_logits)."""
+        pair = self._pair(convnext, efficientnet, input_tensor)
+        with torch.no_grad():
+            return pair(input_tensor)
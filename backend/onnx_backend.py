@@ -0,0 +1,98 @@
+# onnx_backend.py
+"""ONNX Runtime inference backend for the two ensemble members.
+
+Usage:
+    python onnx_backend.py --out_dir .   # writes convnext_pneumonia.onnx / efficientnet_pneumonia.onnx
+
+Serve with INFERENCE_BACKEND=onnx. Session options come from the environment:
+    ORT_INTRA_OP_THREADS, ORT_INTER_OP_THREADS (0 = let ONNX Runtime decide)
+    ORT_GRAPH_OPT_LEVEL  (disable | basic | extended | all)
+    ORT_EXECUTION_MODE   (sequential | parallel)
+"""
+import argparse
+import os
+import torch
+
+from models import CONVNEXT_PATH, EFFICIENTNET_PATH, INPUT_SIZE, build_convnext, build_efficientnet
+
+ONNX_CONVNEXT = os.getenv("ONNX_CONVNEXT", "convnext_pneumonia.onnx")
+ONNX_EFFICIENTNET = os.getenv("ONNX_EFFICIENTNET", "efficientnet_pneumonia.onnx")
+ONNX_OPSET = 17
+
+def export_onnx(model, out_path, opset=ONNX_OPSET):
+    """Export one member to ONNX with a dynamic batch dimension."""
+    example = torch.randn(1, 3, INPUT_SIZE, INPUT_SIZE)
+    with torch.no_grad():
+        torch.onnx.export(
+            model.eval(),
+            example,
+            out_path,
+            input_names=['input'],
+            output_names=['logits'],
+            dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+
+def session_options_from_env():
+    """Build ONNX Runtime SessionOptions from the ORT_* environment variables."""
+    import onnxruntime as ort
+
+    opt_levels = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+    level = os.getenv("ORT_GRAPH_OPT_LEVEL", "all").lower()
+    if level not in opt_levels:
+        raise ValueError(f"ORT_GRAPH_OPT_LEVEL must be one of {sorted(opt_levels)}, got '{level}'")
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = int(os.getenv("ORT_INTRA_OP_THREADS", "0"))
+    options.inter_op_num_threads = int(os.getenv("ORT_INTER_OP_THREADS", "0"))
+    options.graph_optimization_level = opt_levels[level]
+    if os.getenv("ORT_EXECUTION_MODE", "sequential").lower() == "parallel":
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    else:
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+class OnnxMember:
+    """Callable wrapper so an ONNX session can stand in for an eager member in predict()."""
+
+    def __init__(self, onnx_path, options=None):
+        import onnxruntime as ort
+
+        self.path = onnx_path
+        self.session = ort.InferenceSession(
+            onnx_path,
+            sess_options=options or session_options_from_env(),
+            providers=['CPUExecutionProvider'],
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input_tensor):
+        """Run the session on a (N, 3, H, W) tensor and return logits as a torch tensor."""
+        array = input_tensor.detach().cpu().numpy()
+        logits = self.session.run(None, {self.input_name: array})[0]
+        return torch.from_numpy(logits)
+
+def load_onnx_members(convnext_path=ONNX_CONVNEXT, efficientnet_path=ONNX_EFFICIENTNET):
+    """Create ONNX Runtime sessions for both members. Returns (convnext, efficientnet)."""
+    options = session_options_from_env()
+    return OnnxMember(convnext_path, options), OnnxMember(efficientnet_path, options)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export both ensemble members to ONNX.")
+    parser.add_argument('--out_dir', type=str, default='.', help='Directory for the .onnx files')
+    parser.add_argument('--opset', type=int, default=ONNX_OPSET, help='ONNX opset version')
+    args = parser.parse_args()
+
+    for name, builder, weights in [
+        ('convnext_pneumonia.onnx', build_convnext, CONVNEXT_PATH),
+        ('efficientnet_pneumonia.onnx', build_efficientnet, EFFICIENTNET_PATH),
+    ]:
+        out_path = os.path.join(args.out_dir, name)
+        export_onnx(builder(weights), out_path, args.opset)
+        print(f"[EXPORT] Saved {out_path}")
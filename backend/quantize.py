@@ -0,0 +1,125 @@
+# quantize.py
+"""INT8 post-training quantization for the two ensemble members.
+
+Convolutions are statically quantized (FX graph mode, observers calibrated on
+a labelled X-ray folder); Linear layers, including the ConvNeXt block MLPs,
+are dynamically quantized. Each member is evaluated per class against its
+float model and is only written out if the accuracy drop stays within
+--max_accuracy_drop.
+
+Usage:
+    python quantize.py --calib_dir chest_xray/train --eval_dir chest_xray/val
+
+Serve the result with INFERENCE_BACKEND=int8.
+"""
+import argparse
+import copy
+import io
+import os
+import sys
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from benchmark import time_fn
+from datasets import collect_logits, make_loader, per_class_accuracy
+from models import CLASS_NAMES, CONVNEXT_PATH, EFFICIENTNET_PATH, INPUT_SIZE, build_convnext, build_efficientnet
+
+INT8_CONVNEXT = os.getenv("INT8_CONVNEXT", "convnext_pneumonia_int8.pt")
+INT8_EFFICIENTNET = os.getenv("INT8_EFFICIENTNET", "efficientnet_pneumonia_int8.pt")
+
+def quantize_member(model, calib_loader, num_batches=32, engine='x86'):
+    """Static-quantize convs, dynamic-quantize Linear layers. Returns a TorchScript module."""
+    torch.backends.quantized.engine = engine
+    example = torch.randn(1, 3, INPUT_SIZE, INPUT_SIZE)
+
+    # Linear layers are left out of the static config and handled dynamically below
+    qconfig_mapping = get_default_qconfig_mapping(engine).set_object_type(nn.Linear, None)
+    prepared = prepare_fx(copy.deepcopy(model).eval(), qconfig_mapping, (example,))
+    with torch.no_grad():
+        for batch_idx, (inputs, _) in enumerate(calib_loader):
+            if batch_idx >= num_batches:
+                break
+            prepared(inputs)
+    quantized = convert_fx(prepared)
+    quantized = quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(quantized.eval(), example))
+
+def load_int8_members(convnext_path=INT8_CONVNEXT, efficientnet_path=INT8_EFFICIENTNET):
+    """Load the quantized TorchScript members written by this tool. Returns (convnext, efficientnet)."""
+    return torch.jit.load(convnext_path, map_location='cpu'), torch.jit.load(efficientnet_path, map_location='cpu')
+
+def serialized_mb(module):
+    """Size of a module's serialized form in MB (state_dict for eager, archive for TorchScript)."""
+    buffer = io.BytesIO()
+    if isinstance(module, torch.jit.ScriptModule):
+        torch.jit.save(module, buffer)
+    else:
+        torch.save(module.state_dict(), buffer)
+    return buffer.tell() / (1024 * 1024)
+
+def compare(name, float_model, int8_model, eval_loader, runs):
+    """Print the per-class accuracy delta and latency/size savings. Returns the worst drop (pp)."""
+    float_logits, labels = collect_logits(float_model, eval_loader)
+    int8_logits, _ = collect_logits(int8_model, eval_loader)
+    float_acc = per_class_accuracy(float_logits.argmax(1), labels)
+    int8_acc = per_class_accuracy(int8_logits.argmax(1), labels)
+
+    first_batch, _ = next(iter(eval_loader))
+    samples = list(first_batch.split(1))
+    float_lat = time_fn(float_model, samples, runs)
+    int8_lat = time_fn(int8_model, samples, runs)
+    float_mb, int8_mb = serialized_mb(float_model), serialized_mb(int8_model)
+
+    print(f"\n=== {name} ===")
+    print(f"{'class':<22}{'fp32 (%)':>10}{'int8 (%)':>10}{'delta':>9}")
+    worst_drop = 0.0
+    for key in CLASS_NAMES + ['overall']:
+        delta = int8_acc[key] - float_acc[key]
+        if delta == delta:  # skip NaN for classes missing from the eval set
+            worst_drop = max(worst_drop, -delta)
+        print(f"{key:<22}{float_acc[key]:>10.2f}{int8_acc[key]:>10.2f}{delta:>+9.2f}")
+    print(f"latency p50: {float_lat['p50']:.1f} ms -> {int8_lat['p50']:.1f} ms ({float_lat['p50'] / int8_lat['p50']:.2f}x)")
+    print(f"model size:  {float_mb:.1f} MB -> {int8_mb:.1f} MB ({float_mb / int8_mb:.2f}x smaller)")
+    return worst_drop
+
+def main(args):
+    calib_loader = make_loader(args.calib_dir, batch_size=args.batch_size, shuffle=True)
+    eval_loader = make_loader(args.eval_dir, batch_size=args.batch_size)
+
+    rejected = []
+    for name, builder, weights, out_path in [
+        ('ConvNeXt-Tiny', build_convnext, args.convnext_path, args.convnext_out),
+        ('EfficientNetV2-S', build_efficientnet, args.efficientnet_path, args.efficientnet_out),
+    ]:
+        float_model = builder(weights)
+        print(f"[QUANT] Calibrating {name} on {args.calib_batches} batches from {args.calib_dir}...")
+        int8_model = quantize_member(float_model, calib_loader, args.calib_batches, args.engine)
+        worst_drop = compare(name, float_model, int8_model, eval_loader, args.runs)
+        if worst_drop > args.max_accuracy_drop:
+            print(f"[QUANT] REJECTED {name}: accuracy drop {worst_drop:.2f}pp exceeds {args.max_accuracy_drop:.2f}pp")
+            rejected.append(name)
+            continue
+        torch.jit.save(int8_model, out_path)
+        print(f"[QUANT] Saved {out_path}")
+
+    if rejected:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="INT8 post-training quantization of the ensemble members.")
+    parser.add_argument('--calib_dir', type=str, default=os.path.join('chest_xray', 'train'), help='Calibration images (class sub-folders)')
+    parser.add_argument('--eval_dir', type=str, default=os.path.join('chest_xray', 'val'), help='Evaluation images (class sub-folders)')
+    parser.add_argument('--calib_batches', type=int, default=32, help='Number of calibration batches')
+    parser.add_argument('--batch_size', type=int, default=16, help='Batch size for calibration and evaluation')
+    parser.add_argument('--max_accuracy_drop', type=float, default=1.0, help='Max allowed drop (percentage points) per class and overall')
+    parser.add_argument('--runs', type=int, default=20, help='Timed iterations for the latency comparison')
+    parser.add_argument('--engine', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'], help='Quantized kernel backend')
+    parser.add_argument('--convnext_path', type=str, default=CONVNEXT_PATH)
+    parser.add_argument('--efficientnet_path', type=str, default=EFFICIENTNET_PATH)
+    parser.add_argument('--convnext_out', type=str, default=INT8_CONVNEXT)
+    parser.add_argument('--efficientnet_out', type=str, default=INT8_EFFICIENTNET)
+    main(parser.parse_args())
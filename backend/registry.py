@@ -0,0 +1,161 @@
+# registry.py
+"""Versioned model registry: background loading, warm-up and atomic hot swap.
+
+A version is a directory under MODEL_REGISTRY_DIR holding the same files the
+server loads at startup (convnext_pneumonia.pth, efficientnet_pneumonia.pth,
+and optionally ensemble_config.json, ensemble_frozen.pt, the ONNX / INT8
+members). MODEL_VERSION (default "builtin") names the startup version. Only
+"builtin" reads the usual paths next to app.py; every other version, the
+startup one included, is read from its directory.
+
+    model_registry/
+        2024-06-01/convnext_pneumonia.pth
+        2024-06-01/efficientnet_pneumonia.pth
+        2024-06-01/ensemble_config.json
+
+Requests read ModelRegistry.current() once and use that version to the end,
+so a swap never changes the models under an in-flight request; the replaced
+version is kept in an LRU of REGISTRY_CACHE_SIZE versions, which makes
+switching back to it (rollback) instant.
+
+Usage (app.py):
+    curl -X POST localhost:5000/models/activate -H 'Content-Type: application/json' -d '{"version": "2024-06-01"}'
+    curl -X POST localhost:5000/models/rollback
+    curl localhost:5000/models
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from request_log import get_logger
+
+MODEL_REGISTRY_DIR = os.getenv("MODEL_REGISTRY_DIR", "model_registry")
+BUILTIN_VERSION = "builtin"
+MODEL_VERSION = os.getenv("MODEL_VERSION", BUILTIN_VERSION)
+REGISTRY_CACHE_SIZE = int(os.getenv("REGISTRY_CACHE_SIZE", "2"))
+log = get_logger("registry")
+
+def version_file(name, path):
+    """Where version `name` keeps the file configured as `path` ("builtin" uses `path` itself)."""
+    directory = os.path.join(MODEL_REGISTRY_DIR, name)
+    if name == BUILTIN_VERSION and not os.path.isdir(directory):
+        return path
+    return os.path.join(directory, os.path.basename(path))
+
+def available_versions():
+    """Version directories under MODEL_REGISTRY_DIR, plus "builtin" and the startup version."""
+    names = {BUILTIN_VERSION, MODEL_VERSION}
+    if os.path.isdir(MODEL_REGISTRY_DIR):
+        names.update(entry for entry in os.listdir(MODEL_REGISTRY_DIR)
+                     if os.path.isdir(os.path.join(MODEL_REGISTRY_DIR, entry)))
+    return sorted(names)
+
+class ModelVersion:
+    """Every model of one ensemble version plus its fusion settings."""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config  # load_ensemble_config() dict: weights, temperatures, risk threshold
+        self.convnext = None
+        self.efficientnet = None
+        self.ensemble = None  # frozen TorchScript graph (INFERENCE_BACKEND=torchscript)
+        self.cam = None  # eager EfficientNet for Grad-CAM, loaded on first use for non-eager backends
+        self.cam_path = None
+        self.cam_lock = threading.Lock()
+        self.loaded_at = time.time()
+        self.load_seconds = 0.0
+
+    def describe(self):
+        return {"version": self.name, "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.loaded_at)),
+                "load_seconds": round(self.load_seconds, 2), **self.config}
+
+class ModelRegistry:
+    def __init__(self, loader, warmup=None, capacity=REGISTRY_CACHE_SIZE):
+        """loader(name) -> ModelVersion builds a version; warmup(version) runs before it is swapped in."""
+        self.loader = loader
+        self.warmup = warmup
+        self.capacity = max(1, capacity)
+        self.lock = threading.Lock()  # guards active / cache / pending
+        self.load_lock = threading.Lock()  # one version loads at a time
+        self.cache = OrderedDict()  # name -> ModelVersion, least recently served first
+        self.active = None
+        self.pending = {}  # name -> "loading" or the error of the last failed load
+
+    def current(self):
+        """The version new requests should use (None until the first activate())."""
+        return self.active
+
+    def activate(self, name):
+        """Load (or take from the cache), warm up and swap in version `name`; blocks until it serves."""
+        with self.lock:
+            version = self.cache.get(name)
+        if version is None:
+            with self.load_lock:
+                with self.lock:
+                    version = self.cache.get(name)  # loaded by another caller while we waited
+                if version is None:
+                    log.info("Loading model version", extra={"model_version": name})
+                    start = time.perf_counter()
+                    version = self.loader(name)
+                    if self.warmup is not None:
+                        self.warmup(version)
+                    version.load_seconds = time.perf_counter() - start
+                    log.info("Model version loaded and warmed up",
+                             extra={"model_version": name, "seconds": round(version.load_seconds, 2)})
+        with self.lock:
+            previous = self.active
+            self.cache[name] = version
+            self.cache.move_to_end(name)
+            self.active = version  # single reference assignment: requests see old or new, never a mix
+            self.pending.pop(name, None)
+            while len(self.cache) > self.capacity:
+                # The active version is always the most recent entry, so it is never evicted;
+                # requests still holding an evicted version keep it alive until they finish
+                evicted, _ = self.cache.popitem(last=False)
+                log.info("Model version evicted from the cache", extra={"model_version": evicted})
+        if previous is not version:
+            log.info("Model version swapped in", extra={"model_version": name, "previous": previous.name if previous else None})
+        return version
+
+    def activate_async(self, name):
+        """Start activate(name) on a background thread; False if that version is already loading."""
+        with self.lock:
+            if self.pending.get(name) == "loading":
+                return False
+            self.pending[name] = "loading"
+        threading.Thread(target=self._activate_background, args=(name,), name=f"registry-load-{name}", daemon=True).start()
+        return True
+
+    def _activate_background(self, name):
+        try:
+            self.activate(name)
+        except Exception as e:
+            log.error("Failed to load model version", exc_info=True, extra={"model_version": name})
+            with self.lock:
+                self.pending[name] = f"failed: {e}"
+
+    def is_cached(self, name):
+        with self.lock:
+            return name in self.cache
+
+    def rollback(self):
+        """Swap back to the most recently served cached version other than the active one."""
+        with self.lock:
+            previous = [name for name in reversed(self.cache) if self.active is None or name != self.active.name]
+        if not previous:
+            raise KeyError("No cached version to roll back to")
+        return self.activate(previous[0])
+
+    def status(self):
+        with self.lock:
+            active = self.active
+            cached = [version.describe() for version in reversed(self.cache.values())]
+            pending = dict(self.pending)
+        return {
+            "active": active.name if active else None,
+            "cached": cached,
+            "cache_size": self.capacity,
+            "pending": pending,
+            "available": available_versions(),
+        }
@@ -0,0 +1,198 @@
+# request_log.py
+"""Structured (JSON) logging that never blocks the request path.
+
+A logger from get_logger() only hands its records to a bounded queue with
+put_nowait; one background thread (a QueueListener) formats them, including
+exception tracebacks, and writes them to stdout. With PYTHONUNBUFFERED=1 a
+slow stdout then stalls that thread, not a request.
+  - every record carries the req_id of the request being served (set by
+    request_context(), also in executor threads and worker processes since
+    predict() enters it itself) plus the fields passed as `extra=`
+  - `with timed("forward"):` adds the stage's wall time to the request's
+    timings dict, which request_context() yields for the final log line
+  - INFO records logged with extra={"sample": True} are kept with probability
+    LOG_SAMPLE_RATE (warnings and errors are never sampled)
+  - when the queue is full a record is dropped and counted by (logger, level,
+    message); once the queue has room again, at most every LOG_SUMMARY_S, a
+    single "Log records dropped" record reports the counts
+Messages are kept constant and the variable parts go in `extra=`, so records
+aggregate (and drops count) per kind of event. LOG_FORMAT=text prints one
+readable line per record instead of JSON.
+
+Usage:
+    from request_log import adopt_logger, get_logger, request_context, timed
+    log = get_logger("predict")
+    with request_context(req_id) as timings:
+        with timed("decode"):
+            ...
+        log.info("Prediction served", extra={"timings_ms": timings, "sample": True})
+    log.warning("Grad-CAM generation failed", exc_info=True)
+"""
+import atexit
+import collections
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_SUMMARY_S = float(os.getenv("LOG_SUMMARY_S", "10"))
+MAX_DROP_KEYS = 100  # distinct (logger, level, message) drop counters kept between summaries
+if LOG_FORMAT not in ("json", "text"):
+    raise ValueError(f"LOG_FORMAT must be 'json' or 'text', got '{LOG_FORMAT}'")
+
+REQUEST_ID = contextvars.ContextVar("req_id", default=None)
+TIMINGS = contextvars.ContextVar("timings", default=None)
+
+# --- Request context ---
+@contextlib.contextmanager
+def request_context(req_id):
+    """Tag records logged inside with req_id; yields the request's stage timings (ms).
+
+    Re-entering the context of the request already being served reuses it, so
+    handle_prediction() and predict() share one timings dict.
+    """
+    if req_id is not None and REQUEST_ID.get() == req_id and TIMINGS.get() is not None:
+        yield TIMINGS.get()
+        return
+    timings = {}
+    id_token, timings_token = REQUEST_ID.set(req_id), TIMINGS.set(timings)
+    try:
+        yield timings
+    finally:
+        REQUEST_ID.reset(id_token)
+        TIMINGS.reset(timings_token)
+
+@contextlib.contextmanager
+def timed(stage):
+    """Add the wall time of the block to the current request's timings (no-op outside a request)."""
+    timings = TIMINGS.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + 1000 * (time.perf_counter() - start), 2)
+
+# --- Formatting (background thread) ---
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample"}
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS and value is not None}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "msg": record.getMessage(), **_fields(record)}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = " ".join(f"{key}={value}" for key, value in _fields(record).items())
+        line = f"[{record.levelname}] {record.name}: {record.getMessage()}" + (f" {fields}" if fields else "")
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+# --- Non-blocking hand-off (request thread) ---
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue, sample_rate=LOG_SAMPLE_RATE, summary_s=LOG_SUMMARY_S):
+        super().__init__(log_queue)
+        self.sample_rate = sample_rate
+        self.summary_s = summary_s
+        self.counts_lock = threading.Lock()
+        self.dropped = collections.Counter()
+        self.sampled_out = 0
+        self.last_summary = time.monotonic()
+
+    def prepare(self, record):
+        # The queue stays in-process: formatting and tracebacks are left to the listener thread
+        return record
+
+    def emit(self, record):
+        if record.levelno <= logging.INFO and getattr(record, "sample", False) and random.random() >= self.sample_rate:
+            with self.counts_lock:
+                self.sampled_out += 1
+            return
+        if getattr(record, "req_id", None) is None:
+            record.req_id = REQUEST_ID.get()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            key = (record.name, record.levelname, str(record.msg)[:200])
+            with self.counts_lock:
+                self.dropped[key if key in self.dropped or len(self.dropped) < MAX_DROP_KEYS else ("*", "*", "other")] += 1
+            return
+        if self.dropped and time.monotonic() - self.last_summary >= self.summary_s:
+            self.summarize()
+
+    def summarize(self, block=False):
+        """Queue one record with the drop (and sampling) counts since the last summary."""
+        with self.counts_lock:
+            dropped, self.dropped = self.dropped, collections.Counter()
+            sampled_out, self.sampled_out = self.sampled_out, 0
+            self.last_summary = time.monotonic()
+        if not dropped:
+            return
+        record = logging.LogRecord("request_log", logging.WARNING, __file__, 0, "Log records dropped", (), None)
+        record.dropped_total = sum(dropped.values())
+        record.dropped = [{"logger": name, "level": level, "msg": msg, "count": count}
+                          for (name, level, msg), count in dropped.most_common()]
+        record.sampled_out = sampled_out
+        try:
+            self.queue.put(record, block=block)
+        except queue.Full:
+            with self.counts_lock:
+                self.dropped.update(dropped)  # try again with the next summary
+
+# --- Setup ---
+_SETUP_LOCK = threading.Lock()
+_HANDLER = None
+
+def _setup():
+    global _HANDLER
+    with _SETUP_LOCK:
+        if _HANDLER is not None:
+            return
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+        listener = logging.handlers.QueueListener(log_queue, stream)
+        listener.start()
+        handler = NonBlockingQueueHandler(log_queue)
+        root = logging.getLogger("api")
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+
+        def flush():
+            handler.summarize(block=True)
+            listener.stop()  # writes whatever is still queued
+        atexit.register(flush)
+        _HANDLER = handler
+
+def adopt_logger(name):
+    """Send a third-party logger (e.g. werkzeug's access log) through the same queue instead of its own handler."""
+    _setup()
+    logger = logging.getLogger(name)
+    logger.handlers = [_HANDLER]
+    logger.propagate = False
+    return logger
+
+def get_logger(name):
+    """Logger `api.<name>` writing through the shared non-blocking queue."""
+    _setup()
+    return logging.getLogger(f"api.{name}")
@@ -0,0 +1,452 @@
+# router.py
+"""Router: spread /predict over several local model-server replicas.
+
+Each replica is an app.py or asgi_app.py process (or a host) with its own
+models. The router sits where the single upstream used to be (nginx ->
+router -> replicas) and for every request:
+  - picks a replica by ROUTER_POLICY:
+      "least_outstanding": fewest requests in flight from this router, plus
+                           any queue the replica reports in /health beyond
+                           them ("pending"); ties are broken at random
+      "round_robin":       the next available replica in turn (baseline)
+  - forwards it over a pooled keep-alive connection (at most ROUTER_POOL_SIZE
+    idle connections per replica), so a prediction does not pay a TCP
+    connect to the replica
+  - retries on another replica only if the chosen one could not be reached
+    or closed the connection without answering (or answered 503 "busy")
+Replicas are polled on /health every ROUTER_HEALTH_INTERVAL_S. After
+ROUTER_EJECT_AFTER consecutive failures (failed health checks, connection
+errors, 502/504) a replica is ejected for ROUTER_EJECT_S and then
+re-admitted on its next passing health check. A replica reporting
+"loading" receives no traffic.
+
+Admin endpoints (/models/activate, /shadow, ...) act on whichever replica
+serves the call; send them to each replica directly.
+
+Usage:
+    ROUTER_REPLICAS=http://127.0.0.1:5001,http://127.0.0.1:5002 python router.py serve
+    REPLICAS=3 ./startup.sh                                   # in the container
+    python router.py bench --replicas 3 --server asgi         # least_outstanding vs round_robin
+    curl localhost:5000/router/status
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import urllib.parse
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+ROUTER_REPLICAS = [url.strip().rstrip("/") for url in os.getenv("ROUTER_REPLICAS", "http://127.0.0.1:5001").split(",")
+                   if url.strip()]
+ROUTER_POLICY = os.getenv("ROUTER_POLICY", "least_outstanding").lower()
+ROUTER_POOL_SIZE = int(os.getenv("ROUTER_POOL_SIZE", "8"))
+ROUTER_HEALTH_INTERVAL_S = float(os.getenv("ROUTER_HEALTH_INTERVAL_S", "1.0"))
+ROUTER_HEALTH_TIMEOUT_S = float(os.getenv("ROUTER_HEALTH_TIMEOUT_S", "2.0"))
+ROUTER_EJECT_AFTER = int(os.getenv("ROUTER_EJECT_AFTER", "3"))
+ROUTER_EJECT_S = float(os.getenv("ROUTER_EJECT_S", "10"))
+ROUTER_TIMEOUT_S = float(os.getenv("ROUTER_TIMEOUT_S", "300"))
+POLICIES = ("least_outstanding", "round_robin")
+if ROUTER_POLICY not in POLICIES:
+    raise ValueError(f"ROUTER_POLICY must be one of {POLICIES}, got '{ROUTER_POLICY}'")
+
+# Connection-level headers are not forwarded in either direction. The router already has the
+# whole body, so "Expect: 100-continue" would only make the replica send an interim response
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host", "upgrade",
+               "proxy-connection", "te", "trailer", "server", "date", "expect"}
+
+# --- Minimal HTTP/1.1 upstream client over asyncio streams ---
+class UpstreamError(Exception):
+    """The replica closed the connection without sending a response."""
+
+def request_head(method, path, host, port, headers, length):
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}:{port}", f"Content-Length: {length}", "Connection: keep-alive"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+async def read_response(reader):
+    """(status, headers, body, keep_alive) of one HTTP/1.x response; interim 1xx responses are skipped."""
+    while True:
+        status_line = await reader.readline()
+        if not status_line:
+            raise UpstreamError("connection closed before a response")
+        version, status = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if not 100 <= int(status) < 200:
+            break
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass  # trailers
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()  # delimited by EOF
+        headers["connection"] = "close"
+    keep_alive = version == b"HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    return int(status), headers, body, keep_alive
+
+CONNECTION_ERRORS = (OSError, UpstreamError, asyncio.IncompleteReadError)
+
+class Replica:
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        self.url, self.host, self.port = url, parsed.hostname, parsed.port or 80
+        self.idle = []  # pooled keep-alive connections: (reader, writer)
+        self.outstanding = 0  # requests from this router in flight
+        self.remote_pending = 0  # queue reported by /health beyond our own requests
+        self.healthy = False  # set by the first passing health check
+        self.status = "unknown"
+        self.failures = 0  # consecutive
+        self.ejected_until = 0.0
+        self.counts = {"requests": 0, "errors": 0, "ejections": 0, "connections": 0, "reused": 0}
+
+    def available(self):
+        return self.healthy and time.monotonic() >= self.ejected_until
+
+    def load(self):
+        return self.outstanding + self.remote_pending
+
+    def close_idle(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+    async def request(self, method, path, headers, body, timeout):
+        """One exchange over a pooled connection (or a new one); returns (status, headers, body)."""
+        head = request_head(method, path, self.host, self.port, headers, len(body))
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            try:
+                result = await self._exchange(reader, writer, head, body, timeout)
+            except (UpstreamError, ConnectionError):
+                continue  # the replica closed this idle connection (keep-alive timeout): try the next
+            self.counts["reused"] += 1
+            return result
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), ROUTER_HEALTH_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            raise UpstreamError(f"connect timed out after {ROUTER_HEALTH_TIMEOUT_S:.0f}s")
+        self.counts["connections"] += 1
+        return await self._exchange(reader, writer, head, body, timeout)
+
+    async def _exchange(self, reader, writer, head, body, timeout):
+        try:
+            writer.write(head + body)
+            await writer.drain()
+            status, headers, data, keep_alive = await asyncio.wait_for(read_response(reader), timeout)
+        except BaseException:
+            writer.close()  # includes cancellation: the stream is mid-response and cannot be reused
+            raise
+        if keep_alive and len(self.idle) < ROUTER_POOL_SIZE:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, headers, data
+
+    def describe(self):
+        return {"url": self.url, "status": self.status, "available": self.available(),
+                "outstanding": self.outstanding, "remote_pending": self.remote_pending,
+                "consecutive_failures": self.failures, "idle_connections": len(self.idle),
+                "ejected_for_s": round(max(0.0, self.ejected_until - time.monotonic()), 1), **self.counts}
+
+# --- Balancing, ejection and health checks ---
+class Router:
+    def __init__(self, urls, policy=ROUTER_POLICY):
+        if not urls:
+            raise ValueError("ROUTER_REPLICAS is empty")
+        self.replicas = [Replica(url) for url in urls]
+        self.policy = policy
+        self.rotation = itertools.cycle(self.replicas)
+
+    def pick(self, exclude=()):
+        candidates = [replica for replica in self.replicas if replica.available() and replica not in exclude]
+        if not candidates:
+            return None
+        if self.policy == "round_robin":
+            while True:
+                replica = next(self.rotation)
+                if replica in candidates:
+                    return replica
+        lowest = min(replica.load() for replica in candidates)
+        return random.choice([replica for replica in candidates if replica.load() == lowest])
+
+    def record_failure(self, replica, reason):
+        replica.failures += 1
+        replica.counts["errors"] += 1
+        if replica.failures >= ROUTER_EJECT_AFTER and time.monotonic() >= replica.ejected_until:
+            replica.ejected_until = time.monotonic() + ROUTER_EJECT_S
+            replica.counts["ejections"] += 1
+            replica.close_idle()
+            print(f"[ROUTER] WARN: Ejected {replica.url} for {ROUTER_EJECT_S:.0f}s after "
+                  f"{replica.failures} consecutive failures ({reason})")
+
+    async def forward(self, method, path, headers, body):
+        """(replica, status, headers, body), or None when no replica is available.
+
+        Raises asyncio.TimeoutError when the replica does not answer within
+        ROUTER_TIMEOUT_S; a timed-out request is not retried elsewhere, since
+        that would double the work on an already slow cluster.
+        """
+        tried = []
+        busy = None
+        while True:
+            replica = self.pick(tried)
+            if replica is None:
+                return busy
+            tried.append(replica)
+            replica.outstanding += 1
+            replica.counts["requests"] += 1
+            try:
+                status, response_headers, data = await replica.request(method, path, headers, body, ROUTER_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                self.record_failure(replica, "timeout")
+                raise
+            except CONNECTION_ERRORS as e:
+                self.record_failure(replica, e)
+                continue  # nothing was answered: try another replica
+            finally:
+                replica.outstanding -= 1
+            if status in (502, 504):
+                self.record_failure(replica, f"HTTP {status}")
+            else:
+                replica.failures = 0
+            if status == 503:
+                busy = (replica, status, response_headers, data)  # admission limit: try a less loaded replica
+                continue
+            return replica, status, response_headers, data
+
+    async def check(self, replica):
+        try:
+            status, _, data = await replica.request("GET", "/health", {}, b"", ROUTER_HEALTH_TIMEOUT_S)
+            report = json.loads(data)
+        except (asyncio.TimeoutError, ValueError, *CONNECTION_ERRORS) as e:
+            replica.status = f"unreachable: {str(e) or type(e).__name__}"
+            self.record_failure(replica, f"health check: {replica.status}")
+            return
+        replica.status = report.get("status", f"HTTP {status}") if status == 200 else f"HTTP {status}"
+        if replica.status != "ok":
+            replica.healthy = False  # still loading models: not ready for traffic
+            return
+        if not replica.healthy:
+            print(f"[ROUTER] Replica {replica.url} is healthy (model version {report.get('model_version')})")
+        replica.healthy = True
+        replica.failures = 0
+        # Queue depth seen by the replica beyond what this router has in flight (other clients, stragglers)
+        replica.remote_pending = max(0, int(report.get("pending", 0)) - replica.outstanding)
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*[self.check(replica) for replica in self.replicas])
+            await asyncio.sleep(ROUTER_HEALTH_INTERVAL_S)
+
+    def status(self):
+        return {"policy": self.policy, "replicas": [replica.describe() for replica in self.replicas]}
+
+# --- ASGI app ---
+ROUTER = Router(ROUTER_REPLICAS)
+
+async def router_status(request):
+    return JSONResponse(ROUTER.status())
+
+async def health(request):
+    available = sum(replica.available() for replica in ROUTER.replicas)
+    return JSONResponse({"status": "ok" if available else "loading", "replicas": len(ROUTER.replicas),
+                         "available": available, "policy": ROUTER.policy})
+
+async def proxy(request):
+    body = await request.body()
+    headers = {name: value for name, value in request.headers.items() if name not in HOP_HEADERS}
+    if request.client:
+        headers["x-forwarded-for"] = request.headers.get("x-forwarded-for", request.client.host)
+    path = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+    try:
+        result = await ROUTER.forward(request.method, path, headers, body)
+    except asyncio.TimeoutError:
+        return JSONResponse({"error": f"Replica did not answer within {ROUTER_TIMEOUT_S:.0f}s"}, status_code=504)
+    if result is None:
+        return JSONResponse({"error": "No healthy replica, retry shortly"}, status_code=503, headers={"Retry-After": "1"})
+    replica, status, response_headers, data = result
+    headers = {name: value for name, value in response_headers.items() if name not in HOP_HEADERS}
+    headers["x-replica"] = replica.url
+    return Response(data, status_code=status, headers=headers)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    task = asyncio.create_task(ROUTER.health_loop())
+    print(f"[INFO] Router ({ROUTER.policy}) in front of {len(ROUTER.replicas)} replicas: {', '.join(ROUTER_REPLICAS)}")
+    yield
+    task.cancel()
+    for replica in ROUTER.replicas:
+        replica.close_idle()
+
+router = Starlette(
+    routes=[
+        Route("/router/status", router_status, methods=["GET"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/{path:path}", proxy, methods=["GET", "POST", "OPTIONS"]),
+    ],
+    lifespan=lifespan,
+)
+
+# --- Local multi-process harness: least_outstanding vs round_robin ---
+async def drive(port, requests, args):
+    """Closed-loop clients posting a light/heavy mix; returns latencies (ms), errors, replica counts."""
+    from loadtest import multipart_request
+
+    with open(args.image, 'rb') as f:
+        image_bytes = f.read()
+    light = multipart_request("127.0.0.1", port, image_bytes, not args.cam)
+    heavy = multipart_request("127.0.0.1", port, image_bytes, not args.cam, {"tta_views": args.heavy_tta})
+    latencies, errors, served = [], 0, {}
+    queue = list(requests)
+
+    async def client():
+        nonlocal errors
+        while queue:
+            head, body = heavy if queue.pop() else light
+            start = time.perf_counter()
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                try:
+                    writer.write(head + body)
+                    await writer.drain()
+                    status, headers, _, _ = await asyncio.wait_for(read_response(reader), args.timeout)
+                finally:
+                    writer.close()
+            except (asyncio.TimeoutError, *CONNECTION_ERRORS):
+                status, headers = 0, {}
+            if status == 200:
+                latencies.append(1000 * (time.perf_counter() - start))
+                replica = headers.get("x-replica", "?")
+                served[replica] = served.get(replica, 0) + 1
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.clients)])
+    return latencies, errors, served, time.perf_counter() - start
+
+def bench(args):
+    from loadtest import SERVERS, wait_healthy
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    threads = args.replica_threads or max(1, (os.cpu_count() or 1) // args.replicas)
+    urls = [f"http://127.0.0.1:{args.port + 1 + i}" for i in range(args.replicas)]
+    # Same request mix, in the same order, for every policy
+    rng = random.Random(args.seed)
+    requests = [rng.random() < args.heavy_fraction for _ in range(args.requests)]
+    processes = []
+    try:
+        for i, url in enumerate(urls):
+            replica_threads = 1 if (args.slow_replica and i == 0) else threads
+            env = dict(os.environ, PORT=str(args.port + 1 + i), OMP_NUM_THREADS=str(replica_threads),
+                       INFERENCE_WORKERS=str(args.replica_workers))
+            processes.append(subprocess.Popen(SERVERS[args.server], env=env, cwd=here,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            print(f"[BENCH] Replica {url} ({args.server}, {replica_threads} threads)")
+        for url in urls:
+            wait_healthy(url, args.startup_timeout)
+
+        rows = []
+        for policy in args.policies:
+            env = dict(os.environ, PORT=str(args.port), ROUTER_POLICY=policy, ROUTER_REPLICAS=",".join(urls))
+            server = subprocess.Popen([sys.executable, "router.py", "serve"], env=env, cwd=here,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_healthy(f"http://127.0.0.1:{args.port}", args.startup_timeout)
+                time.sleep(2 * ROUTER_HEALTH_INTERVAL_S)  # let every replica pass a health check
+                asyncio.run(drive(args.port, requests[:args.warmup], args))
+                latencies, errors, served, elapsed = asyncio.run(drive(args.port, requests, args))
+            finally:
+                server.terminate()
+                server.wait()
+            latencies.sort()
+            rows.append((policy, {
+                "throughput": len(latencies) / elapsed,
+                "p50": latencies[len(latencies) // 2] if latencies else float('nan'),
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else float('nan'),
+                "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else float('nan'),
+                "mean": statistics.mean(latencies) if latencies else float('nan'),
+                "errors": errors,
+                "split": "/".join(str(served.get(url, 0)) for url in urls),
+            }))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    print(f"\n{args.replicas} {args.server} replicas{' (replica 1 slowed to 1 thread)' if args.slow_replica else ''}, "
+          f"{args.clients} clients, {args.requests} requests, {100 * args.heavy_fraction:.0f}% heavy "
+          f"(tta_views={args.heavy_tta})")
+    print(f"{'policy':<20}{'req/s':>8}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}  per replica")
+    print("-" * 90)
+    for policy, stats in rows:
+        print(f"{policy:<20}{stats['throughput']:>8.2f}{stats['mean']:>9.0f}{stats['p50']:>9.0f}{stats['p95']:>9.0f}"
+              f"{stats['p99']:>9.0f}{stats['errors']:>8}  {stats['split']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Least-outstanding-requests router for local model-server replicas.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('serve', help='Run the router on $PORT (default 5000)')
+
+    bench_parser = subparsers.add_parser('bench', help='Launch replicas and compare routing policies')
+    bench_parser.add_argument('--replicas', type=int, default=3, help='Replica processes to launch')
+    bench_parser.add_argument('--server', choices=['flask', 'asgi'], default='asgi', help='Replica server mode')
+    bench_parser.add_argument('--replica_threads', type=int, default=0, help='Intra-op threads per replica (0 = cores / replicas)')
+    bench_parser.add_argument('--replica_workers', type=int, default=1, help='INFERENCE_WORKERS per replica')
+    bench_parser.add_argument('--slow_replica', action='store_true', help='Give the first replica a single thread')
+    bench_parser.add_argument('--policies', nargs='+', choices=POLICIES, default=['round_robin', 'least_outstanding'])
+    bench_parser.add_argument('--port', type=int, default=5200, help='Router port; replicas take the following ports')
+    bench_parser.add_argument('--image', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archive',
+                                                                        'Real Data', 'xray1.jpg'), help='X-ray posted by every client')
+    bench_parser.add_argument('--clients', type=int, default=8, help='Concurrent closed-loop clients')
+    bench_parser.add_argument('--requests', type=int, default=200, help='Timed requests per policy')
+    bench_parser.add_argument('--warmup', type=int, default=10, help='Untimed requests per policy')
+    bench_parser.add_argument('--heavy_fraction', type=float, default=0.2, help='Fraction of heavy (TTA) requests')
+    bench_parser.add_argument('--heavy_tta', type=int, default=None, help='tta_views of a heavy request (default: all TTA views)')
+    bench_parser.add_argument('--cam', action='store_true', help='Request Grad-CAM overlays')
+    bench_parser.add_argument('--seed', type=int, default=0, help='Seed of the request mix')
+    bench_parser.add_argument('--timeout', type=float, default=300.0, help='Per-request timeout (s)')
+    bench_parser.add_argument('--startup_timeout', type=float, default=180.0, help='Seconds to wait for each server')
+
+    args = parser.parse_args()
+    if args.command == 'bench':
+        # Imported here so `serve` does not need torch
+        from models import TTA_VIEWS
+        if args.heavy_tta is None:
+            args.heavy_tta = len(TTA_VIEWS)
+        elif not 1 <= args.heavy_tta <= len(TTA_VIEWS):
+            parser.error(f'--heavy_tta must be between 1 and {len(TTA_VIEWS)} (the server rejects more views)')
+    if args.command == 'serve':
+        port = int(os.getenv("PORT", 5000))
+        uvicorn.run(router, host='0.0.0.0', port=port, log_level="warning",
+                    timeout_keep_alive=int(os.getenv("ASGI_KEEPALIVE_S", "65")))
+    else:
+        bench(args)
@@ -0,0 +1,215 @@
+# scheduler.py
+"""Priority lanes with weighted fair queueing in front of the model executor.
+
+predict() runs its model work inside `with SCHEDULER.slot(...)`. At most
+`slots` requests (INFERENCE_WORKERS; 0 = unlimited) run at once. Requests
+that do not get a slot wait in the queue of their priority class:
+  - between classes, strict priority: a free slot goes to the first class in
+    PRIORITY_CLASSES (e.g. "interactive") before any lower one ("bulk")
+  - PRIORITY_RESERVED_SLOTS slots are only ever used by the first class, so
+    an interactive request waits at most for one of those to free up even
+    when bulk work has filled everything else
+  - with PRIORITY_TARGET_MS set, the slots lower classes may hold shrink by
+    one (at most once a second) while the first class's recent p95 queue
+    wait is above the target, and grow back once it is under half of it
+  - within a class, clients share the capacity by weighted fair queueing
+    (self-clocked: a request's finish tag is max(class virtual time, the
+    client's previous tag) + cost / weight, and the smallest tag runs next),
+    so one client submitting a thousand requests delays another client by
+    about one request per turn, not by a thousand
+Cost is in forward passes (tta_views); weight comes from the client's API key.
+
+Requests are classified from headers (classify()):
+  X-API-Key      listed in PRIORITY_API_KEYS ("key=class[:weight],..."): that
+                 class and weight, whatever else the request says
+  X-Priority     otherwise, the requested class (default PRIORITY_DEFAULT)
+  X-Client-Id    fair-queueing identity of an unkeyed client (a bulk job id),
+                 else X-Real-IP / X-Forwarded-For / the peer address
+A class with PRIORITY_MAX_QUEUE requests waiting rejects more (SchedulerFull,
+answered 503 with Retry-After).
+
+Usage (app.py):
+    INFERENCE_WORKERS=4 PRIORITY_TARGET_MS=200 PRIORITY_API_KEYS="rescore-job=bulk:1,pacs=interactive:2" python app.py
+    curl -F file=@xray.jpg -H 'X-Priority: bulk' -H 'X-Client-Id: rescore-2024-06' localhost:5000/predict
+    curl localhost:5000/debug/queues
+"""
+import collections
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+import time
+
+PRIORITY_CLASSES = [name.strip().lower() for name in os.getenv("PRIORITY_CLASSES", "interactive,bulk").split(",")
+                    if name.strip()]
+PRIORITY_DEFAULT = os.getenv("PRIORITY_DEFAULT", PRIORITY_CLASSES[0]).lower()
+PRIORITY_HEADER = os.getenv("PRIORITY_HEADER", "X-Priority")
+PRIORITY_RESERVED_SLOTS = int(os.getenv("PRIORITY_RESERVED_SLOTS", "1"))
+PRIORITY_TARGET_MS = float(os.getenv("PRIORITY_TARGET_MS", "0"))
+PRIORITY_MAX_QUEUE = int(os.getenv("PRIORITY_MAX_QUEUE", "64"))
+PRIORITY_WINDOW = 500  # recent queue waits kept per class
+ADJUST_INTERVAL_S = 1.0
+
+class SchedulerFull(Exception):
+    """The request's priority class already has its maximum number of requests waiting."""
+
+def parse_api_keys(spec):
+    """"key=class[:weight],..." -> {key: (class, weight)}."""
+    keys = {}
+    for entry in spec.split(","):
+        key, _, lane = entry.strip().partition("=")
+        if not key or not lane:
+            continue
+        name, _, weight = lane.partition(":")
+        keys[key.strip()] = (name.strip().lower(), float(weight or 1))
+    return keys
+
+PRIORITY_API_KEYS = parse_api_keys(os.getenv("PRIORITY_API_KEYS", ""))
+for _name in [PRIORITY_DEFAULT] + [lane for lane, _ in PRIORITY_API_KEYS.values()]:
+    if _name not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority class '{_name}', PRIORITY_CLASSES is {PRIORITY_CLASSES}")
+
+def classify(headers, remote_addr=None):
+    """(priority class, client id, weight) of a request; ValueError on an unknown class."""
+    api_key = headers.get("X-API-Key", "")
+    if api_key in PRIORITY_API_KEYS:
+        priority, weight = PRIORITY_API_KEYS[api_key]
+        return priority, f"key:{api_key}", weight
+    priority = (headers.get(PRIORITY_HEADER) or PRIORITY_DEFAULT).strip().lower()
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority '{priority}'. Use one of {PRIORITY_CLASSES}")
+    client = (headers.get("X-Client-Id") or headers.get("X-Real-IP")
+              or headers.get("X-Forwarded-For", "").split(",")[0].strip() or remote_addr or "anonymous")
+    return priority, f"client:{client}", 1.0
+
+def _summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(len(values) * q))], 1)
+    return {"mean": round(sum(values) / len(values), 1), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}
+
+class _Ticket:
+    __slots__ = ("finish", "granted")
+
+    def __init__(self, finish):
+        self.finish = finish
+        self.granted = False
+
+class FairScheduler:
+    def __init__(self, slots, classes=PRIORITY_CLASSES, reserved=PRIORITY_RESERVED_SLOTS,
+                 target_ms=PRIORITY_TARGET_MS, max_queue=PRIORITY_MAX_QUEUE):
+        self.slots = slots  # 0 = unlimited: every request runs at once, classes only show in stats
+        self.classes = list(classes)
+        self.reserved = min(reserved, slots - 1) if slots > 1 and len(self.classes) > 1 else 0
+        self.max_lower = slots - self.reserved  # slots the lower classes may hold together
+        self.lower_cap = self.max_lower
+        self.target_ms = target_ms
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        self.seq = itertools.count()
+        self.running = {name: 0 for name in self.classes}
+        self.queues = {name: [] for name in self.classes}  # heaps of (finish tag, seq, ticket)
+        self.virtual = {name: 0.0 for name in self.classes}
+        self.client_finish = {name: {} for name in self.classes}
+        self.waits = {name: collections.deque(maxlen=PRIORITY_WINDOW) for name in self.classes}
+        self.counts = {name: {"served": 0, "rejected": 0} for name in self.classes}
+        self.last_adjust = 0.0
+
+    @contextlib.contextmanager
+    def slot(self, priority, client, weight=1.0, cost=1.0):
+        """Blocks until the request may run and yields the queue wait (ms); raises SchedulerFull if the queue is full."""
+        wait_ms = self.acquire(priority, client, weight, cost)
+        try:
+            yield wait_ms
+        finally:
+            self.release(priority)
+
+    def acquire(self, priority, client, weight=1.0, cost=1.0):
+        enqueued = time.perf_counter()
+        with self.cond:
+            queue = self.queues[priority]
+            if len(queue) >= self.max_queue:
+                self.counts[priority]["rejected"] += 1
+                raise SchedulerFull(f"Too many queued '{priority}' requests, retry shortly")
+            finishes = self.client_finish[priority]
+            ticket = _Ticket(max(self.virtual[priority], finishes.get(client, 0.0)) + cost / max(weight, 1e-6))
+            finishes[client] = ticket.finish
+            if len(finishes) > 4 * self.max_queue:
+                # Clients whose last tag is behind virtual time would restart from it anyway
+                for stale in [c for c, finish in finishes.items() if finish <= self.virtual[priority]]:
+                    del finishes[stale]
+            heapq.heappush(queue, (ticket.finish, next(self.seq), ticket))
+            self._dispatch()
+            while not ticket.granted:
+                self.cond.wait()
+            wait_ms = 1000 * (time.perf_counter() - enqueued)
+            self.waits[priority].append(wait_ms)
+            self.counts[priority]["served"] += 1
+        return wait_ms
+
+    def release(self, priority):
+        with self.cond:
+            self.running[priority] -= 1
+            self._adjust()
+            self._dispatch()
+
+    def _next_class(self):
+        if self.slots and sum(self.running.values()) >= self.slots:
+            return None
+        lower_running = sum(self.running[name] for name in self.classes[1:])
+        for i, name in enumerate(self.classes):
+            if not self.queues[name]:
+                continue
+            if i > 0 and self.slots and lower_running >= self.lower_cap:
+                return None  # the remaining slots are held for the first class
+            return name
+        return None
+
+    def _dispatch(self):
+        """Grant free slots to queued requests; caller holds self.cond."""
+        granted = False
+        while (name := self._next_class()) is not None:
+            finish, _, ticket = heapq.heappop(self.queues[name])
+            self.virtual[name] = finish
+            self.running[name] += 1
+            ticket.granted = granted = True
+        if granted:
+            self.cond.notify_all()
+
+    def _adjust(self):
+        """Move the lower classes' slot cap towards PRIORITY_TARGET_MS for the first class's p95 wait."""
+        now = time.monotonic()
+        if not self.target_ms or self.max_lower <= 1 or now - self.last_adjust < ADJUST_INTERVAL_S:
+            return
+        recent = sorted(list(self.waits[self.classes[0]])[-100:])
+        if not recent:
+            return
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))]
+        if p95 > self.target_ms and self.lower_cap > 1:
+            self.lower_cap -= 1
+        elif p95 < self.target_ms / 2 and self.lower_cap < self.max_lower:
+            self.lower_cap += 1
+        else:
+            return
+        self.last_adjust = now
+
+    def reset(self):
+        with self.cond:
+            for name in self.classes:
+                self.waits[name].clear()
+                self.counts[name] = {"served": 0, "rejected": 0}
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                "slots": self.slots or "unlimited",
+                "reserved_slots": self.reserved,
+                "lower_class_cap": self.lower_cap if self.slots else None,
+                "target_ms": self.target_ms or None,
+                "classes": {name: {"queued": len(self.queues[name]), "running": self.running[name],
+                                   "clients": len(self.client_finish[name]), **self.counts[name],
+                                   "wait_ms": _summary(list(self.waits[name]))}
+                            for name in self.classes},
+            }
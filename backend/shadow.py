@@ -0,0 +1,220 @@
+# shadow.py
+"""Shadow evaluation: mirror a sample of /predict traffic to a candidate model version.
+
+predict() offers its preprocessed input and final probabilities after the
+primary forward. A sampled request is put on a bounded queue with
+put_nowait (a full queue drops the sample), so the primary path only pays
+for a random draw and a queue append. SHADOW_WORKERS dispatcher threads
+hand queued samples to SHADOW_WORKERS spawned processes that each hold the
+candidate and run with SHADOW_THREADS intra-op threads at a lower OS priority
+and returns its probabilities. torch's thread count is process-wide (new
+request threads pick it up on first use), so it is only ever changed in that
+process. The dispatchers record the result against production:
+  - agreement rate and a primary x candidate confusion matrix
+  - confidence deltas (candidate top confidence minus primary, and the shift
+    in the probability of the primary's class)
+  - forward latency of both
+The candidate is any registry version (see registry.py), loaded and warmed
+in the candidate process; loader and forward must be module-level
+functions so they can be sent to it.
+
+Usage (app.py):
+    SHADOW_VERSION=2024-06-01 SHADOW_SAMPLE_RATE=0.2 python app.py
+    curl -X POST localhost:5000/shadow -H 'Content-Type: application/json' -d '{"version": "2024-06-01", "sample_rate": 0.1}'
+    curl localhost:5000/shadow
+    curl -X POST localhost:5000/shadow/reset -H "Authorization: Bearer $REGISTRY_ADMIN_TOKEN"
+"""
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import random
+import statistics
+import threading
+import time
+import torch
+
+from request_log import get_logger
+
+SHADOW_VERSION = os.getenv("SHADOW_VERSION", "")
+SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "0.1"))
+SHADOW_QUEUE_SIZE = int(os.getenv("SHADOW_QUEUE_SIZE", "16"))
+SHADOW_WORKERS = int(os.getenv("SHADOW_WORKERS", "1"))
+SHADOW_THREADS = int(os.getenv("SHADOW_THREADS", "1"))
+SHADOW_NICE = int(os.getenv("SHADOW_NICE", "10"))
+SHADOW_WINDOW = 1000  # recent samples kept for percentiles
+log = get_logger("shadow")
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else None
+
+def _summary(values, scale=1.0):
+    if not values:
+        return None
+    return {"mean": round(scale * statistics.mean(values), 4), "p50": round(scale * _percentile(values, 0.5), 4),
+            "p95": round(scale * _percentile(values, 0.95), 4), "p99": round(scale * _percentile(values, 0.99), 4)}
+
+# --- Candidate process ---
+_CANDIDATE = None  # the candidate version, in the shadow process only
+
+def _init_candidate(loader, name, threads, nice):
+    global _CANDIDATE
+    torch.set_num_threads(threads)
+    if nice and hasattr(os, 'nice'):
+        try:
+            os.nice(nice)
+        except OSError:
+            pass
+    _CANDIDATE = loader(name)
+
+def _candidate_ready():
+    return _CANDIDATE is not None
+
+def _candidate_forward(forward, batch):
+    """(class probabilities averaged over the batch, forward ms) of the candidate."""
+    start = time.perf_counter()
+    with torch.no_grad():
+        probs = forward(_CANDIDATE, batch).mean(0)
+    return probs, 1000 * (time.perf_counter() - start)
+
+class ShadowEvaluator:
+    def __init__(self, loader, forward, class_names, workers=SHADOW_WORKERS, queue_size=SHADOW_QUEUE_SIZE,
+                 threads=SHADOW_THREADS):
+        """loader(name) -> warmed model version; forward(version, batch) -> class probabilities [N, C].
+
+        Both run in the candidate process, so they must be picklable (module-level) functions.
+        """
+        self.loader = loader
+        self.forward = forward
+        self.class_names = class_names
+        self.workers = workers
+        self.threads = threads
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.candidate = None  # process pool holding the candidate
+        self.candidate_name = None
+        self.sample_rate = 0.0
+        self.status = "off"
+        self.started = False
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            n = len(self.class_names)
+            self.counts = {"mirrored": 0, "dropped": 0, "evaluated": 0, "agreed": 0, "errors": 0}
+            self.confusion = [[0] * n for _ in range(n)]
+            self.top_confidence_delta = collections.deque(maxlen=SHADOW_WINDOW)
+            self.primary_class_delta = collections.deque(maxlen=SHADOW_WINDOW)
+            self.primary_ms = collections.deque(maxlen=SHADOW_WINDOW)
+            self.candidate_ms = collections.deque(maxlen=SHADOW_WINDOW)
+
+    # --- Control ---
+    def start(self, name, sample_rate=SHADOW_SAMPLE_RATE):
+        """Load `name` on a background thread and start mirroring sample_rate of requests to it."""
+        if not 0.0 < sample_rate <= 1.0:
+            raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}")
+        with self.lock:
+            self.status = f"loading {name}"
+        threading.Thread(target=self._load, args=(name, sample_rate), name="shadow-load", daemon=True).start()
+
+    def _load(self, name, sample_rate):
+        # spawn: a forked child would inherit the parent's torch thread pools in an unusable state
+        candidate = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_candidate,
+            initargs=(self.loader, name, self.threads, SHADOW_NICE))
+        try:
+            # The first task waits for an initializer: the candidate is loaded and warmed
+            candidate.submit(_candidate_ready).result()
+        except Exception as e:
+            log.error("Failed to load shadow candidate", exc_info=True, extra={"candidate": name})
+            candidate.shutdown(wait=False, cancel_futures=True)
+            with self.lock:
+                self.status = f"failed to load {name}: {e}"
+            return
+        self.reset()
+        with self.lock:
+            previous = self.candidate
+            self.candidate, self.candidate_name = candidate, name
+            self.sample_rate, self.status = sample_rate, "running"
+            if not self.started:
+                for i in range(self.workers):
+                    threading.Thread(target=self._worker, name=f"shadow-{i}", daemon=True).start()
+                self.started = True
+        if previous is not None:
+            previous.shutdown(wait=False, cancel_futures=True)
+        log.info("Shadow candidate running", extra={"candidate": name, "sample_rate": sample_rate})
+
+    def stop(self):
+        with self.lock:
+            previous = self.candidate
+            self.candidate, self.candidate_name, self.sample_rate, self.status = None, None, 0.0, "off"
+        if previous is not None:
+            previous.shutdown(wait=False, cancel_futures=True)
+
+    # --- Hot path ---
+    def offer(self, batch, primary_probs, primary_ms):
+        """Called by predict() after the primary forward; never blocks."""
+        candidate = self.candidate
+        if candidate is None or random.random() >= self.sample_rate:
+            return False
+        try:
+            self.queue.put_nowait((candidate, batch, primary_probs, primary_ms))
+        except queue.Full:
+            with self.lock:
+                self.counts["dropped"] += 1
+            return False
+        with self.lock:
+            self.counts["mirrored"] += 1
+        return True
+
+    # --- Background ---
+    def _worker(self):
+        # Dispatcher only: the candidate forward runs in the candidate process
+        while True:
+            candidate, batch, primary_probs, primary_ms = self.queue.get()
+            if candidate is not self.candidate:
+                continue  # stopped or replaced while queued
+            try:
+                probs, candidate_ms = candidate.submit(_candidate_forward, self.forward, batch).result()
+                self._record(primary_probs, probs, primary_ms, candidate_ms)
+            except concurrent.futures.CancelledError:
+                continue  # stopped while in flight
+            except Exception:
+                log.warning("Shadow candidate forward failed", exc_info=True, extra={"candidate": self.candidate_name})
+                with self.lock:
+                    self.counts["errors"] += 1
+
+    def _record(self, primary_probs, probs, primary_ms, candidate_ms):
+        primary_class = int(primary_probs.argmax())
+        candidate_class = int(probs.argmax())
+        with self.lock:
+            self.counts["evaluated"] += 1
+            self.counts["agreed"] += int(primary_class == candidate_class)
+            self.confusion[primary_class][candidate_class] += 1
+            self.top_confidence_delta.append(float(probs.max() - primary_probs.max()))
+            self.primary_class_delta.append(float(probs[primary_class] - primary_probs[primary_class]))
+            self.primary_ms.append(primary_ms)
+            self.candidate_ms.append(candidate_ms)
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+            evaluated = counts["evaluated"]
+            return {
+                "status": self.status,
+                "candidate": self.candidate_name,
+                "sample_rate": self.sample_rate,
+                "queue_depth": self.queue.qsize(),
+                "counts": counts,
+                "agreement": round(counts["agreed"] / evaluated, 4) if evaluated else None,
+                "confusion": {"rows": "primary", "columns": "candidate", "classes": self.class_names,
+                              "matrix": [list(row) for row in self.confusion]},
+                # Percentage points, over the last SHADOW_WINDOW samples
+                "top_confidence_delta_pct": _summary(list(self.top_confidence_delta), 100.0),
+                "primary_class_delta_pct": _summary(list(self.primary_class_delta), 100.0),
+                "abs_primary_class_delta_pct": _summary([abs(v) for v in self.primary_class_delta], 100.0),
+                "primary_forward_ms": _summary(list(self.primary_ms)),
+                "candidate_forward_ms": _summary(list(self.candidate_ms)),
+            }
@@ -12,10 +12,42 @@ echo "[startup] Cloud Run target port: ${CR_PORT}"
 export PYTHONUNBUFFERED=${PYTHONUNBUFFERED:-1}
 export DISABLE_CAM=${DISABLE_CAM:-0}
 
-# Start Flask app on 5000 in background (Nginx will proxy to it)
-echo "[startup] Starting Flask application on 0.0.0.0:5000..."
+# Start the app on 5000 in background (Nginx will proxy to it)
+# SERVER_MODE=asgi serves the same API from asgi_app.py (uvicorn + inference executor); with
+# ASGI_EXECUTOR=process the /models, /shadow and /debug endpoints answer 501 (state lives in the workers)
+# REPLICAS>1 starts that many app processes on 5001.. with router.py on 5000 in front of them,
+# each with OMP_NUM_THREADS=REPLICA_THREADS (default: cores / REPLICAS)
+export SERVER_MODE=${SERVER_MODE:-flask}
+export REPLICAS=${REPLICAS:-1}
 cd /app
-python app.py &
+if [ "${SERVER_MODE}" = "asgi" ]; then
+    SERVER_SCRIPT=asgi_app.py
+else
+    SERVER_SCRIPT=app.py
+fi
+REPLICA_PIDS=""
+if [ "${REPLICAS}" -gt 1 ]; then
+    if [ "${SIMILAR_CASES:-0}" = "1" ] && [ "${EMBEDDING_CAPTURE:-0}" = "1" ]; then
+        # Every replica would append to the same EMBEDDING_INDEX_DIR files
+        echo "[startup] ERROR: REPLICAS>1 cannot append to the similar-case index; set EMBEDDING_CAPTURE=0"
+        exit 1
+    fi
+    # Split the cores between the replicas instead of each one sizing its pool for all of them
+    REPLICA_THREADS=${REPLICA_THREADS:-$(( $(nproc) / REPLICAS ))}
+    [ "${REPLICA_THREADS}" -ge 1 ] || REPLICA_THREADS=1
+    REPLICA_URLS=""
+    for i in $(seq 1 "${REPLICAS}"); do
+        echo "[startup] Starting ${SERVER_MODE} replica ${i} on 127.0.0.1:$((5000 + i)) (${REPLICA_THREADS} threads)..."
+        OMP_NUM_THREADS=${REPLICA_THREADS} PORT=$((5000 + i)) python "${SERVER_SCRIPT}" &
+        REPLICA_PIDS="${REPLICA_PIDS} $!"
+        REPLICA_URLS="${REPLICA_URLS:+${REPLICA_URLS},}http://127.0.0.1:$((5000 + i))"
+    done
+    echo "[startup] Starting router on 0.0.0.0:5000 (${ROUTER_POLICY:-least_outstanding})..."
+    ROUTER_REPLICAS="${REPLICA_URLS}" PORT=5000 python router.py serve &
+else
+    echo "[startup] Starting ${SERVER_MODE} application on 0.0.0.0:5000..."
+    python "${SERVER_SCRIPT}" &
+fi
 FLASK_PID=$!
 
 echo "[startup] Flask app started with PID: $FLASK_PID"
@@ -48,8 +80,8 @@ echo "[startup] Nginx started with PID: $NGINX_PID (listening on ${CR_PORT})"
 # Graceful shutdown handler
 shutdown() {
     echo "[startup] Shutting down services..."
-    kill ${NGINX_PID} ${FLASK_PID} 2>/dev/null || true
-    wait ${NGINX_PID} ${FLASK_PID} 2>/dev/null || true
+    kill ${NGINX_PID} ${FLASK_PID} ${REPLICA_PIDS} 2>/dev/null || true
+    wait ${NGINX_PID} ${FLASK_PID} ${REPLICA_PIDS} 2>/dev/null || true
     echo "[startup] Services stopped"
     exit 0
 }
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+DICOM ingestion tests on synthetic files written with pydicom (no PACS data needed).
+Run with `python -m pytest test_dicom.py` from backend/.
+"""
+
+import io
+import numpy as np
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from dicom_io import DicomError, decode_dicom, is_dicom, read_dicom
+from memory_stats import FORWARD_MB_PER_VIEW, MemoryBudgetExceeded
+from models import INPUT_SIZE
+
+DX_SOP_CLASS = "1.2.840.10008.5.1.4.1.1.1.1"  # Digital X-Ray Image Storage - For Presentation
+
+def make_dicom(pixels, photometric="MONOCHROME2", window=None, rescale=None, bits_stored=12):
+    """DICOM Part 10 bytes for a single-frame grayscale image."""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = DX_SOP_CLASS
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset("synthetic.dcm", {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = DX_SOP_CLASS
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "DX"
+    ds.PatientName = "Synthetic^Patient"
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = photometric
+    ds.BitsAllocated = 16
+    ds.BitsStored = bits_stored
+    ds.HighBit = bits_stored - 1
+    ds.PixelRepresentation = 1 if pixels.dtype == np.int16 else 0
+    if window is not None:
+        ds.WindowCenter, ds.WindowWidth = window
+    if rescale is not None:
+        ds.RescaleSlope, ds.RescaleIntercept = rescale
+    ds.PixelData = pixels.tobytes()
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    buffer = io.BytesIO()
+    pydicom.dcmwrite(buffer, ds, write_like_original=False)
+    return buffer.getvalue()
+
+def gray(image):
+    array = np.asarray(image)
+    assert array.shape == (INPUT_SIZE, INPUT_SIZE, 3)
+    assert (array[..., 0] == array[..., 1]).all() and (array[..., 0] == array[..., 2]).all()
+    return array[..., 0].astype(np.int32)
+
+def ramp(height=1024, width=768, high=4095):
+    """Horizontal 12-bit ramp: 0 on the left, `high` on the right."""
+    return np.tile(np.linspace(0, high, width), (height, 1)).astype(np.uint16)
+
+def test_detects_dicom_by_magic():
+    assert is_dicom(make_dicom(ramp(16, 16)))
+    assert not is_dicom(b"\xff\xd8\xff\xe0" + b"\0" * 200)  # JPEG
+    assert not is_dicom(b"short")
+
+def test_reads_only_needed_tags():
+    ds = read_dicom(make_dicom(ramp(16, 16)))
+    assert "PixelData" in ds and "PhotometricInterpretation" in ds
+    assert "PatientName" not in ds and "Modality" not in ds
+
+def test_downsamples_to_model_resolution():
+    values = gray(decode_dicom(make_dicom(ramp())))
+    assert values[:, 0].max() <= 2 and values[:, -1].min() >= 253
+    assert (np.diff(values[0]) >= 0).all()  # the ramp survives the area downsample
+
+def test_monochrome1_is_inverted():
+    data = ramp()
+    mono2 = gray(decode_dicom(make_dicom(data, "MONOCHROME2")))
+    mono1 = gray(decode_dicom(make_dicom(data, "MONOCHROME1")))
+    assert np.abs((255 - mono1) - mono2).max() <= 1
+
+def test_window_clips_outside_range():
+    # Window 1000..2000 of a 0..4095 ramp: left quarter black, right half white
+    values = gray(decode_dicom(make_dicom(ramp(), window=(1500, 1001))))
+    columns = values[0]
+    assert (columns[:INPUT_SIZE // 5] == 0).all()
+    assert (columns[-INPUT_SIZE // 3:] == 255).all()
+    assert 100 < columns[int(INPUT_SIZE * 1500 / 4095)] < 155
+
+def test_multi_valued_window_uses_first_preset():
+    first = gray(decode_dicom(make_dicom(ramp(), window=([1500, 500], [1001, 200]))))
+    single = gray(decode_dicom(make_dicom(ramp(), window=(1500, 1001))))
+    assert (first == single).all()
+
+def test_rescale_is_applied_before_window():
+    # Stored 0..4095 with slope 1, intercept -1024 (CT-like units): window centred at 476 = stored 1500
+    shifted = gray(decode_dicom(make_dicom(ramp(), window=(476, 1001), rescale=(1, -1024))))
+    plain = gray(decode_dicom(make_dicom(ramp(), window=(1500, 1001))))
+    assert np.abs(shifted - plain).max() <= 1
+
+def test_without_window_uses_value_range():
+    values = gray(decode_dicom(make_dicom(ramp(high=1000))))
+    assert values.min() == 0 and values.max() == 255
+
+def test_signed_pixels():
+    data = (ramp(high=2000).astype(np.int32) - 1000).astype(np.int16)
+    values = gray(decode_dicom(make_dicom(data, bits_stored=16)))
+    assert values[0, 0] == 0 and values[0, -1] == 255
+
+def test_rejects_color_photometric():
+    data = make_dicom(ramp(16, 16), photometric="PALETTE COLOR")
+    with pytest.raises(DicomError):
+        decode_dicom(data)
+
+def test_rejects_corrupt_file():
+    data = make_dicom(ramp(64, 64))
+    with pytest.raises(DicomError):
+        decode_dicom(data[:200])
+
+def test_budget_is_checked_before_decoding():
+    data = make_dicom(ramp())  # 1024x768 16-bit: 1.5 MB of stored pixels
+    with pytest.raises(MemoryBudgetExceeded):
+        decode_dicom(data, budget_mb=FORWARD_MB_PER_VIEW + 1)
+    gray(decode_dicom(data, budget_mb=FORWARD_MB_PER_VIEW + 2))
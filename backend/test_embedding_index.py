@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Similar-case index tests on random unit vectors (no model checkpoints needed).
+Run with `python -m pytest test_embedding_index.py` from backend/.
+"""
+
+import numpy as np
+import torch
+
+from embedding_index import EmbeddingCapture, EmbeddingIndex, combine
+
+DIM = 64
+
+def unit_rows(n, seed=0):
+    rows = np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+def fill(index, rows):
+    index.add(rows, [{"id": f"case-{i}", "source": "reference"} for i in range(len(rows))])
+
+def test_exact_search_matches_brute_force(tmp_path):
+    rows = unit_rows(3000)
+    index = EmbeddingIndex(str(tmp_path), dtype="float32")
+    fill(index, rows)
+    query = rows[123] + 0.05 * unit_rows(1, seed=1)[0]
+    query /= np.linalg.norm(query)
+    results = index.search(query, k=5)
+    expected = np.argsort(-(rows @ query))[:5]
+    assert [r["id"] for r in results] == [f"case-{i}" for i in expected]
+    assert results[0]["score"] >= results[-1]["score"]
+
+def test_incremental_appends_grow_and_persist(tmp_path):
+    rows = unit_rows(2500)
+    index = EmbeddingIndex(str(tmp_path))
+    for start in range(0, len(rows), 100):
+        index.add(rows[start:start + 100], [{"id": f"case-{i}"} for i in range(start, min(start + 100, len(rows)))])
+    assert len(index) == 2500 and index.header["capacity"] >= 2500
+
+    reopened = EmbeddingIndex(str(tmp_path))
+    assert len(reopened) == 2500
+    assert reopened.search(rows[2499], k=1)[0]["id"] == "case-2499"  # float16 rows still find themselves
+
+def test_ivf_search_finds_near_duplicates(tmp_path):
+    rows = unit_rows(4000)
+    index = EmbeddingIndex(str(tmp_path), dtype="float32")
+    fill(index, rows)
+    index.train_ivf(num_lists=32, iters=5)
+    index.add(rows[:1], [{"id": "appended-after-training"}])
+    hits = sum(index.search(rows[i], k=1, nprobe=4)[0]["id"] in (f"case-{i}", "appended-after-training")
+               for i in range(0, 4000, 97))
+    assert hits == len(range(0, 4000, 97))
+    assert EmbeddingIndex(str(tmp_path)).header["ivf_lists"] == 32
+
+def test_empty_index_returns_nothing(tmp_path):
+    assert EmbeddingIndex(str(tmp_path)).search(unit_rows(1)[0], k=5) == []
+
+def test_capture_records_only_expected_batches():
+    capture = EmbeddingCapture()
+    model = torch.nn.Sequential()
+    model.classifier = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(DIM, 3))
+    assert capture.attach("convnext", model)
+    assert not capture.attach("efficientnet", lambda x: x)  # e.g. an ONNX session wrapper
+
+    batch = torch.randn(2, DIM)
+    model(batch)  # not expected: nothing recorded
+    capture.expect(batch)
+    model(batch)
+    features = capture.collect(batch)
+    assert torch.equal(features["convnext"], batch)
+    assert capture.collect(batch) == {}
+
+def test_combine_is_unit_norm_and_needs_both_members():
+    features = {"convnext": torch.randn(3, 768), "efficientnet": torch.randn(3, 1280)}
+    embedding = combine(features)
+    assert embedding.shape == (2048,)
+    assert abs(np.linalg.norm(embedding) - 1.0) < 1e-5
+    assert combine({"convnext": features["convnext"]}) is None
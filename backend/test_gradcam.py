@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Batched vs single-image Grad-CAM on a tiny conv net (no checkpoints needed).
+Run with `python -m pytest test_gradcam.py` from backend/.
+"""
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from PIL import Image
+
+pytest.importorskip("pytorch_grad_cam")
+from pytorch_grad_cam.utils.image import preprocess_image
+
+import explain
+from explain import IMAGENET_MEAN, IMAGENET_STD, get_grad_cam_batch, get_grad_cam_optimized
+
+SIZE = 224
+
+def tiny_net():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 8, 3, stride=4, padding=1), nn.ReLU(),
+                         nn.Conv2d(8, 16, 3, stride=2, padding=1), nn.ReLU(),
+                         nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(16, 3)).eval()
+
+def sample_images(n):
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, (SIZE, SIZE, 3), dtype=np.uint8) for _ in range(n)]
+
+def test_batched_matches_single_image():
+    model = tiny_net()
+    target_layer = model[2]
+    pixels = sample_images(5)
+    images = [np.float32(image) / 255.0 for image in pixels]
+    batch = torch.cat([preprocess_image(image, mean=IMAGENET_MEAN, std=IMAGENET_STD) for image in images])
+    _, overlays, classes = get_grad_cam_batch(model, batch, target_layer, images=images)
+    with torch.no_grad():
+        assert classes.tolist() == model(batch).argmax(1).tolist()
+    for image, overlay in zip(pixels, overlays):
+        single = get_grad_cam_optimized(model, None, target_layer, image=Image.fromarray(image))
+        assert single is not None
+        assert np.abs(single.astype(np.int32) - overlay.astype(np.int32)).max() <= 2
+
+def test_chunk_sizing_is_measured_without_extra_forwards(monkeypatch):
+    model = tiny_net()
+    calls = []
+    model.register_forward_hook(lambda _m, inputs, _o: calls.append(len(inputs[0])))
+    monkeypatch.setattr(explain, "GRADCAM_CHUNK_MB", 1)
+    batch = torch.randn(12, 3, SIZE, SIZE)
+    heatmaps, overlays, _ = get_grad_cam_batch(model, batch, model[2])
+    assert heatmaps.shape == (12, SIZE, SIZE) and len(overlays) == 12
+    assert calls[:2] == [1, 2] and sum(calls) == 12  # measured on the real chunks
+    fixed, per_sample = explain._SAVED_BYTES[model][(3, SIZE, SIZE)]
+    assert per_sample > 0 and max(calls[2:]) <= max(1, (2 ** 20 - fixed) // per_sample)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Parity test: ONNX Runtime backend vs eager PyTorch on the sample X-rays.
+The members are built with seeded random weights, so no .pth checkpoints are needed:
+the export path and the graph are what is under test, not the trained weights.
+Run with `python -m pytest test_onnx_parity.py` from backend/.
+"""
+
+import pytest
+import torch
+
+pytest.importorskip("onnxruntime")
+
+from benchmark import load_sample_inputs
+from models import CONVNEXT_WEIGHT, EFFICIENTNET_WEIGHT, build_convnext, build_efficientnet
+from onnx_backend import OnnxMember, export_onnx
+
+PROB_TOLERANCE = 1e-4
+
+@pytest.fixture(scope="module")
+def members(tmp_path_factory):
+    """Eager and ONNX versions of both ensemble members (random weights)."""
+    out_dir = tmp_path_factory.mktemp("onnx")
+    torch.manual_seed(0)
+    convnext = build_convnext()
+    efficientnet = build_efficientnet()
+    export_onnx(convnext, str(out_dir / "convnext.onnx"))
+    export_onnx(efficientnet, str(out_dir / "efficientnet.onnx"))
+    return {
+        "convnext": (convnext, OnnxMember(str(out_dir / "convnext.onnx"))),
+        "efficientnet": (efficientnet, OnnxMember(str(out_dir / "efficientnet.onnx"))),
+    }
+
+def fused(convnext, efficientnet, input_tensor):
+    """Weighted softmax fusion exactly as predict() computes it."""
+    probs1 = torch.nn.functional.softmax(convnext(input_tensor), dim=1)
+    probs2 = torch.nn.functional.softmax(efficientnet(input_tensor), dim=1)
+    return (CONVNEXT_WEIGHT * probs1) + (EFFICIENTNET_WEIGHT * probs2)
+
+@pytest.mark.parametrize("name", ["convnext", "efficientnet"])
+def test_member_probabilities_match(members, name):
+    eager, onnx = members[name]
+    with torch.no_grad():
+        for input_tensor in load_sample_inputs():
+            expected = torch.nn.functional.softmax(eager(input_tensor), dim=1)
+            actual = torch.nn.functional.softmax(onnx(input_tensor), dim=1)
+            assert (expected - actual).abs().max().item() < PROB_TOLERANCE
+
+def test_ensemble_prediction_matches(members):
+    with torch.no_grad():
+        for input_tensor in load_sample_inputs():
+            expected = fused(members["convnext"][0], members["efficientnet"][0], input_tensor)
+            actual = fused(members["convnext"][1], members["efficientnet"][1], input_tensor)
+            top2 = expected.topk(2, dim=1).values
+            if (top2[0, 0] - top2[0, 1]).item() > 2 * PROB_TOLERANCE:  # random weights can tie
+                assert torch.argmax(expected, 1).item() == torch.argmax(actual, 1).item()
+            assert (expected - actual).abs().max().item() < PROB_TOLERANCE
+
+def test_batched_input(members):
+    _, onnx = members["efficientnet"]
+    batch = torch.cat(load_sample_inputs(), dim=0)
+    assert onnx(batch).shape == (batch.shape[0], 3)
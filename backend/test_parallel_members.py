@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+ParallelMembers tests on tiny conv nets (no checkpoints needed).
+Run with `python -m pytest test_parallel_members.py` from backend/.
+"""
+
+import torch
+import torch.nn as nn
+
+from models import ParallelMembers, threads_on_fresh_thread
+
+def tiny_member(seed):
+    torch.manual_seed(seed)
+    return nn.Sequential(nn.Conv2d(3, 8, 3, padding=1), nn.ReLU(), nn.AdaptiveAvgPool2d(1),
+                         nn.Flatten(), nn.Linear(8, 3)).eval()
+
+def test_parallel_matches_sequential():
+    convnext, efficientnet = tiny_member(0), tiny_member(1)
+    runner = ParallelMembers()
+    for batch in (1, 4):  # TTA batches come in several sizes
+        x = torch.randn(batch, 3, 32, 32)
+        outputs1, outputs2 = runner.run(convnext, efficientnet, x)
+        with torch.no_grad():
+            assert torch.allclose(outputs1, convnext(x), atol=1e-6)
+            assert torch.allclose(outputs2, efficientnet(x), atol=1e-6)
+
+def test_run_leaves_the_thread_count_alone():
+    before = threads_on_fresh_thread()
+    runner = ParallelMembers()
+    runner.run(tiny_member(0), tiny_member(1), torch.randn(2, 3, 32, 32))
+    assert threads_on_fresh_thread() == before
+    assert torch.get_num_threads() == before
+
+def test_traced_pair_follows_the_members():
+    convnext, efficientnet = tiny_member(0), tiny_member(1)
+    runner = ParallelMembers()
+    x = torch.randn(1, 3, 32, 32)
+    runner.run(convnext, efficientnet, x)
+    swapped = tiny_member(2)  # a hot swap replaces a member: the cached graph must not be reused
+    _, outputs2 = runner.run(convnext, swapped, x)
+    with torch.no_grad():
+        assert torch.allclose(outputs2, swapped(x), atol=1e-6)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Hot-swap, LRU and rollback tests for registry.py (pure Python, fake loader, no models needed).
+Run with `python -m pytest test_registry.py` from backend/.
+"""
+
+import os
+
+import pytest
+
+import registry
+from registry import ModelRegistry, ModelVersion, version_file
+
+def make_registry(capacity=2):
+    loads = []
+
+    def loader(name):
+        loads.append(name)
+        return ModelVersion(name, {"weights": [0.5, 0.5]})
+    return ModelRegistry(loader, capacity=capacity), loads
+
+def test_swap_keeps_in_flight_version():
+    reg, loads = make_registry()
+    old = reg.activate("v1")
+    in_flight = reg.current()  # what a request pinned before the swap
+    new = reg.activate("v2")
+    assert in_flight is old and reg.current() is new
+    assert in_flight.name == "v1" and new.name == "v2"
+    assert reg.activate("v1") is old  # served from the cache, not loaded again
+    assert loads == ["v1", "v2"]
+
+def test_lru_evicts_least_recently_served():
+    reg, loads = make_registry(capacity=2)
+    reg.activate("v1")
+    reg.activate("v2")
+    reg.activate("v1")
+    reg.activate("v3")  # v2 is the least recently served
+    assert not reg.is_cached("v2") and reg.is_cached("v1") and reg.is_cached("v3")
+    assert [entry["version"] for entry in reg.status()["cached"]] == ["v3", "v1"]
+    reg.activate("v2")
+    assert loads == ["v1", "v2", "v3", "v2"]
+
+def test_rollback():
+    reg, loads = make_registry()
+    reg.activate("v1")
+    with pytest.raises(KeyError):
+        reg.rollback()  # nothing else cached
+    reg.activate("v2")
+    assert reg.rollback().name == "v1"
+    assert reg.rollback().name == "v2"
+    assert loads == ["v1", "v2"]
+
+def test_version_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, "MODEL_REGISTRY_DIR", str(tmp_path))
+    assert version_file("builtin", "models/convnext_pneumonia.pth") == "models/convnext_pneumonia.pth"
+    assert version_file("2024-06-01", "models/convnext_pneumonia.pth") == \
+        os.path.join(str(tmp_path), "2024-06-01", "convnext_pneumonia.pth")
+    (tmp_path / "builtin").mkdir()  # an explicit builtin directory wins over the root paths
+    assert version_file("builtin", "models/convnext_pneumonia.pth") == \
+        os.path.join(str(tmp_path), "builtin", "convnext_pneumonia.pth")
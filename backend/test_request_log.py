@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Structured logging tests for request_log.py (pure Python, no models needed).
+Run with `python -m pytest test_request_log.py` from backend/.
+"""
+
+import json
+import logging
+import queue
+import time
+
+from request_log import JsonFormatter, NonBlockingQueueHandler, request_context, timed
+
+def make_logger(name, handler):
+    logger = logging.getLogger(f"test.{name}")
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+def test_records_carry_req_id_timings_and_fields():
+    records = queue.Queue()
+    log = make_logger("fields", NonBlockingQueueHandler(records))
+    with request_context("abc123") as timings:
+        with timed("decode"):
+            time.sleep(0.01)
+        with request_context("abc123") as inner:  # predict() re-entering the handler's context
+            assert inner is timings
+        log.info("Prediction served", extra={"timings_ms": dict(timings), "prediction": "NORMAL"})
+    log.info("Outside a request")
+
+    entry = json.loads(JsonFormatter().format(records.get_nowait()))
+    assert entry["req_id"] == "abc123" and entry["prediction"] == "NORMAL"
+    assert entry["timings_ms"]["decode"] >= 10
+    assert "req_id" not in json.loads(JsonFormatter().format(records.get_nowait()))
+
+def test_exception_traceback_is_formatted_by_the_consumer():
+    records = queue.Queue()
+    log = make_logger("exc", NonBlockingQueueHandler(records))
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError:
+        log.error("Prediction failed", exc_info=True)
+    record = records.get_nowait()
+    assert record.exc_info is not None  # not rendered on the logging thread
+    assert "RuntimeError: boom" in json.loads(JsonFormatter().format(record))["exc"]
+
+def test_sampling_only_applies_to_marked_info_records():
+    records = queue.Queue()
+    log = make_logger("sampling", NonBlockingQueueHandler(records, sample_rate=0.0))
+    for _ in range(10):
+        log.info("Prediction served", extra={"sample": True})
+    log.info("Model loaded")
+    log.warning("Grad-CAM failed", extra={"sample": True})
+    assert [records.get_nowait().getMessage() for _ in range(records.qsize())] == ["Model loaded", "Grad-CAM failed"]
+
+def test_full_queue_drops_and_summarizes_without_blocking():
+    records = queue.Queue(maxsize=2)
+    handler = NonBlockingQueueHandler(records, summary_s=0.0)
+    log = make_logger("pressure", handler)
+    start = time.perf_counter()
+    for i in range(100):
+        log.info("Prediction served", extra={"n": i})
+    assert time.perf_counter() - start < 1.0
+    assert records.qsize() == 2 and sum(handler.dropped.values()) == 98
+
+    records.get_nowait()
+    records.get_nowait()
+    log.warning("Request rejected")  # room again: the record plus one summary of the drops
+    assert records.get_nowait().getMessage() == "Request rejected"
+    summary = records.get_nowait()
+    assert summary.dropped_total == 98
+    assert summary.dropped[0] == {"logger": "test.pressure", "level": "INFO", "msg": "Prediction served", "count": 98}
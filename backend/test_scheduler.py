@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Priority-lane and fair-queueing tests for scheduler.py (pure Python, no models needed).
+Run with `python -m pytest test_scheduler.py` from backend/.
+"""
+
+import threading
+import time
+
+import pytest
+
+import scheduler
+from scheduler import FairScheduler, SchedulerFull, classify
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.005)
+
+def queue_behind(sched, order, requests):
+    """Queue (priority, client, weight) requests one by one; each records its label once it runs."""
+    threads = []
+    for priority, client, weight in requests:
+        def run(priority=priority, client=client, weight=weight):
+            with sched.slot(priority, client, weight):
+                order.append(client)
+        queued = len(sched.queues[priority])
+        thread = threading.Thread(target=run)
+        thread.start()
+        wait_for(lambda: len(sched.queues[priority]) == queued + 1)
+        threads.append(thread)
+    return threads
+
+def drain(sched, threads, priority="interactive"):
+    sched.release(priority)
+    for thread in threads:
+        thread.join(5)
+
+def test_interactive_overtakes_queued_bulk():
+    sched = FairScheduler(1, ["interactive", "bulk"])
+    sched.acquire("interactive", "holder")
+    order = []
+    threads = queue_behind(sched, order, [("bulk", "b1", 1), ("bulk", "b2", 1), ("interactive", "i1", 1)])
+    drain(sched, threads)
+    assert order == ["i1", "b1", "b2"]
+
+def test_reserved_slot_is_kept_for_interactive():
+    sched = FairScheduler(2, ["interactive", "bulk"], reserved=1)
+    sched.acquire("bulk", "job")
+    order = []
+    threads = queue_behind(sched, order, [("bulk", "job", 1)])  # one slot is free, but it is reserved
+    assert sched.running == {"interactive": 0, "bulk": 1}
+    sched.acquire("interactive", "clinician")  # granted at once
+    sched.release("interactive")
+    drain(sched, threads, "bulk")
+    assert order == ["job"]
+
+def test_clients_share_a_class_fairly():
+    sched = FairScheduler(1, ["interactive", "bulk"])
+    sched.acquire("interactive", "holder")
+    order = []
+    threads = queue_behind(sched, order, [("bulk", "big-job", 1)] * 6 + [("bulk", "small-job", 1)] * 2)
+    drain(sched, threads)
+    # The late small job is not stuck behind all six of the big job's requests
+    assert order.index("small-job") <= 2
+    assert order[-1] == "big-job"
+
+def test_weight_buys_a_larger_share():
+    sched = FairScheduler(1, ["interactive", "bulk"])
+    sched.acquire("interactive", "holder")
+    order = []
+    threads = queue_behind(sched, order, [("bulk", "light", 1)] * 4 + [("bulk", "heavy", 2)] * 4)
+    drain(sched, threads)
+    assert order[:6].count("heavy") == 4
+
+def test_full_class_queue_rejects():
+    sched = FairScheduler(1, ["interactive", "bulk"], max_queue=1)
+    sched.acquire("interactive", "holder")
+    order = []
+    threads = queue_behind(sched, order, [("bulk", "b1", 1)])
+    with pytest.raises(SchedulerFull):
+        sched.acquire("bulk", "b2")
+    assert sched.snapshot()["classes"]["bulk"]["rejected"] == 1
+    drain(sched, threads)
+
+def test_unlimited_slots_never_wait():
+    sched = FairScheduler(0, ["interactive", "bulk"])
+    for _ in range(10):
+        sched.acquire("bulk", "job")
+    assert sched.running["bulk"] == 10
+
+def test_classify(monkeypatch):
+    monkeypatch.setattr(scheduler, "PRIORITY_API_KEYS", {"rescore": ("bulk", 2.0)})
+    assert classify({"X-API-Key": "rescore", "X-Priority": "interactive"}) == ("bulk", "key:rescore", 2.0)
+    assert classify({"X-Priority": "bulk", "X-Client-Id": "job-7"}, "10.0.0.1") == ("bulk", "client:job-7", 1.0)
+    assert classify({}, "10.0.0.1") == ("interactive", "client:10.0.0.1", 1.0)
+    with pytest.raises(ValueError):
+        classify({"X-Priority": "urgent"})
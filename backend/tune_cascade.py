@@ -0,0 +1,81 @@
+# tune_cascade.py
+"""Pick the early-exit threshold for CASCADE_MODE from cached validation logits.
+
+For each candidate threshold the first member's prediction is kept when its
+softmax confidence clears the threshold; otherwise the full weighted
+ensemble decides. The lowest threshold whose accuracy stays within
+--max_accuracy_drop of the full ensemble wins, since it skips the second
+member most often.
+
+Usage:
+    python tune_cascade.py --cache val_logits.npz --data_dir chest_xray/val
+"""
+import argparse
+import os
+import torch
+
+from datasets import build_logit_cache, load_logit_cache
+from models import load_ensemble_config
+
+# Relative forward cost per member (GFLOPs at 224x224); override with measured latencies
+MEMBER_COST = {"convnext": 4.5, "efficientnet": 8.4}
+DEFAULT_THRESHOLDS = [0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 0.995, 0.999]
+
+def sweep(cache, first, thresholds, costs):
+    """Accuracy / exit rate / compute saving for each threshold, vectorized over the cache."""
+    second = "efficientnet" if first == "convnext" else "convnext"
+    # Same weights / temperatures as the server (ensemble_config.json when present)
+    config = load_ensemble_config()
+    probs = {name: torch.softmax(cache[name] / config[f"{name}_temperature"], dim=1) for name in ("convnext", "efficientnet")}
+    labels = cache["labels"]
+    ensemble_pred = (config["convnext_weight"] * probs["convnext"] + config["efficientnet_weight"] * probs["efficientnet"]).argmax(1)
+    first_conf, first_pred = probs[first].max(1)
+
+    # Rows = thresholds, columns = samples
+    exits = first_conf.unsqueeze(0) >= torch.tensor(thresholds).unsqueeze(1)
+    cascade_pred = torch.where(exits, first_pred.unsqueeze(0), ensemble_pred.unsqueeze(0))
+    accuracy = 100.0 * (cascade_pred == labels.unsqueeze(0)).float().mean(1)
+    exit_rate = exits.float().mean(1)
+    saving = 100.0 * exit_rate * costs[second] / (costs[first] + costs[second])
+
+    full_accuracy = 100.0 * (ensemble_pred == labels).float().mean().item()
+    rows = [
+        {"threshold": t, "accuracy": accuracy[i].item(), "exit_rate": 100.0 * exit_rate[i].item(), "saving": saving[i].item()}
+        for i, t in enumerate(thresholds)
+    ]
+    return full_accuracy, rows
+
+def main(args):
+    if not os.path.exists(args.cache):
+        print(f"[CASCADE] Building logit cache {args.cache} from {args.data_dir}...")
+        build_logit_cache(args.data_dir, args.cache)
+    cache = load_logit_cache(args.cache)
+    costs = {"convnext": args.convnext_cost, "efficientnet": args.efficientnet_cost}
+
+    best = None
+    for first in ("efficientnet", "convnext"):
+        full_accuracy, rows = sweep(cache, first, args.thresholds, costs)
+        print(f"\n=== first member: {first} (full ensemble accuracy {full_accuracy:.2f}%, n={len(cache['labels'])}) ===")
+        print(f"{'threshold':>10}{'accuracy (%)':>14}{'exit rate (%)':>15}{'compute saved (%)':>19}")
+        for row in rows:
+            ok = row["accuracy"] >= full_accuracy - args.max_accuracy_drop
+            print(f"{row['threshold']:>10.3f}{row['accuracy']:>14.2f}{row['exit_rate']:>15.1f}{row['saving']:>19.1f}{'' if ok else '  x'}")
+            if ok and (best is None or row["saving"] > best["saving"]):
+                best = dict(row, first=first)
+
+    if best is None:
+        print(f"\n[CASCADE] No threshold keeps accuracy within {args.max_accuracy_drop:.2f}pp; leave CASCADE_MODE off.")
+        return
+    print(f"\n[CASCADE] Recommended: CASCADE_MODE=1 CASCADE_FIRST={best['first']} CASCADE_THRESHOLD={best['threshold']}")
+    print(f"          expected accuracy {best['accuracy']:.2f}%, {best['exit_rate']:.1f}% early exits, "
+          f"~{best['saving']:.1f}% less compute")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Choose the cascade early-exit threshold from cached logits.")
+    parser.add_argument('--cache', type=str, default='val_logits.npz', help='Logit cache (built if missing)')
+    parser.add_argument('--data_dir', type=str, default=os.path.join('chest_xray', 'val'), help='Labelled images for building the cache')
+    parser.add_argument('--max_accuracy_drop', type=float, default=0.5, help='Allowed accuracy loss vs full ensemble (pp)')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=DEFAULT_THRESHOLDS, help='Candidate thresholds')
+    parser.add_argument('--convnext_cost', type=float, default=MEMBER_COST["convnext"], help='Relative ConvNeXt cost (e.g. measured ms)')
+    parser.add_argument('--efficientnet_cost', type=float, default=MEMBER_COST["efficientnet"], help='Relative EfficientNet cost (e.g. measured ms)')
+    main(parser.parse_args())
@@ -0,0 +1,138 @@
+# tune_ensemble.py
+"""Tune the ensemble fusion from cached validation logits and write ensemble_config.json.
+
+Both members run over the labelled set once (datasets.build_logit_cache);
+everything else is vectorized over that store:
+  1. per-member temperature scaling, fitted by minimizing NLL over a grid
+  2. ensemble weight (ConvNeXt w, EfficientNet 1 - w): best accuracy, ties
+     broken by NLL of the temperature-scaled fusion
+  3. risk threshold: the lowest confidence at which predictions above it
+     reach --target_precision; get_risk_level reports "Indeterminate" below it
+
+app.py (and export_ensemble.py) read the config at startup.
+
+Usage:
+    python tune_ensemble.py --cache val_logits.npz --data_dir chest_xray/val
+"""
+import argparse
+import json
+import os
+import torch
+
+from datasets import build_logit_cache, load_logit_cache
+from models import CONVNEXT_WEIGHT, EFFICIENTNET_WEIGHT, ENSEMBLE_CONFIG_PATH, RISK_THRESHOLD
+
+def fit_temperature(logits, labels, temperatures):
+    """Temperature with the lowest NLL; all candidates are evaluated in one [T, N, C] pass."""
+    log_probs = torch.log_softmax(logits.unsqueeze(0) / temperatures.view(-1, 1, 1), dim=2)
+    nll = -log_probs.gather(2, labels.view(1, -1, 1).expand(len(temperatures), -1, 1)).squeeze(2).mean(1)
+    best = int(nll.argmin())
+    return temperatures[best].item(), nll[best].item()
+
+def fuse(probs1, probs2, weights):
+    """[W, N, C] fused probabilities for each ConvNeXt weight w (EfficientNet gets 1 - w)."""
+    w = weights.view(-1, 1, 1)
+    return w * probs1.unsqueeze(0) + (1 - w) * probs2.unsqueeze(0)
+
+def search_weights(probs1, probs2, labels, weights):
+    fused = fuse(probs1, probs2, weights)
+    accuracy = 100.0 * (fused.argmax(2) == labels.unsqueeze(0)).float().mean(1)
+    nll = -torch.log(fused.gather(2, labels.view(1, -1, 1).expand(len(weights), -1, 1)).squeeze(2).clamp_min(1e-12)).mean(1)
+    # Highest accuracy first, then lowest NLL among the ties
+    candidates = torch.nonzero(accuracy == accuracy.max()).flatten()
+    best = candidates[nll[candidates].argmin()]
+    return weights[best].item(), accuracy[best].item(), nll[best].item()
+
+def expected_calibration_error(probs, labels, bins=15):
+    confidence, predicted = probs.max(1)
+    correct = (predicted == labels).float()
+    bin_idx = torch.clamp((confidence * bins).long(), max=bins - 1)
+    conf_sum = torch.bincount(bin_idx, weights=confidence, minlength=bins)
+    correct_sum = torch.bincount(bin_idx, weights=correct, minlength=bins)
+    return 100.0 * (conf_sum - correct_sum).abs().sum().item() / max(1, len(labels))
+
+def pick_risk_threshold(probs, labels, target_precision):
+    """Lowest confidence (%) such that predictions at or above it are >= target_precision correct.
+
+    Returns (threshold %, coverage %, precision %) or None if no threshold qualifies.
+    """
+    confidence, predicted = probs.max(1)
+    order = torch.argsort(confidence, descending=True)
+    sorted_conf = confidence[order]
+    correct = (predicted[order] == labels[order]).float()
+    precision = torch.cumsum(correct, 0) / torch.arange(1, len(correct) + 1)
+    # Only cut between distinct confidences so ties are all kept or all dropped
+    boundary = torch.ones_like(sorted_conf, dtype=torch.bool)
+    boundary[:-1] = sorted_conf[:-1] != sorted_conf[1:]
+    valid = torch.nonzero(boundary & (precision >= target_precision / 100.0)).flatten()
+    if len(valid) == 0:
+        return None
+    k = int(valid[-1])
+    return 100.0 * sorted_conf[k].item(), 100.0 * (k + 1) / len(correct), 100.0 * precision[k].item()
+
+def summarize(name, probs, labels, threshold):
+    confidence, predicted = probs.max(1)
+    kept = 100.0 * confidence >= threshold
+    precision = 100.0 * (predicted[kept] == labels[kept]).float().mean().item() if kept.any() else float('nan')
+    print(f"{name:<10} accuracy {100.0 * (predicted == labels).float().mean().item():6.2f}%  "
+          f"ECE {expected_calibration_error(probs, labels):5.2f}%  "
+          f"threshold {threshold:5.1f}% -> coverage {100.0 * kept.float().mean().item():5.1f}%, precision {precision:6.2f}%")
+
+def main(args):
+    if not os.path.exists(args.cache):
+        print(f"[ENSEMBLE] Building logit cache {args.cache} from {args.data_dir}...")
+        build_logit_cache(args.data_dir, args.cache)
+    cache = load_logit_cache(args.cache)
+    labels = cache["labels"]
+    print(f"[ENSEMBLE] {len(labels)} cached samples from {args.cache}")
+
+    temperatures = torch.arange(args.min_temperature, args.max_temperature + 1e-9, args.temperature_step)
+    fitted = {}
+    for name in ("convnext", "efficientnet"):
+        temperature, nll = fit_temperature(cache[name], labels, temperatures)
+        fitted[name] = temperature
+        print(f"  {name:<13} temperature {temperature:.2f} (NLL {nll:.4f})")
+    probs1 = torch.softmax(cache["convnext"] / fitted["convnext"], dim=1)
+    probs2 = torch.softmax(cache["efficientnet"] / fitted["efficientnet"], dim=1)
+
+    weights = torch.linspace(0.0, 1.0, args.weight_steps + 1)
+    weight, accuracy, nll = search_weights(probs1, probs2, labels, weights)
+    print(f"  weights       ConvNeXt {weight:.2f} / EfficientNet {1 - weight:.2f} (accuracy {accuracy:.2f}%, NLL {nll:.4f})")
+    tuned = fuse(probs1, probs2, torch.tensor([weight]))[0]
+
+    picked = pick_risk_threshold(tuned, labels, args.target_precision)
+    if picked is None:
+        threshold = RISK_THRESHOLD
+        print(f"[WARN] No confidence level reaches {args.target_precision:.1f}% precision; keeping {threshold:.1f}%")
+    else:
+        threshold = picked[0]
+
+    baseline = CONVNEXT_WEIGHT * torch.softmax(cache["convnext"], dim=1) + EFFICIENTNET_WEIGHT * torch.softmax(cache["efficientnet"], dim=1)
+    print()
+    summarize("defaults", baseline, labels, RISK_THRESHOLD)
+    summarize("tuned", tuned, labels, threshold)
+
+    config = {
+        "convnext_weight": round(weight, 4),
+        "efficientnet_weight": round(1 - weight, 4),
+        "convnext_temperature": round(fitted["convnext"], 4),
+        "efficientnet_temperature": round(fitted["efficientnet"], 4),
+        "risk_threshold": round(threshold, 2),
+        "target_precision": args.target_precision,
+        "source": {"cache": args.cache, "samples": len(labels)},
+    }
+    with open(args.out, "w") as f:
+        json.dump(config, f, indent=2)
+    print(f"\n[ENSEMBLE] Wrote {args.out}; restart the server (and re-run export_ensemble.py for the torchscript backend).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune ensemble weights, temperatures and the risk threshold from cached logits.")
+    parser.add_argument('--cache', type=str, default='val_logits.npz', help='Logit cache (built if missing)')
+    parser.add_argument('--data_dir', type=str, default=os.path.join('chest_xray', 'val'), help='Labelled images for building the cache')
+    parser.add_argument('--out', type=str, default=ENSEMBLE_CONFIG_PATH, help='Config file read by app.py')
+    parser.add_argument('--target_precision', type=float, default=95.0, help='Required accuracy (%%) of predictions above the risk threshold')
+    parser.add_argument('--weight_steps', type=int, default=100, help='Grid resolution for the ConvNeXt weight in [0, 1]')
+    parser.add_argument('--min_temperature', type=float, default=0.25, help='Smallest temperature tried')
+    parser.add_argument('--max_temperature', type=float, default=5.0, help='Largest temperature tried')
+    parser.add_argument('--temperature_step', type=float, default=0.05, help='Temperature grid step')
+    main(parser.parse_args())